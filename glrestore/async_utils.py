@@ -0,0 +1,365 @@
+"""
+An optional asyncio engine for the S3 requests (needs aiobotocore)
+
+Drives ListObjectsV2 / HeadObject / RestoreObject with thousands of requests in flight on a single thread, and
+makes the same decisions as the threaded functions in glrestore.s3_utils
+"""
+
+import time
+import asyncio
+import logging
+import itertools
+
+from collections import defaultdict, deque
+from botocore.exceptions import ClientError
+
+import glrestore.metrics
+import glrestore.s3_utils
+import glrestore.scheduler
+
+try:
+    import aiobotocore.session
+    import aiobotocore.config
+except ImportError:
+    aiobotocore = None
+
+# Objects to restore are pulled from a lazy iterable (like the --stream pipeline) this many at a time
+PULL_BATCH_SIZE = 500
+
+def pull_batch(it):
+    """
+    Return the next PULL_BATCH_SIZE items of iterator it (fewer once it runs out)
+    """
+    return list(itertools.islice(it, PULL_BATCH_SIZE))
+
+def require_aiobotocore():
+    """
+    Raise a helpful error if aiobotocore isn't installed
+    """
+    if aiobotocore is None:
+        raise Exception("The asyncio engine needs aiobotocore. Install it with: pip install aiobotocore")
+
+class AsyncS3(object):
+    """
+    Region-aware aiobotocore S3 clients that share one cap on the number of requests in flight
+
+    Use as "async with AsyncS3(...) as s3:"
+    """
+    def __init__(self, max_in_flight=1000, **kwargs):
+        require_aiobotocore()
+        self.max_in_flight = max_in_flight
+        self.kwargs = kwargs
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.session = aiobotocore.session.AioSession(profile=kwargs.get('profile'))
+        glrestore.metrics.attach(self.session)
+        self.config = aiobotocore.config.AioConfig(max_pool_connections=max_in_flight)
+        self.clients = {}
+        self.contexts = []
+        self.lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        for context in self.contexts:
+            await context.__aexit__(None, None, None)
+
+    async def get_client(self, region=None):
+        """
+        Return the client for region, making it if need be
+        """
+        async with self.lock:
+            if region not in self.clients:
+                context = self.session.create_client('s3', region_name=region, config=self.config)
+                self.clients[region] = await context.__aenter__()
+                self.contexts.append(context)
+        return self.clients[region]
+
+    async def get_client_for_bucket(self, bucket):
+        """
+        Return the client for the region bucket lives in (sharing the bucket region cache with s3_utils)
+        """
+        regions = glrestore.s3_utils._BUCKET_REGIONS
+        if bucket not in regions:
+            client = await self.get_client()
+            try:
+                response = await self.call(client.head_bucket, Bucket=bucket)
+                headers = response['ResponseMetadata']['HTTPHeaders']
+            except ClientError as e:
+                # S3 still reports the region on 301 / 403 responses
+                headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+            regions[bucket] = headers.get('x-amz-bucket-region')
+        return await self.get_client(regions[bucket])
+
+    async def call(self, func, retries=None, **params):
+        """
+        Await func(**params) once a slot is free, retrying throttling / 5xx errors with jittered backoff
+        """
+        if retries is None:
+            retries = self.kwargs.get('retries', 8)
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    return await func(**params)
+            except Exception as e:
+                if (attempt >= retries) or (not glrestore.s3_utils.is_retryable_error(e)):
+                    raise
+                glrestore.metrics.count_retry(func.__name__)
+                await asyncio.sleep(glrestore.s3_utils.backoff_delay(attempt))
+                attempt += 1
+
+    async def list_pages(self, bucket, prefix, delimiter=None, start_after=None):
+        """
+        Return the "Contents" of each ListObjectsV2 page under prefix (see s3_utils.iter_list_pages)
+        """
+        client = await self.get_client_for_bucket(bucket)
+        params = {'Bucket': bucket, 'Prefix': prefix, 'OptionalObjectAttributes': ['RestoreStatus']}
+        if delimiter is not None:
+            params['Delimiter'] = delimiter
+        if start_after is not None:
+            params['StartAfter'] = start_after
+
+        while True:
+            page = await self.call(client.list_objects_v2, **params)
+            yield page.get('Contents', [])
+
+            if not page.get('IsTruncated', False):
+                break
+            params['ContinuationToken'] = page['NextContinuationToken']
+
+    async def list_common_prefixes(self, bucket, prefix):
+        """
+        Return the "directories" directly under prefix (see s3_utils.list_common_prefixes)
+        """
+        client = await self.get_client_for_bucket(bucket)
+        params = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': '/'}
+
+        prefixes = []
+        while True:
+            page = await self.call(client.list_objects_v2, **params)
+            prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+
+            if not page.get('IsTruncated', False):
+                break
+            params['ContinuationToken'] = page['NextContinuationToken']
+        return prefixes
+
+    async def head_object(self, s3_loc):
+        """
+        Return the head_object response for s3_loc, or None if it doesn't exist
+        """
+        bucket, key = glrestore.s3_utils.get_bucket_key(s3_loc)
+        client = await self.get_client_for_bucket(bucket)
+        try:
+            return await self.call(client.head_object, Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ['404', 'NoSuchKey']:
+                logging.warning(f"{s3_loc} does not exist")
+                return None
+            raise
+
+async def sweep_async(s3, bucket, items, exact=True):
+    """
+    Return the raw table rows for a group of keys / prefixes that share a directory (see s3_utils.sweep)
+    """
+    state = glrestore.s3_utils.SweepState(bucket, items, exact=exact)
+    records = []
+    try:
+        async for contents in s3.list_pages(bucket, state.prefix, delimiter=state.delimiter):
+            records.extend(state.add_page(contents))
+            if state.done:
+                break
+        else:
+            state.complete = True
+    except ClientError as e:
+        logging.debug(f"Could not list s3://{bucket}/{state.prefix} ({e}); will look up the items one by one")
+
+    heads, relists = state.leftovers()
+
+    async def _head(key):
+        f = f"s3://{bucket}/{key}"
+        response = await s3.head_object(f)
+        return None if response is None else glrestore.s3_utils.head_to_record(f, response)
+
+    async def _relist(prefix, start_after):
+        found = []
+        async for contents in s3.list_pages(bucket, prefix, start_after=start_after):
+            found.extend(glrestore.s3_utils.listing_to_record(bucket, entry) for entry in contents)
+        return found
+
+    for record in await asyncio.gather(*[_head(key) for key in heads]):
+        if record is not None:
+            records.append(record)
+    for found in await asyncio.gather(*[_relist(p, sa) for p, sa in relists]):
+        records.extend(found)
+    return records
+
+async def list_wildcard_async(s3, bucket, pattern):
+    """
+    Return the raw table rows for every object in bucket whose key matches the glob pattern (see s3_utils.GlobPattern)
+    """
+    glob = glrestore.s3_utils.GlobPattern(pattern)
+
+    dirs = [glob.base]
+    for i, seg in enumerate(glob.segments[:glob.depth]):
+        if not glrestore.s3_utils.has_wildcard(seg):
+            dirs = [d + seg + '/' for d in dirs]
+            continue
+        children = await asyncio.gather(*[s3.list_common_prefixes(bucket, glob.level_prefix(d, i)) for d in dirs])
+        dirs = [c for d, cs in zip(dirs, children) for c in cs if glob.child_matches(i, d, c)]
+
+    async def _list(d):
+        found = []
+        async for contents in s3.list_pages(bucket, glob.final_prefix(d)):
+            found.extend(glrestore.s3_utils.listing_to_record(bucket, e) for e in contents if glob.matches(e['Key']))
+        return found
+
+    return [r for found in await asyncio.gather(*[_list(d) for d in dirs]) for r in found]
+
+async def get_object_storage_class_async(s3_locs, exact=None, max_in_flight=1000, **kwargs):
+    """
+    Coroutine version of s3_utils.get_object_storage_class_v2; returns the same object table
+    """
+    s3_locs, exact = glrestore.s3_utils.normalise_s3_locs(s3_locs, exact)
+
+    cached = []
+    cache = kwargs.get('status_cache')
+    if cache is not None:
+        cached, s3_locs = cache.split(s3_locs, exact)
+
+    async def _counted(lookup):
+        found = await lookup
+        glrestore.metrics.tick('objects_classified', len(found))
+        return found
+
+    async with AsyncS3(max_in_flight=max_in_flight, **kwargs) as s3:
+        lookups = []
+        for lookup in glrestore.s3_utils.plan_lookups(s3_locs, exact):
+            if lookup[0] == 'sweep':
+                lookups.append(_counted(sweep_async(s3, lookup[1], lookup[2], exact=lookup[3])))
+            else:
+                lookups.append(_counted(list_wildcard_async(s3, lookup[1], lookup[2])))
+        results = await asyncio.gather(*lookups)
+
+    records = {}
+    for record in cached + [r for result in results for r in result]:
+        records.setdefault(record['file'], record)
+    db = glrestore.s3_utils.records_to_table(records.values())
+
+    if cache is not None:
+        cache.update(db, prefixes=None if exact else s3_locs)
+    return db
+
+async def restore_file_async(f, s3=None, **kwargs):
+    """
+    Coroutine version of s3_utils.restore_file; returns the same statuses
+    """
+    if s3 is None:
+        async with AsyncS3(**kwargs) as s3:
+            return await restore_file_async(f, s3=s3, **kwargs)
+
+    obucket, okey = glrestore.s3_utils.get_bucket_key(f)
+    client = await s3.get_client_for_bucket(obucket)
+
+    try:
+        response = await s3.call(client.restore_object, retries=kwargs.get('retries', 8),
+            Bucket=obucket,
+            Key=okey,
+            RestoreRequest={
+                'Days': kwargs.get('days'),
+                'GlacierJobParameters': {
+                 'Tier': str(kwargs.get('speed'))}})
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'RestoreAlreadyInProgress':
+            return 'in-progress'
+        raise
+
+    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        return 'already-restored'
+    return 'issued'
+
+async def restore_files_async(s3_locs, max_in_flight=1000, on_failed=None, on_finished=None, scheduler=None, **kwargs):
+    """
+    Coroutine version of s3_utils.restore_files, with up to max_in_flight requests at once
+
+    Uses the same PrefixScheduler as the threaded engine to spread requests across prefixes
+    """
+    counts = defaultdict(int)
+    failed = []
+    retries = kwargs.get('retries', 8)
+    request_kwargs = dict(kwargs, retries=0)
+
+    if scheduler is None:
+        scheduler = glrestore.scheduler.PrefixScheduler(concurrency=max_in_flight, max_limit=kwargs.get('max_per_prefix'))
+
+    def _finish(f, status, error):
+        glrestore.metrics.tick('restores_finished')
+        if on_finished is not None:
+            on_finished(f, status, error)
+        if error is None:
+            counts[status] += 1
+            return
+        logging.debug(f"Restore of {f} failed: {error}")
+        counts['failed'] += 1
+        if on_failed is not None:
+            on_failed(f, str(error))
+        else:
+            failed.append((f, str(error)))
+
+    async with AsyncS3(max_in_flight=max_in_flight, **kwargs) as s3:
+        async def _restore(f, attempt):
+            try:
+                return f, attempt, await restore_file_async(f, s3=s3, **request_kwargs), None
+            except Exception as e:
+                return f, attempt, None, e
+
+        # Generators (like the --stream pipeline) are pulled from a batch at a time in a worker thread so they
+        # don't hold up the event loop
+        loop = asyncio.get_running_loop()
+        lazy = not isinstance(s3_locs, (list, tuple, set))
+        it = iter(s3_locs)
+        buffered = deque()
+        exhausted = False
+        pending = set()
+
+        while True:
+            for _ in range(scheduler.concurrency):
+                if exhausted or not scheduler.can_add():
+                    break
+                if len(buffered) == 0:
+                    buffered.extend(await loop.run_in_executor(None, pull_batch, it) if lazy else pull_batch(it))
+                    if len(buffered) == 0:
+                        exhausted = True
+                        break
+                scheduler.add(buffered.popleft())
+
+            now = time.time()
+            while True:
+                ready = scheduler.next_ready(now)
+                if ready is None:
+                    break
+                pending.add(asyncio.ensure_future(_restore(*ready)))
+
+            if exhausted and scheduler.idle():
+                break
+
+            wakeup = scheduler.next_wakeup(now)
+            timeout = None if wakeup is None else max(0.001, wakeup - now)
+            if (not exhausted) and scheduler.can_add():
+                timeout = 0
+            if len(pending) == 0:
+                await asyncio.sleep(timeout or 0)
+                continue
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            now = time.time()
+            for task in done:
+                f, attempt, status, error = task.result()
+                if glrestore.scheduler.handle_outcome(scheduler, f, attempt, error, retries, now):
+                    _finish(f, status, error)
+
+    if scheduler.throttles > 0:
+        logging.info(f"S3 throttled {scheduler.throttles} restore requests; the busiest prefixes were:")
+        scheduler.log_stats(level=logging.INFO)
+    return counts, failed
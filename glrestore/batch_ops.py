@@ -0,0 +1,222 @@
+"""
+Restore objects with an S3 Batch Operations job instead of one restore request per object
+
+The objects to restore are written to a CSV manifest and uploaded, an S3InitiateRestoreObject job is created with
+s3control, and once the job is done its completion report is read back so every object has a result
+"""
+
+import io
+import csv
+import json
+import time
+import uuid
+import logging
+import urllib.parse
+
+import pandas as pd
+
+from botocore.exceptions import ClientError
+
+import glrestore.s3_utils
+
+# --speed -> the tier names Batch Operations uses. Batch Operations can't do Expedited restores
+SPEED2BATCH_TIER = {'Standard': 'STANDARD', 'Bulk': 'BULK'}
+
+FINISHED_JOB_STATUSES = ['Complete', 'Failed', 'Cancelled']
+
+def tasks_finished(job):
+    """
+    Return how many of a job's tasks have succeeded or failed so far, going by its description
+    """
+    summary = job.get('ProgressSummary', {})
+    return summary.get('NumberOfTasksSucceeded', 0) + summary.get('NumberOfTasksFailed', 0)
+
+def write_manifest(keys, bucket):
+    """
+    Return the CSV manifest (Bucket,Key with URL-encoded keys) for keys in bucket, as bytes
+    """
+    out = io.StringIO()
+    for key in keys:
+        out.write(f"{bucket},{urllib.parse.quote(key, safe='/')}\n")
+    return out.getvalue().encode()
+
+def parse_location(location):
+    """
+    Turn the s3:// --batch-ops-location into (bucket, prefix); the prefix ends with "/" unless it's empty
+    """
+    bucket, prefix = glrestore.s3_utils.get_bucket_key(location)
+    if (len(prefix) > 0) and not prefix.endswith('/'):
+        prefix += '/'
+    return bucket, prefix
+
+class BatchRestoreJob(object):
+    """
+    One S3 Batch Operations restore job over the objects of one bucket
+
+    "location" is where the manifest and completion report go (s3://bucket/prefix/), and "role_arn" is the IAM
+    role Batch Operations runs as (it needs s3:RestoreObject on the objects, s3:GetObject on the manifest and
+    s3:PutObject on the report location)
+    """
+    def __init__(self, bucket, keys, location, role_arn, days=7, speed='Bulk', account_id=None, s3control=None,
+                 sleep=time.sleep, **kwargs):
+        if speed not in SPEED2BATCH_TIER:
+            raise Exception(f"S3 Batch Operations can only restore at {' or '.join(SPEED2BATCH_TIER)} speed, not {speed}")
+
+        self.bucket = bucket
+        self.keys = list(keys)
+        self.location_bucket, self.location_prefix = parse_location(location)
+        self.role_arn = role_arn
+        self.days = days
+        self.tier = SPEED2BATCH_TIER[speed]
+        self.sleep = sleep
+        self.kwargs = kwargs
+
+        self.account_id = account_id if account_id is not None else self.get_account_id()
+        region = glrestore.s3_utils.get_bucket_region(bucket, **kwargs)
+        self.s3control = s3control if s3control is not None else \
+            glrestore.s3_utils.get_service_client('s3control', region=region, **kwargs)
+
+        self.token = str(uuid.uuid4())
+        self.job_id = None
+        self.status = None
+        self.manifest_key = None
+
+    def get_account_id(self):
+        """
+        Return the AWS account the credentials belong to
+        """
+        sts = glrestore.s3_utils.get_service_client('sts', **self.kwargs)
+        return sts.get_caller_identity()['Account']
+
+    def upload_manifest(self):
+        """
+        Write the manifest to the location and return its (key, ETag)
+        """
+        self.manifest_key = f"{self.location_prefix}glrestore-{self.token}/manifest.csv"
+        client = glrestore.s3_utils.get_client_for_bucket(self.location_bucket, **self.kwargs)
+        re = client.put_object(Bucket=self.location_bucket, Key=self.manifest_key,
+                               Body=write_manifest(self.keys, self.bucket))
+        logging.info(f"Uploaded a manifest of {len(self.keys)} objects to s3://{self.location_bucket}/{self.manifest_key}")
+        return self.manifest_key, re['ETag']
+
+    def create(self):
+        """
+        Upload the manifest and create the job; returns the job ID
+        """
+        key, etag = self.upload_manifest()
+        re = self.s3control.create_job(
+            AccountId=self.account_id,
+            ConfirmationRequired=False,
+            Operation={'S3InitiateRestoreObject': {'ExpirationInDays': self.days, 'GlacierJobTier': self.tier}},
+            Manifest={
+                'Spec': {'Format': 'S3BatchOperations_CSV_20180820', 'Fields': ['Bucket', 'Key']},
+                'Location': {'ObjectArn': f"arn:aws:s3:::{self.location_bucket}/{key}", 'ETag': etag}},
+            Report={
+                'Bucket': f"arn:aws:s3:::{self.location_bucket}",
+                'Prefix': f"{self.location_prefix}glrestore-{self.token}/report",
+                'Format': 'Report_CSV_20180820',
+                'Enabled': True,
+                'ReportScope': 'AllTasks'},
+            ClientRequestToken=self.token,
+            Description=f"glrestore restore of {len(self.keys)} objects from {self.bucket}",
+            Priority=10,
+            RoleArn=self.role_arn)
+        self.job_id = re['JobId']
+        logging.info(f"Created S3 Batch Operations job {self.job_id} to restore {len(self.keys)} objects from {self.bucket} ({self.tier}, {self.days} days)")
+        return self.job_id
+
+    def describe(self):
+        """
+        Return the job description from s3control
+        """
+        job = self.s3control.describe_job(AccountId=self.account_id, JobId=self.job_id)['Job']
+        self.status = job['Status']
+        return job
+
+    def wait(self, interval=30, progress=None):
+        """
+        Wait for the job to finish, and return its final description. "progress" is called with each description
+        """
+        while True:
+            job = self.describe()
+            summary = job.get('ProgressSummary', {})
+            logging.info(f"Job {self.job_id} is {job['Status']}: {summary.get('NumberOfTasksSucceeded', 0)} succeeded, {summary.get('NumberOfTasksFailed', 0)} failed of {summary.get('TotalNumberOfTasks', '?')}")
+            if progress is not None:
+                progress(job)
+            if job['Status'] in FINISHED_JOB_STATUSES:
+                if job['Status'] != 'Complete':
+                    logging.error(f"Job {self.job_id} finished as {job['Status']}: {job.get('FailureReasons', [])}")
+                return job
+            self.sleep(interval)
+
+    def read_report(self):
+        """
+        Return the job's completion report as a DataFrame of file, batch_status and batch_error
+        """
+        client = glrestore.s3_utils.get_client_for_bucket(self.location_bucket, **self.kwargs)
+        prefix = f"{self.location_prefix}glrestore-{self.token}/report/job-{self.job_id}/"
+        manifest = json.loads(client.get_object(Bucket=self.location_bucket, Key=prefix + 'manifest.json')['Body'].read())
+
+        rows = []
+        for result in manifest.get('Results', []):
+            body = client.get_object(Bucket=result['Bucket'], Key=result['Key'])['Body'].read().decode()
+            for row in csv.reader(io.StringIO(body)):
+                if len(row) < 4:
+                    continue
+                bucket, key, version, task_status = row[:4]
+                error = row[4] if len(row) > 4 else ''
+                message = row[6] if len(row) > 6 else ''
+                rows.append({'file': f"s3://{bucket}/{urllib.parse.unquote(key)}",
+                             'batch_status': task_status.lower(),
+                             'batch_error': ' '.join(x for x in [error, message] if len(x) > 0)})
+        return pd.DataFrame(rows, columns=['file', 'batch_status', 'batch_error'])
+
+    def run(self, interval=30, progress=None):
+        """
+        Create the job, wait for it, and return its completion report
+
+        If the job failed before writing a report, every object is reported as failed with the job's reasons
+        """
+        self.create()
+        job = self.wait(interval=interval, progress=progress)
+        try:
+            return self.read_report()
+        except ClientError as e:
+            if job['Status'] == 'Complete':
+                raise
+            reasons = '; '.join(r.get('FailureReason', '') for r in job.get('FailureReasons', [])) or job['Status']
+            logging.debug(f"No completion report for job {self.job_id} ({e})")
+            return pd.DataFrame({'file': [f"s3://{self.bucket}/{k}" for k in self.keys],
+                                 'batch_status': 'failed', 'batch_error': f"Job {job['Status']}: {reasons}"},
+                                columns=['file', 'batch_status', 'batch_error'])
+
+def batch_restore(s3_locs, location, role_arn, interval=30, progress=None, **kwargs):
+    """
+    Restore s3_locs with one Batch Operations job per bucket; return the combined completion reports. "progress"
+    is called with the number of objects every job so far has finished with, each time a job is checked
+    """
+    bucket2keys = {}
+    for f in s3_locs:
+        bucket, key = glrestore.s3_utils.get_bucket_key(f)
+        bucket2keys.setdefault(bucket, []).append(key)
+
+    reports = []
+    done = 0
+    for bucket, keys in bucket2keys.items():
+        job = BatchRestoreJob(bucket, keys, location, role_arn, account_id=kwargs.get('batch_ops_account_id'), **kwargs)
+        _progress = None if progress is None else (lambda j, before=done: progress(before + tasks_finished(j)))
+        reports.append(job.run(interval=interval, progress=_progress))
+        done += len(keys)
+    if len(reports) == 0:
+        return pd.DataFrame(columns=['file', 'batch_status', 'batch_error'])
+    return pd.concat(reports, ignore_index=True)
+
+def apply_report(cdb, report):
+    """
+    Add the batch_status / batch_error of a completion report to the object table; objects the job restored are
+    marked as restoring
+    """
+    cdb = cdb.merge(report, on='file', how='left')
+    succeeded = (cdb['batch_status'] == 'succeeded') & (cdb['restore_status'] == 'not-restored')
+    cdb.loc[succeeded, 'restore_status'] = 'restoring'
+    return cdb
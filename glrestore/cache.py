@@ -0,0 +1,235 @@
+"""
+A persistent, on-disk cache of object status so reruns only go to S3 for objects that could have changed
+"""
+
+import os
+import time
+import bisect
+import logging
+import sqlite3
+import datetime
+import threading
+
+import pandas as pd
+
+import glrestore.s3_utils
+
+def default_cache_location():
+    """
+    Where the status cache lives unless --cache says otherwise
+    """
+    return os.path.join(os.path.expanduser('~'), '.glrestore', 'status_cache.sqlite')
+
+class StatusCache(object):
+    """
+    SQLite cache of the object table, keyed by bucket / key / ETag
+
+    Entries are only trusted when their state can't have changed since they were recorded:
+    - restored objects are trusted until their restore expiry-date
+    - objects that aren't archived are trusted for max_age seconds after they were last checked (a lifecycle
+      transition to an archive class doesn't change LastModified or the ETag, so nothing else would notice it)
+    Everything else (objects being restored, archived objects that haven't been restored) always goes to S3
+    """
+    def __init__(self, location, max_age=24 * 3600):
+        """
+        Open (or create) the cache at location
+        """
+        if os.path.dirname(location) != '':
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+
+        self.location = location
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # Shards running in parallel processes share the cache, so wait for each other's writes
+        self.conn = sqlite3.connect(location, timeout=60, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS objects (
+            bucket TEXT, key TEXT, etag TEXT, storage_class TEXT, restore_status TEXT, last_modified REAL,
+            size_bytes INTEGER, restore_expiry REAL, sole_match INTEGER, checked REAL,
+            PRIMARY KEY (bucket, key))""")
+        # Copies of restored objects to a hot storage class (--copy-to-class), and how they went
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS copies (
+            bucket TEXT, key TEXT, destination TEXT, etag TEXT, storage_class TEXT, status TEXT, error TEXT,
+            updated REAL, PRIMARY KEY (bucket, key, destination))""")
+        self.conn.commit()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.writes = 0
+
+    def get(self, files):
+        """
+        Return a dictionary of file -> cached row for every file in the cache
+        """
+        bucket2keys = {}
+        for f in files:
+            bucket, key = glrestore.s3_utils.get_bucket_key(f)
+            bucket2keys.setdefault(bucket, []).append(key)
+
+        rows = {}
+        with self.lock:
+            for bucket, keys in bucket2keys.items():
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    cursor = self.conn.execute(
+                        f"SELECT key, etag, storage_class, restore_status, last_modified, size_bytes, restore_expiry, sole_match, checked FROM objects WHERE bucket = ? AND key IN ({','.join('?' * len(chunk))})",
+                        [bucket] + chunk)
+                    for row in cursor:
+                        rows[f"s3://{bucket}/{row[0]}"] = row[1:]
+        return rows
+
+    def split(self, s3_locs, exact, now=None):
+        """
+        Split s3_locs into raw rows of the object table that can be served from the cache, and the s3_locs that
+        still need to go to S3
+
+        When not exact, s3_locs are prefixes / wildcards; a prefix is only served from the cache when the last
+        listing of it found a single object with exactly that name
+        """
+        if now is None:
+            now = time.time()
+
+        candidates = [f for f in s3_locs if exact or not (glrestore.s3_utils.has_wildcard(f) or f.endswith('/'))]
+        rows = self.get(candidates)
+
+        cached = []
+        remaining = []
+        for f in s3_locs:
+            row = rows.get(f)
+            if (row is not None) and (exact or row[6] == 1) and self.is_trusted(row, now):
+                cached.append(self.row_to_record(f, row))
+            else:
+                remaining.append(f)
+
+        self.hits += len(cached)
+        self.misses += len(candidates) - len(cached)
+        return cached, remaining
+
+    def is_trusted(self, row, now):
+        """
+        Return True if a cached row's state can't have changed since it was recorded
+        """
+        etag, storage_class, restore_status, last_modified, size_bytes, restore_expiry = row[:6]
+        if (restore_status == 'restored') and (restore_expiry is not None) and (restore_expiry > now):
+            return True
+        checked = row[7]
+        return (storage_class not in glrestore.s3_utils.ARCHIVE_STORAGE_CLASSES) and (checked is not None) and \
+            (now - checked < self.max_age)
+
+    @staticmethod
+    def row_to_record(f, row):
+        """
+        Turn a cached row into a raw row of the object table
+        """
+        etag, storage_class, restore_status, last_modified, size_bytes, restore_expiry = row[:6]
+        record = {'file': f, 'storage_class': storage_class, 'size_bytes': size_bytes, 'etag': etag,
+                  'LastModified': datetime.datetime.fromtimestamp(last_modified, datetime.timezone.utc)}
+        if (restore_status == 'restored') and (restore_expiry is not None):
+            record['restore_ongoing'] = False
+            record['restore_expiry'] = datetime.datetime.fromtimestamp(restore_expiry, datetime.timezone.utc)
+        return record
+
+    def update(self, cdb, prefixes=None):
+        """
+        Record the rows of an object table
+
+        If prefixes is given, those are the prefixes / wildcards that were listed to make the table, and prefixes
+        that matched only an object with exactly their name are remembered as such
+        """
+        if len(cdb) == 0:
+            return
+
+        files = cdb['file'].tolist()
+        sole = None
+        if prefixes is not None:
+            sole = set()
+            sorted_files = sorted(files)
+            for p in prefixes:
+                i = bisect.bisect_left(sorted_files, p)
+                if (i < len(sorted_files)) and (sorted_files[i] == p) and \
+                        ((i + 1 == len(sorted_files)) or not sorted_files[i + 1].startswith(p)):
+                    sole.add(p)
+
+        columns = zip(files, [None if pd.isna(e) else str(e) for e in cdb['etag']],
+                      cdb['storage_class'].astype(str).tolist(), cdb['restore_status'].astype(str).tolist(),
+                      _to_epoch(cdb['LastModified']), cdb['size_bytes'].tolist(), _to_epoch(cdb['restore_expiry']))
+        now = time.time()
+
+        rows = []
+        for f, etag, storage_class, restore_status, last_modified, size_bytes, restore_expiry in columns:
+            bucket, key = glrestore.s3_utils.get_bucket_key(f)
+            rows.append((bucket, key, etag, storage_class, restore_status, last_modified, int(size_bytes),
+                         restore_expiry, None if sole is None else int(f in sole), now))
+
+        with self.lock:
+            before = dict(((r[0], r[1]), r[2:4]) for r in self._existing(rows))
+            for r in rows:
+                old = before.get((r[0], r[1]))
+                if (old is not None) and ((old[0] != r[2]) or (old[1] != r[5])):
+                    self.stale += 1
+
+            self.conn.executemany("""INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, key) DO UPDATE SET etag = excluded.etag, storage_class = excluded.storage_class,
+                restore_status = excluded.restore_status, last_modified = excluded.last_modified,
+                size_bytes = excluded.size_bytes, restore_expiry = excluded.restore_expiry,
+                sole_match = COALESCE(excluded.sole_match, objects.sole_match), checked = excluded.checked""", rows)
+            self.conn.commit()
+            self.writes += len(rows)
+
+    def _existing(self, rows):
+        """
+        Return (bucket, key, etag, last_modified) for the rows that are already in the cache
+        """
+        existing = []
+        for i in range(0, len(rows), 500):
+            chunk = rows[i:i + 500]
+            for bucket in set(r[0] for r in chunk):
+                keys = [r[1] for r in chunk if r[0] == bucket]
+                cursor = self.conn.execute(
+                    f"SELECT bucket, key, etag, last_modified FROM objects WHERE bucket = ? AND key IN ({','.join('?' * len(keys))})",
+                    [bucket] + keys)
+                existing.extend(cursor.fetchall())
+        return existing
+
+    def get_copy(self, f, destination):
+        """
+        Return (etag, storage_class, status, error) of the last copy of f to destination, or None
+        """
+        bucket, key = glrestore.s3_utils.get_bucket_key(f)
+        with self.lock:
+            return self.conn.execute("SELECT etag, storage_class, status, error FROM copies WHERE bucket = ? AND key = ? AND destination = ?",
+                                     (bucket, key, destination)).fetchone()
+
+    def record_copy(self, f, destination, etag, storage_class, status, error=None):
+        """
+        Record the status of the copy of f to destination ("copying", "copied" or "failed")
+
+        An object copied over itself isn't archived anymore, so its cached status is dropped
+        """
+        bucket, key = glrestore.s3_utils.get_bucket_key(f)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO copies VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                              (bucket, key, destination, etag, storage_class, status, error, time.time()))
+            if (status == 'copied') and (destination == f):
+                self.conn.execute("DELETE FROM objects WHERE bucket = ? AND key = ?", (bucket, key))
+            self.conn.commit()
+
+    def log_stats(self):
+        """
+        Print how useful the cache was
+        """
+        logging.info(f"Status cache ({self.location}): {self.hits} hits, {self.misses} misses, {self.stale} stale entries replaced, {self.writes} entries written")
+
+    def close(self):
+        """
+        Close the underlying database
+        """
+        with self.lock:
+            self.conn.close()
+
+def _to_epoch(col):
+    """
+    Turn a datetime64 column into a list of epoch seconds (None for NaT)
+    """
+    epoch = (col - pd.Timestamp('1970-01-01')) / pd.Timedelta(seconds=1)
+    return [None if pd.isna(e) else float(e) for e in epoch]
@@ -0,0 +1,197 @@
+"""
+Copy restored objects to a storage class that isn't archived (--copy-to-class), in place or to --copy-to, as soon
+as each one is restored
+
+Objects up to part_size are copied with one CopyObject; bigger ones (and everything over CopyObject's 5GB limit) are
+copied server-side in parts with UploadPartCopy, the parts of every object sharing one pool of threads. How each
+copy went is recorded in the status cache, so a rerun skips what's already copied
+"""
+
+import math
+import logging
+import threading
+
+from botocore.exceptions import ClientError
+
+import glrestore.metrics
+import glrestore.s3_utils
+import glrestore.download
+
+# Storage classes restored objects can be copied to
+COPY_STORAGE_CLASSES = ['STANDARD', 'INTELLIGENT_TIERING', 'STANDARD_IA', 'ONEZONE_IA', 'GLACIER_IR']
+
+# S3's limits on copies: CopyObject and each copied part are at most 5GB, parts are at least 5MB (bar the last),
+# and an upload has at most 10,000 parts
+MAX_COPY_BYTES = 5 * 1024 ** 3
+MIN_PART_BYTES = 5 * 1024 ** 2
+MAX_PARTS = 10000
+
+# Headers that CreateMultipartUpload needs to be given again, since (unlike CopyObject) it doesn't copy them. Tags
+# are copied separately once the upload is complete
+COPIED_HEADERS = ['ContentType', 'ContentEncoding', 'ContentDisposition', 'ContentLanguage', 'CacheControl',
+                  'Metadata']
+
+def copyable_mask(cdb):
+    """
+    Return a mask of the rows of the object table that can be copied right now (archived and restored)
+    """
+    archived = cdb['storage_class'].isin(glrestore.s3_utils.ARCHIVE_STORAGE_CLASSES)
+    return archived & (cdb['restore_status'] == 'restored')
+
+def destination(f, copy_to=None):
+    """
+    Return where f is copied to: itself, or its key under the s3:// location copy_to
+    """
+    if copy_to is None:
+        return f
+    bucket, key = glrestore.s3_utils.get_bucket_key(f)
+    return copy_to + key if copy_to.endswith('/') else copy_to + '/' + key
+
+def part_ranges(size, part_size):
+    """
+    Return the (first byte, last byte) of each part to copy size bytes in, growing parts to stay within MAX_PARTS
+    """
+    part_size = max(part_size, math.ceil(size / MAX_PARTS))
+    return [(start, min(size, start + part_size) - 1) for start in range(0, size, part_size)]
+
+class Copier(glrestore.download.TransferPool):
+    """
+    Copies objects to storage_class (in place, or under copy_to) with up to "threads" copy requests at once;
+    close() waits for everything submitted to be copied
+    """
+    def __init__(self, storage_class, copy_to=None, threads=16, part_size=1024 ** 3, status_cache=None, **kwargs):
+        super().__init__(threads=threads, **kwargs)
+        if not (MIN_PART_BYTES <= part_size <= MAX_COPY_BYTES):
+            raise Exception(f"The copy part size has to be between {MIN_PART_BYTES // 1024 ** 2}MB and {MAX_COPY_BYTES // 1024 ** 2}MB")
+        self.storage_class = storage_class
+        self.copy_to = copy_to
+        self.part_size = part_size
+        self.status_cache = status_cache
+
+        self.copied = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def record(self, f, dest, etag, status, error=None):
+        if self.status_cache is not None:
+            self.status_cache.record_copy(f, dest, etag, self.storage_class, status, error)
+
+    def call(self, func, **kwargs):
+        return glrestore.s3_utils.call_with_backoff(func, retries=self.retries, **kwargs)
+
+    def start(self, f):
+        """
+        Copy the object in one go, or start a multipart copy and queue its parts
+        """
+        dest = destination(f, self.copy_to)
+        etag = None
+        try:
+            bucket, key = glrestore.s3_utils.get_bucket_key(f)
+            dbucket, dkey = glrestore.s3_utils.get_bucket_key(dest)
+            client = glrestore.s3_utils.get_client_for_bucket(dbucket, **self.kwargs)
+            head = self.call(glrestore.s3_utils.get_client_for_bucket(bucket, **self.kwargs).head_object, Bucket=bucket, Key=key)
+            etag = head.get('ETag')
+
+            if self.status_cache is not None:
+                last = self.status_cache.get_copy(f, dest)
+                if (last is not None) and (last[0] == etag) and (last[1] == self.storage_class) and (last[2] == 'copied'):
+                    with self.lock:
+                        self.skipped += 1
+                    return
+
+            self.record(f, dest, etag, 'copying')
+            source = {'Bucket': bucket, 'Key': key}
+            size = head['ContentLength']
+            if size <= self.part_size:
+                self.call(client.copy_object, CopySource=source, CopySourceIfMatch=etag, Bucket=dbucket, Key=dkey,
+                          StorageClass=self.storage_class, MetadataDirective='COPY', TaggingDirective='COPY')
+                self.finish(f, dest, etag, size)
+                return
+
+            headers = dict((h, head[h]) for h in COPIED_HEADERS if head.get(h) is not None)
+            tags = self.call(glrestore.s3_utils.get_client_for_bucket(bucket, **self.kwargs).get_object_tagging,
+                             Bucket=bucket, Key=key).get('TagSet', [])
+            upload = self.call(client.create_multipart_upload, Bucket=dbucket, Key=dkey,
+                               StorageClass=self.storage_class, **headers)
+            job = MultipartCopy(f, dest, etag, upload['UploadId'], part_ranges(size, self.part_size), tags)
+            for i in range(len(job.ranges)):
+                self._run(self.copy_part, job, i)
+        except Exception as e:
+            self.fail(f, e)
+            self.record(f, dest, etag, 'failed', str(e))
+
+    def copy_part(self, job, i):
+        """
+        Copy part i of a multipart copy, completing the upload after its last part (or aborting it on a failure)
+        """
+        if job.error is not None:
+            return
+        bucket, key = glrestore.s3_utils.get_bucket_key(job.f)
+        dbucket, dkey = glrestore.s3_utils.get_bucket_key(job.dest)
+        client = glrestore.s3_utils.get_client_for_bucket(dbucket, **self.kwargs)
+        start, end = job.ranges[i]
+        try:
+            response = self.call(client.upload_part_copy, CopySource={'Bucket': bucket, 'Key': key},
+                                 CopySourceRange=f"bytes={start}-{end}", CopySourceIfMatch=job.etag,
+                                 Bucket=dbucket, Key=dkey, UploadId=job.upload_id, PartNumber=i + 1)
+            glrestore.metrics.tick('bytes_copied', end - start + 1)
+            if not job.part_done(i, response['CopyPartResult']['ETag']):
+                return
+            self.call(client.complete_multipart_upload, Bucket=dbucket, Key=dkey, UploadId=job.upload_id,
+                      MultipartUpload={'Parts': [{'ETag': job.etags[n], 'PartNumber': n + 1} for n in range(len(job.ranges))]})
+            if len(job.tags) > 0:
+                self.call(client.put_object_tagging, Bucket=dbucket, Key=dkey, Tagging={'TagSet': job.tags})
+            self.finish(job.f, job.dest, job.etag, job.ranges[-1][1] + 1)
+        except Exception as e:
+            with job.lock:
+                first = job.error is None
+                job.error = e
+            if not first:
+                return
+            self.fail(job.f, e)
+            self.record(job.f, job.dest, job.etag, 'failed', str(e))
+            try:
+                client.abort_multipart_upload(Bucket=dbucket, Key=dkey, UploadId=job.upload_id)
+            except ClientError as abort_error:
+                logging.debug(f"Couldn't abort the copy of {job.f}: {abort_error}")
+
+    def finish(self, f, dest, etag, size):
+        self.record(f, dest, etag, 'copied')
+        glrestore.metrics.tick('objects_copied')
+        with self.lock:
+            self.copied += 1
+            self.bytes += size
+        logging.debug(f"Copied {f} to {dest} as {self.storage_class}")
+
+    def close(self):
+        """
+        Wait for everything submitted to be copied, then say how it went
+        """
+        self.wait()
+        logging.info(f"Copied {self.copied} objects ({self.bytes / 1e9:.2f}GB) to {self.storage_class}; {self.skipped} were already copied and {len(self.failed)} failed")
+        if len(self.failed) > 0:
+            logging.error(f"{len(self.failed)} copies failed (for example {self.failed[0][0]}: {self.failed[0][1]}). Re-run with the same --copy-to-class to retry them")
+
+class MultipartCopy(object):
+    """
+    The state of one multipart copy: its upload, its parts' ranges, the ETags of the parts that are done and the
+    source's tags
+    """
+    def __init__(self, f, dest, etag, upload_id, ranges, tags=None):
+        self.f = f
+        self.dest = dest
+        self.etag = etag
+        self.upload_id = upload_id
+        self.ranges = ranges
+        self.tags = tags or []
+        self.etags = {}
+        self.error = None
+        self.lock = threading.Lock()
+
+    def part_done(self, i, etag):
+        """
+        Record part i's ETag; return True if that was the last part
+        """
+        with self.lock:
+            self.etags[i] = etag
+            return len(self.etags) == len(self.ranges)
@@ -0,0 +1,276 @@
+"""
+Download objects as soon as they're available (--download), while the rest are still being restored
+
+Objects are fetched in ranged GETs of part_size bytes by one pool of threads shared by every object, so the
+concurrency and byte rate (--download-threads, --download-rate) are budgets for the whole download. Parts are
+streamed straight into place in a .part file, and each finished part is recorded next to it, so an interrupted
+download picks up with only the parts it's missing
+"""
+
+import os
+import time
+import logging
+import threading
+import concurrent.futures
+
+from botocore.exceptions import ClientError
+
+import glrestore.metrics
+import glrestore.s3_utils
+
+# Bytes read from a response body at a time
+CHUNK_SIZE = 1024 * 1024
+
+def available_mask(cdb):
+    """
+    Return a mask of the rows of the object table that can be downloaded right now (not archived, or restored)
+    """
+    archived = cdb['storage_class'].isin(glrestore.s3_utils.ARCHIVE_STORAGE_CLASSES)
+    return (~archived) | (cdb['restore_status'] == 'restored')
+
+def local_path(dest, f):
+    """
+    Return where s3 location f is downloaded to under dest (dest/bucket/key), refusing keys that would escape dest
+    """
+    bucket, key = glrestore.s3_utils.get_bucket_key(f)
+    root = os.path.abspath(dest)
+    path = os.path.abspath(os.path.join(root, bucket, *key.split('/')))
+    if not path.startswith(root + os.sep):
+        raise Exception(f"Not downloading {f}; its key would be written outside of {dest}")
+    return path
+
+class RateLimiter(object):
+    """
+    Token bucket shared by every download thread; consume(n) blocks until n more bytes are allowed
+    """
+    def __init__(self, bytes_per_second, clock=time.monotonic, sleep=time.sleep):
+        self.rate = bytes_per_second
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.tokens = bytes_per_second
+        self.last = clock()
+
+    def consume(self, n):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate) - n
+            self.last = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            self.sleep(wait)
+
+class ObjectDownload(object):
+    """
+    The state of one object's download: its parts, which of them are done, and where they go
+    """
+    def __init__(self, f, path, size, etag, part_size):
+        self.f = f
+        self.path = path
+        self.part_path = path + '.part'
+        self.record_path = path + '.part.done'
+        self.size = size
+        self.etag = etag
+        self.parts = [(start, min(size, start + part_size) - 1) for start in range(0, size, part_size)]
+        self.done = set()
+        self.left = 0
+        self.error = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Pick up the parts an earlier, interrupted download finished (if it was of the same version of the object)
+        """
+        if os.path.exists(self.part_path) and os.path.exists(self.record_path):
+            with open(self.record_path) as r:
+                lines = r.read().split('\n')
+            if lines[0] == self.etag:
+                self.done = set(int(l) for l in lines[1:-1])
+        if len(self.done) == 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.part_path, 'wb') as o:
+                o.truncate(self.size)
+            with open(self.record_path, 'w') as o:
+                o.write(self.etag + '\n')
+        self.left = len(self.parts) - len(self.done)
+
+    def part_done(self, i):
+        """
+        Record that part i is on disk; return True if that was the last part
+        """
+        with self.lock:
+            with open(self.record_path, 'a') as o:
+                o.write(f"{i}\n")
+                o.flush()
+                os.fsync(o.fileno())
+            self.done.add(i)
+            self.left -= 1
+            return self.left == 0
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        os.remove(self.record_path)
+
+class TransferPool(object):
+    """
+    A pool of "threads" threads that objects are handed to as they become available, where each object's work can
+    queue more tasks (its parts) on the same pool. Subclasses do the work in start(f)
+
+    submit() can be called at any time (for example as objects finish restoring); wait() returns once everything
+    submitted (and everything that queued) is done
+    """
+    def __init__(self, threads=16, **kwargs):
+        self.threads = threads
+        self.retries = kwargs.get('retries', 8)
+        self.kwargs = dict(kwargs, threads=threads)
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.submitted = set()
+        self.failed = []
+
+    def submit(self, files):
+        """
+        Start on files (each object is only handled once, however often it's submitted)
+        """
+        for f in files:
+            with self.lock:
+                if f in self.submitted:
+                    continue
+                self.submitted.add(f)
+            self._run(self.start, f)
+
+    def _run(self, func, *args):
+        with self.lock:
+            self.pending += 1
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(self._task_done)
+
+    def _task_done(self, future):
+        with self.lock:
+            self.pending -= 1
+            if self.pending == 0:
+                self.idle.notify_all()
+
+    def start(self, f):
+        raise NotImplementedError
+
+    def fail(self, f, e):
+        logging.debug(f"{type(self).__name__} failed on {f}: {e}")
+        with self.lock:
+            self.failed.append((f, str(e)))
+
+    def wait(self):
+        """
+        Wait for everything submitted to be done, then stop the threads
+        """
+        with self.lock:
+            while self.pending > 0:
+                self.idle.wait()
+        self.executor.shutdown()
+
+    def abort(self):
+        """
+        Drop work that hasn't started
+        """
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+class Downloader(TransferPool):
+    """
+    Downloads objects to dest with up to "threads" ranged GETs at once and at most max_bytes_per_second overall;
+    close() waits for everything submitted to be downloaded
+    """
+    def __init__(self, dest, threads=16, part_size=16 * 1024 * 1024, max_bytes_per_second=None, **kwargs):
+        super().__init__(threads=threads, **kwargs)
+        self.dest = dest
+        self.part_size = part_size
+        self.limiter = RateLimiter(max_bytes_per_second) if max_bytes_per_second else None
+
+        self.downloaded = 0
+        self.skipped = 0
+        self.bytes = 0
+
+    def start(self, f):
+        """
+        Look the object up and queue its missing parts
+        """
+        try:
+            if f.endswith('/'):
+                return
+            path = local_path(self.dest, f)
+            bucket, key = glrestore.s3_utils.get_bucket_key(f)
+            client = glrestore.s3_utils.get_client_for_bucket(bucket, **self.kwargs)
+            head = glrestore.s3_utils.call_with_backoff(client.head_object, retries=self.retries, Bucket=bucket, Key=key)
+            size = head['ContentLength']
+
+            if os.path.exists(path) and os.path.getsize(path) == size:
+                with self.lock:
+                    self.skipped += 1
+                return
+
+            obj = ObjectDownload(f, path, size, head.get('ETag', ''), self.part_size)
+            obj.load()
+            if obj.left == 0:
+                self.finish(obj)
+                return
+            for i in range(len(obj.parts)):
+                if i not in obj.done:
+                    self._run(self.fetch_part, obj, i)
+        except Exception as e:
+            self.fail(f, e)
+
+    def fetch_part(self, obj, i):
+        """
+        Stream part i of obj into place, retrying it from the start if the connection drops
+        """
+        if obj.error is not None:
+            return
+        start, end = obj.parts[i]
+        bucket, key = glrestore.s3_utils.get_bucket_key(obj.f)
+        client = glrestore.s3_utils.get_client_for_bucket(bucket, **self.kwargs)
+
+        attempt = 0
+        while True:
+            try:
+                response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=obj.etag)
+                with open(obj.part_path, 'r+b') as o:
+                    o.seek(start)
+                    for chunk in response['Body'].iter_chunks(CHUNK_SIZE):
+                        if self.limiter is not None:
+                            self.limiter.consume(len(chunk))
+                        o.write(chunk)
+                        glrestore.metrics.tick('bytes_downloaded', len(chunk))
+                    o.flush()
+                    os.fsync(o.fileno())
+                break
+            except Exception as e:
+                if (attempt >= self.retries) or (isinstance(e, ClientError) and not glrestore.s3_utils.is_retryable_error(e)):
+                    obj.error = e
+                    self.fail(obj.f, e)
+                    return
+                glrestore.metrics.count_retry('GetObject')
+                time.sleep(glrestore.s3_utils.backoff_delay(attempt))
+                attempt += 1
+
+        with self.lock:
+            self.bytes += end - start + 1
+        if obj.part_done(i):
+            self.finish(obj)
+
+    def finish(self, obj):
+        obj.finish()
+        glrestore.metrics.tick('objects_downloaded')
+        with self.lock:
+            self.downloaded += 1
+        logging.debug(f"Downloaded {obj.f} to {obj.path}")
+
+    def close(self):
+        """
+        Wait for everything submitted to be downloaded, then say how it went
+        """
+        self.wait()
+        logging.info(f"Downloaded {self.downloaded} objects ({self.bytes / 1e9:.2f}GB) to {self.dest}; {self.skipped} were already there and {len(self.failed)} failed")
+        if len(self.failed) > 0:
+            logging.error(f"{len(self.failed)} downloads failed (for example {self.failed[0][0]}: {self.failed[0][1]}). Re-run with the same --download to pick them up where they stopped")
@@ -10,20 +10,43 @@ __license__ = "MIT"
 
 import os
 import sys
-import boto3
 import time
 import copy
 import argparse
 import logging
-import awswrangler
-from time import sleep
+import importlib
+import itertools
 
-import pandas as pd
-import glrestore.s3_utils
+from collections import defaultdict
+
+import glrestore
+import glrestore.waves
+import glrestore.metrics
+
+# These pull in boto3 and pandas, so they're only imported once there's work to do (see load_modules). That
+# keeps argument parsing, -h and --version fast
+CONTROLLER_MODULES = ['glrestore.s3_utils', 'glrestore.cache', 'glrestore.manifests', 'glrestore.polling',
+                      'glrestore.notifications', 'glrestore.sharding', 'glrestore.batch_ops', 'glrestore.planner',
+                      'glrestore.reports', 'glrestore.journal', 'glrestore.download', 'glrestore.copier']
+
+# --stream classifies the -f entries this many at a time, so a huge manifest is never held in memory
+STREAM_CHUNK_SIZE = 100000
+
+def load_modules():
+    """
+    Import the modules RestoreController needs
+    """
+    for name in CONTROLLER_MODULES:
+        importlib.import_module(name)
 
 def main():
     """ This is executed when run from the command line """
     args = parse_args()
+
+    # Clients of a --serve service don't need boto3 or pandas
+    if args.connect is not None:
+        import glrestore.service
+        sys.exit(glrestore.service.run_client(args))
     RestoreController(args).main()
 
 class RestoreController(object):
@@ -34,38 +57,171 @@ class RestoreController(object):
         """
         Initialize and store args
         """
+        load_modules()
+
         self.args = args
         self.ori_args = copy.deepcopy(args)
         self.kwargs = vars(self.args)
 
+        # What this run did, for the process running it as part of a sharded restore
+        self.totals = None
+        self.restore_counts = defaultdict(int)
+        self.report_loc = None
+        self.num_failed = 0
+        self.shard = None
+
+        # The -f entries (only kept when --deadline / --budget rank objects by them), and the tier chosen for each
+        # object
+        self.s3_locs = []
+        self.restore_plan = None
+
+        # The --journal being written, and what it already said for --resume
+        self.journal = None
+        self.journal_state = None
+        self.resume_groups = None
+
+        # Downloads (--download) and copies (--copy-to-class) of objects as they become available, and the objects
+        # that were already restoring when this run started (so they're waited on and handled too)
+        self.downloader = None
+        self.copier = None
+        self.files_to_transfer_later = []
+
+        # Objects already waited on by --wave-bytes / --wave-objects waves, and the sizes the waves were made from
+        self.files_already_waited_on = set()
+        self.wave_sizes = None
+
+        # The HTTP server of --serve, while it's running
+        self.server = None
+
+        # Where the time went (see --metrics-out)
+        self.metrics = glrestore.metrics.RunMetrics(progress_interval=self.kwargs.get('progress_interval', 30))
+
     def main(self):
         """
-        The main controller for restore
+        The main controller for restore; records metrics while it runs and writes them to --metrics-out at the end
+        """
+        glrestore.metrics.activate(self.metrics)
+        try:
+            self.run()
+        finally:
+            glrestore.metrics.activate(None)
+            self.metrics.stop_progress()
+            for pool in self.transfers():
+                pool.abort()
+            if self.journal is not None:
+                self.journal.close()
+            if self.kwargs.get('metrics_out') is not None:
+                self.metrics.write(self.kwargs.get('metrics_out'))
+
+    def run(self):
         """
-        self.parse_arguments()
+        Run each phase of the restore
+        """
+        with self.metrics.phase('setup'):
+            self.parse_arguments()
+
+        if len(self.kwargs.get('merge_reports') or []) > 0:
+            logging.debug("Merge shard reports")
+            with self.metrics.phase('merge_reports'):
+                self.merge_reports(self.kwargs.get('merge_reports'))
+            return
+
+        if self.kwargs.get('serve', False):
+            logging.debug("Serve restores to other glrestore processes")
+            with self.metrics.phase('serve'):
+                self.serve()
+            return
+
+        if (self.kwargs.get('processes') or 1) > 1:
+            logging.debug("Run shards in local processes")
+            with self.metrics.phase('shards'):
+                self.run_local_shards()
+            return
+
+        if (self.journal_state is not None) and self.journal_state.complete:
+            logging.debug("Resume the restore in the journal")
+            with self.metrics.phase('restore', counter='restores_finished', label='Restoring', unit='restore requests'):
+                self.resume_restore()
+
+            if self.kwargs.get('wait'):
+                with self.metrics.phase('wait', counter='objects_restored', label='Waiting', total=len(self.files_to_restore_filtered)):
+                    self.wait_for_restore()
+            return
+
+        if self.kwargs.get('stream', False) and self.kwargs.get('batch_ops', False):
+            logging.warning("--stream doesn't apply to --batch-ops; the manifest is made from the full object table")
+
+        if self.kwargs.get('stream', False) and self.planning():
+            logging.warning("--deadline and --budget need every object's size up front, so --stream is ignored")
+
+        if self.kwargs.get('stream', False) and self.waving() and not self.kwargs.get('report', False):
+            logging.warning("--wave-bytes and --wave-objects need every object up front, so --stream is ignored")
+
+        if self.kwargs.get('batch_ops', False) and self.waving():
+            logging.warning("--wave-bytes and --wave-objects don't apply to --batch-ops; everything goes in one job")
+
+        if self.kwargs.get('stream', False) and self.kwargs.get('report', False) and not self.from_report():
+            logging.debug("Write the report as objects are classified")
+            with self.metrics.phase('classify', counter='objects_classified', label='Classifying'):
+                self.stream_report()
+
+            if self.kwargs.get('wait'):
+                with self.metrics.phase('wait', counter='objects_restored', label='Waiting', total=len(self.files_to_restore_filtered)):
+                    self.wait_for_restore()
+            self.log_cache_stats()
+            return
+
+        if self.kwargs.get('stream', False) and not self.kwargs.get('report', False) and not self.kwargs.get('batch_ops', False) \
+                and not self.planning() and not self.waving() and not self.from_report():
+            logging.debug("Stream objects straight from classification to restoring")
+            with self.metrics.phase('stream', counter='restores_finished', label='Restoring', unit='restore requests'):
+                self.stream_restore()
+
+            if self.kwargs.get('wait'):
+                with self.metrics.phase('wait', counter='objects_restored', label='Waiting', total=len(self.files_to_restore_filtered)):
+                    self.wait_for_restore()
+            self.log_cache_stats()
+            return
 
         logging.debug("Get objects to restore")
-        self.file_classifications = self.get_files_to_restore_v2(self.kwargs.get('files'))
+        with self.metrics.phase('classify', counter='objects_classified', label='Classifying'):
+            self.file_classifications = self.get_files_to_restore_v2(self.kwargs.get('files'))
 
         if self.kwargs.get('report', True):
             logging.info("\n!!!!!!!!!!!\nWill NOT RESTORE anything because of --report flag; the following information is FYI only\n!!!!!!!!!!!!")
 
             logging.debug("Print status")
-            self.print_status(sleep=False)
+            with self.metrics.phase('status'):
+                self.print_status(sleep=False)
 
             logging.debug("Create report")
-            self.create_report()
+            with self.metrics.phase('report'):
+                self.create_report()
 
         else:
             logging.debug("Print status")
-            self.print_status()
+            with self.metrics.phase('status'):
+                self.print_status(sleep=not self.kwargs.get('shard_worker', False))
+
+            if len(self.transfers()) > 0:
+                self.start_transfers(self.file_classifications)
 
-            logging.debug("Restoring files")
-            self.restore_files()
+            if self.kwargs.get('batch_ops', False):
+                logging.debug("Restoring files with S3 Batch Operations")
+                with self.metrics.phase('restore', counter='restores_finished', label='Restoring', unit='restore requests',
+                                        total=len(self.files_to_restore_filtered)):
+                    self.batch_restore()
+            else:
+                logging.debug("Restoring files")
+                with self.metrics.phase('restore', counter='restores_finished', label='Restoring', unit='restore requests',
+                                        total=len(self.files_to_restore_filtered)):
+                    self.restore_files()
 
         if self.kwargs.get('wait'):
-            self.wait_for_restore()
+            with self.metrics.phase('wait', counter='objects_restored', label='Waiting', total=len(self.files_to_restore_filtered)):
+                self.wait_for_restore()
 
+        self.log_cache_stats()
 
     def parse_arguments(self):
         """
@@ -76,122 +232,439 @@ class RestoreController(object):
         # Set up the log
         self.setup_log()
 
-        # Set up boto3
-        if 'profile' in args:
-            boto3.setup_default_session(profile_name=args.get('profile'))
-        else:
-            session = boto3.session.Session()
-            self.kwargs.client = session.client("s3")
+        # Set up boto3; clients are pooled by profile and region and shared by every request
+        glrestore.s3_utils.get_boto3_client(**args)
+
+        # Fail early if the asyncio engine can't be used
+        if args.get('engine') == 'asyncio':
+            importlib.import_module('glrestore.async_utils').require_aiobotocore()
+
+        # Check the shard early
+        if args.get('shard') is not None:
+            self.shard = glrestore.sharding.parse_shard(args.get('shard'))
+            logging.info(f"Running shard {self.shard[0]} of {self.shard[1]} (0-based), split by {args.get('shard_by')}")
+
+        # Batch Operations can't do Expedited restores; say so before anything is classified
+        if args.get('batch_ops', False) and not self.planning() and (args.get('speed') not in glrestore.batch_ops.SPEED2BATCH_TIER):
+            raise Exception(f"S3 Batch Operations can only restore at {' or '.join(glrestore.batch_ops.SPEED2BATCH_TIER)} speed, not {args.get('speed')}; pass --speed Standard or --speed Bulk with --batch-ops")
+
+        # Fail early if Parquet reports can't be read or written
+        if (args.get('report_format') == 'parquet') or \
+                any(glrestore.reports.report_format(loc) == 'parquet' for loc in (args.get('from_report') or [])):
+            glrestore.reports.require_pyarrow()
+
+        if self.from_report() and len(args.get('files') or []) > 0:
+            logging.warning("-f is ignored with --from-report; the objects come from the report")
+
+        # Open the journal, reading what's already in it for --resume
+        if args.get('resume', False) and args.get('journal') is None:
+            raise Exception("--resume needs the --journal of the restore to carry on")
+        if (args.get('journal') is not None) and not args.get('report', False) and ((args.get('processes') or 1) <= 1):
+            self.open_journal(args.get('journal'), resume=args.get('resume', False))
+
+        # Downloading means waiting for everything to be restored
+        if (args.get('download') is not None) and args.get('report', False):
+            logging.warning("--download is ignored with --report")
+        elif (args.get('download') is not None) and ((args.get('processes') or 1) <= 1):
+            args['wait'] = True
+            rate = args.get('download_rate')
+            self.downloader = glrestore.download.Downloader(args.get('download'), **dict(args,
+                threads=args.get('download_threads', 16),
+                part_size=int(args.get('download_part_size', 16) * 1024 * 1024),
+                max_bytes_per_second=rate * 1e6 if rate else None))
+
+        # Set up the status cache
+        if not args.get('no_cache', False):
+            cache_loc = args.get('cache') or glrestore.cache.default_cache_location()
+            self.kwargs['status_cache'] = glrestore.cache.StatusCache(cache_loc, max_age=args.get('cache_max_age', 24) * 3600)
+
+        # Copying restored objects also means waiting for everything to be restored
+        if (args.get('copy_to') is not None) and (args.get('copy_to_class') is None):
+            raise Exception("--copy-to needs --copy-to-class")
+        if (args.get('copy_to_class') is not None) and args.get('report', False):
+            logging.warning("--copy-to-class is ignored with --report")
+        elif (args.get('copy_to_class') is not None) and ((args.get('processes') or 1) <= 1):
+            if args.get('no_cache', False):
+                logging.warning("With --no-cache, copies aren't recorded, so a rerun copies everything again")
+            args['wait'] = True
+            self.copier = glrestore.copier.Copier(args.get('copy_to_class'), **dict(args,
+                threads=args.get('copy_threads', 16),
+                part_size=int(args.get('copy_part_size', 1024) * 1024 * 1024)))
+
+    def serve(self):
+        """
+        Run the restore service (--serve) until interrupted
+        """
+        import glrestore.service
+
+        service = glrestore.service.RestoreService(self.classify, **dict(self.kwargs,
+                                                   poll_interval=self.kwargs.get('poll_interval') or 300)).start()
+        socket_loc = None
+        if self.kwargs.get('port') is None:
+            socket_loc = self.kwargs.get('socket') or glrestore.service.default_socket_location()
+        server = glrestore.service.make_server(service, socket_loc=socket_loc, port=self.kwargs.get('port'))
+        self.server = server
+
+        logging.info(f"Serving restores on {socket_loc or 'http://127.0.0.1:' + str(server.server_address[1])}; connect with glrestore --connect")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logging.info("Stopping the service")
+        finally:
+            service.stop()
+            server.server_close()
+            if (socket_loc is not None) and os.path.exists(socket_loc):
+                os.remove(socket_loc)
+            logging.info(f"The service handled {service.get_stats()}")
+
+    def open_journal(self, loc, resume=False):
+        """
+        Start writing the --journal at loc; with resume, read it first and add to it
+        """
+        if resume and os.path.exists(loc):
+            start = time.time()
+            self.journal_state = glrestore.journal.replay(loc)
+            logging.info(f"Read {self.journal_state.lines} journal entries from {loc} in {time.time() - start:.1f}s")
+            if not self.journal_state.complete:
+                logging.info("The journal doesn't have the full list of objects to restore, so -f will be classified again (objects that are already restoring are skipped as usual)")
+        elif resume:
+            logging.warning(f"There is no journal at {loc} to resume from; starting from the beginning")
+        self.journal = glrestore.journal.RestoreJournal(loc, append=resume)
+
+    def resume_restore(self):
+        """
+        Restore the objects in the journal that don't have an outcome yet, without classifying anything
+        """
+        state = self.journal_state
+        self.resume_groups = state.remaining()
+        remaining = sum(len(files) for tier, files in self.resume_groups)
+        logging.info(f"Resuming from {self.journal.loc}: {len(state.queued) - remaining} of {len(state.queued)} objects already have restore requests; restoring the other {remaining}")
+
+        # --wait waits on everything, including restores that were started before the interruption
+        self.files_to_restore_filtered = list(state.queued)
+        self.restore_files()
 
     def get_files_to_restore_v2(self, files):
         """
         Return a list of s3 files to restore
         """
-        # Get the command line argument
-        base_restore = files
-
-        # Load files if need be
-        to_restore = []
-        for br in base_restore:
-            if not br.startswith('s3://'):
-                with open(br, 'r') as r:
-                    for line in r.readlines():
-                        if not line.startswith('s3://'):
-                            logging.error(f"CRITICAL ERROR! You passed {br} to -f, which doesn't start with s3://. I assumed this was a file of files to restore, but the line {line} also doesn't start with s3://. Will ignore {br} and {line}")
-                        else:
-                            to_restore.append(line.strip())
-            else:
-                to_restore.append(br)
+        # A previous --report already classified everything
+        if self.from_report():
+            cdb = glrestore.sharding.read_reports(self.kwargs.get('from_report'))
+            logging.info(f"Read {len(cdb)} objects from {', '.join(self.kwargs.get('from_report'))}; they will not be checked again")
+            if self.planning():
+                self.s3_locs = cdb['file'].tolist()
+            return self.shard_table(cdb)
+
+        # The whole object table is built here anyway, so the entries are read in full
+        to_restore, owned = self.hash_s3_locs(self.shard_s3_locs(list(self.load_s3_locs(files))))
+        if self.planning():
+            self.s3_locs = to_restore
+
+        # Duplicate and overlapping entries are collapsed, and everything is classified in one batched pass
+        fc = self.shard_table(self.classify(to_restore, exact=False), owned)
+        return fc
+
+    def from_report(self):
+        """
+        Return True if the object table comes from --from-report rather than classifying -f
+        """
+        return len(self.kwargs.get('from_report') or []) > 0
 
-        dbs = []
-        for br in to_restore:
-            db = glrestore.s3_utils.get_object_storage_class_v2(br)
-            dbs.append(db)
+    def shard_s3_locs(self, s3_locs):
+        """
+        Return the -f entries this process is responsible for (all of them unless --shard-by prefix)
+        """
+        if (self.shard is None) or (self.kwargs.get('shard_by') != 'prefix'):
+            return s3_locs
+        return glrestore.sharding.shard_s3_locs(s3_locs, *self.shard)
 
-        fc = pd.concat(dbs).reset_index(drop=True)
-        return fc
+    def hashing(self):
+        """
+        Return True if this process is one shard of a --shard-by hash split
+        """
+        return (self.shard is not None) and (self.kwargs.get('shard_by') == 'hash')
 
-    def print_status(self, sleep=True):
+    def hash_s3_locs(self, s3_locs):
         """
-        Print status and estimated costs
+        Return the -f entries this process looks up, and the ones it owns outright (see sharding.hash_s3_locs);
+        with --shard-by hash, entries naming other shards' objects aren't looked up at all
         """
-        debug = self.kwargs.get('debug', False)
+        if not self.hashing():
+            return s3_locs, None
+        return glrestore.sharding.hash_s3_locs(s3_locs, *self.shard)
 
-        cdb = self.file_classifications
-        logging.info(f"Identified {len(cdb)} files")
+    def shard_table(self, cdb, owned=None):
+        """
+        Return the rows of the object table this process is responsible for (all of them unless --shard-by hash)
+        """
+        if not self.hashing():
+            return cdb
+        return cdb[glrestore.sharding.shard_mask(cdb, *self.shard, owned)].reset_index(drop=True)
 
-        tdb = cdb[cdb['restore_status'] != False]
-        logging.info(f"Of these, {len(tdb)} are being actively restored or are already restored")
+    def classify(self, s3_locs, exact=None):
+        """
+        Return the object table for s3_locs using the chosen --engine
+        """
+        if self.kwargs.get('engine') == 'asyncio':
+            import asyncio
+            async_utils = importlib.import_module('glrestore.async_utils')
+            return asyncio.run(async_utils.get_object_storage_class_async(s3_locs, exact=exact, **self.kwargs))
+        return glrestore.s3_utils.get_object_storage_class_v2(s3_locs, exact=exact, **self.kwargs)
 
-        tdb = cdb[~cdb['storage_class'].isin(['GLACIER', 'DEEP_ARCHIVE'])]
-        logging.info(f"Of these, {len(tdb)} are not in glacier")
+    def issue_restores(self, s3_locs, on_failed=None, speed=None):
+        """
+        Issue restore requests for s3_locs using the chosen --engine (at "speed", if given, instead of --speed);
+        returns (counts, failed)
+        """
+        kwargs = self.kwargs if speed is None else dict(self.kwargs, speed=speed)
+        on_finished = self.journal.record if self.journal is not None else None
+        if self.kwargs.get('engine') == 'asyncio':
+            import asyncio
+            async_utils = importlib.import_module('glrestore.async_utils')
+            return asyncio.run(async_utils.restore_files_async(s3_locs, on_failed=on_failed, on_finished=on_finished, **kwargs))
+        return glrestore.s3_utils.restore_files(s3_locs, on_failed=on_failed, on_finished=on_finished, **kwargs)
+
+    def load_s3_locs(self, files):
+        """
+        Return an iterable of the s3 locations (objects, prefixes and wildcards) passed to -f
+
+        Anything that isn't an s3 location is a manifest: a file of them (plain, gzip or zstd), "-" for stdin or
+        "@s3://bucket/key" for a manifest in S3. Manifests are streamed and duplicate entries dropped as they're read,
+        so nothing is held in memory until the caller does so
+        """
+        return glrestore.manifests.ManifestReader(files, **self.kwargs)
 
-        fcdb = cdb[(cdb['restore_status'] == False) & (cdb['storage_class'].isin(['GLACIER', 'DEEP_ARCHIVE']))]
-        logging.info(f"Restoring the remaining {len(fcdb)} objects will cost the following:")
+    def iter_s3_loc_chunks(self, files):
+        """
+        Yield the -f entries this process is responsible for in lists of up to STREAM_CHUNK_SIZE
 
-        self.display_restore_costs(fcdb, sleep=sleep)
+        --shard-by prefix splits the sorted, deduplicated entries, so it has to read them all first
+        """
+        s3_locs = iter(self.load_s3_locs(files))
+        if (self.shard is not None) and (self.kwargs.get('shard_by') == 'prefix'):
+            s3_locs = iter(self.shard_s3_locs(list(s3_locs)))
+        num = 0
+        while True:
+            chunk = list(itertools.islice(s3_locs, STREAM_CHUNK_SIZE))
+            if len(chunk) == 0:
+                break
+            num += len(chunk)
+            yield chunk
+        logging.debug(f"Read {num} s3 locations")
 
+    def print_status(self, sleep=True):
+        """
+        Print status and estimated costs
+        """
+        debug = self.kwargs.get('debug', False)
+
+        cdb = self.file_classifications
+        fcdb = cdb[glrestore.s3_utils.needs_restore(cdb)]
         self.files_to_restore_filtered = fcdb['file'].tolist()
 
+        if self.planning():
+            self.plan_restores(fcdb)
+
+        self.totals = StatusTotals.from_table(cdb)
+        self.log_status(self.totals, sleep=sleep)
+
         if debug:
             for f in fcdb['file'].tolist():
                 logging.debug(f)
 
+    def planning(self):
+        """
+        Return True if each object's tier is to be chosen by the planner (--deadline / --budget) rather than --speed
+        """
+        return (self.kwargs.get('deadline') is not None) or (self.kwargs.get('budget') is not None)
+
+    def plan_restores(self, fcdb):
+        """
+        Choose the tier of each object to restore for --deadline / --budget
+        """
+        # Batch Operations can't do Expedited restores
+        tiers = list(glrestore.batch_ops.SPEED2BATCH_TIER) if self.kwargs.get('batch_ops', False) else glrestore.planner.TIERS
+        order = glrestore.planner.priority_order(fcdb, self.s3_locs)
+        self.restore_plan = glrestore.planner.plan_restores(fcdb, deadline=self.kwargs.get('deadline'),
+                                                            budget=self.kwargs.get('budget'), days=self.kwargs.get('days'),
+                                                            tiers=tiers, order=order)
+
+    def plan_groups(self):
+        """
+        Return [(tier, files)] to restore, fastest tier first: the plan's tiers, or everything at --speed
+        """
+        if self.resume_groups is not None:
+            return self.resume_groups
+        if self.restore_plan is None:
+            return [(self.kwargs.get('speed'), self.files_to_restore_filtered)]
+        plan = self.restore_plan
+        return [(tier, plan.loc[plan['tier'] == tier, 'file'].tolist()) for tier in glrestore.planner.TIERS
+                if (plan['tier'] == tier).any()]
+
+    def log_status(self, totals, sleep=True):
+        """
+        Print the status and estimated costs from a StatusTotals
+        """
+        logging.info(f"Identified {totals.num_files} files")
+        logging.info(f"Of these, {totals.num_restoring} are being actively restored or are already restored")
+        logging.info(f"Of these, {totals.num_not_glacier} are not in glacier")
+        logging.info(f"Restoring the remaining {totals.num_to_restore} objects will cost the following:")
+
+        self.display_restore_costs(totals, sleep=sleep)
+
+    def report_location(self):
+        """
+        Return where the report goes (-o, with the extension of --report-format and the shard added)
+        """
+        outloc = glrestore.reports.report_location(self.kwargs.get('output'), self.kwargs.get('report_format') or 'csv')
+        if self.shard is not None:
+            outloc = glrestore.sharding.shard_name(outloc, *self.shard)
+        return outloc
+
     def create_report(self):
         """
         Create a report instead of actually restoring anything
         """
-        outloc = self.kwargs.get('output')
-        if not outloc.endswith('.csv'):
-            outloc += '.csv'
+        outloc = self.report_location()
 
         cdb = self.file_classifications
         logging.info(f"Identified {len(cdb)} files. Will create a report on them at {outloc}")
-        cdb.to_csv(outloc, index=False)
+        with glrestore.reports.ReportWriter(outloc) as writer:
+            writer.write(cdb)
+        self.report_loc = outloc
 
+    def stream_report(self):
+        """
+        Classify and write the report at the same time, a batch of objects at a time, keeping running totals for
+        the status / cost summary
+        """
+        totals = self.totals = StatusTotals()
+        wait = self.kwargs.get('wait', False)
+        self.files_to_restore_filtered = []
+
+        outloc = self.report_location()
+        logging.info(f"Writing the report to {outloc} as objects are found; the cost summary will be printed at the end")
+        with glrestore.reports.ReportWriter(outloc) as writer:
+            for cdb in self.iter_classified(totals):
+                writer.write(cdb)
+                if wait:
+                    self.files_to_restore_filtered.extend(cdb.loc[glrestore.s3_utils.needs_restore(cdb), 'file'].tolist())
+            if writer.rows == 0:
+                writer.write(glrestore.s3_utils.records_to_table([]))
+        self.report_loc = outloc
+
+        logging.info(f"Identified {totals.num_files} files and wrote a report on them at {outloc}")
+        self.log_status(totals, sleep=False)
+
+    def iter_classified(self, totals):
+        """
+        Classify the -f entries a batch at a time, yielding each batch of the object table (and adding it to totals
+        and the status cache) as soon as it's ready
+        """
+        for cdb in glrestore.s3_utils.iter_table_batches(self.iter_classified_records()):
+            totals.add_table(cdb)
+            if self.kwargs.get('status_cache') is not None:
+                self.kwargs['status_cache'].update(cdb)
+            yield cdb
 
-    def display_restore_costs(self, fcdb, sleep=True):
+    def iter_classified_records(self):
+        """
+        Yield the raw rows of the objects this process is responsible for among those matched by the -f entries,
+        classifying STREAM_CHUNK_SIZE entries at a time. One SeenSet is shared by every chunk, so objects matched by
+        entries in different chunks are only yielded once
         """
-        Print how much this is going to cost
+        seen = glrestore.manifests.SeenSet()
+        try:
+            for chunk in self.iter_s3_loc_chunks(self.kwargs.get('files')):
+                chunk, owned = self.hash_s3_locs(chunk)
+                for record in glrestore.s3_utils.iter_object_records(chunk, exact=False, seen=seen, **self.kwargs):
+                    if self.hashing() and not glrestore.sharding.owns(record['file'], *self.shard, owned):
+                        continue
+                    yield record
+        finally:
+            seen.close()
+
+    def merge_reports(self, locs):
+        """
+        Combine the --report CSVs of several shards into one report (at -o) and print the combined status and costs
+        """
+        logging.info(f"Merging {len(locs)} reports")
+        self.file_classifications = glrestore.sharding.read_reports(locs)
+        self.print_status(sleep=False)
+        self.create_report()
 
-        NOTE- YOURE TREATING EVERYTHING AS IF IT'S BEING RESTORED FROM DEEP ARCHIVE; the "standard" is actully a bit cheaper when restoring from flexible
+    def run_local_shards(self):
         """
-        S3_COST_PER_GB_PER_MONTH = 0.022
+        Split the restore into --processes shards, run them in parallel local processes, and combine the results
+        """
+        n = self.kwargs.get('processes')
+        if self.shard is not None:
+            raise Exception("--processes runs every shard itself, so it can't be combined with --shard")
+        logging.info(f"Running {n} shards in parallel processes (split by {self.kwargs.get('shard_by')}); the cost summary will be printed at the end")
+
+        summaries = glrestore.sharding.run_local_shards(self.ori_args, n)
 
-        TIER2REQUEST2COST = {
-            'Expedited':10,
-            'Standard':0.10,
-            'Bulk':0.025
-        }
-        TIER2REQUEST2SIZE_COST = {
-            'Expedited': 0.03,
-            'Standard': 0.02,
-            'Bulk': 0.0025
-        }
+        if self.kwargs.get('report', False):
+            self.merge_reports([s['report'] for s in summaries])
+            return
 
+        totals = StatusTotals()
+        for summary in summaries:
+            if summary['totals'] is not None:
+                totals.add_totals(summary['totals'])
+            for status, count in summary['counts'].items():
+                self.restore_counts[status] += count
+
+        self.log_restore_counts(self.restore_counts)
+        self.log_status(totals, sleep=False)
+        for summary in summaries:
+            if summary['failed'] > 0:
+                logging.error(f"Shard {summary['shard']} had {summary['failed']} failed restore requests; they are in {glrestore.sharding.shard_name(self.kwargs.get('failed'), summary['shard'], n)}")
+
+
+    def display_restore_costs(self, totals, sleep=True):
+        """
+        Print how much this is going to cost, pricing each storage class at its own rates
+        """
         # 0) Calculate the size and number of objects to restore
-        num_obs = len(fcdb)
-        size_obs = sum(fcdb['size_bytes']) / 1e9
+        num_obs = totals.num_to_restore
+        size_obs = totals.bytes_to_restore / 1e9
         tier = self.kwargs.get('speed')
 
         # 1) Calculate the cost for the extra storage
-        storage_cost = size_obs * (self.kwargs.get('days') / 30) * S3_COST_PER_GB_PER_MONTH
+        storage_cost = glrestore.planner.storage_cost(totals.bytes_to_restore, self.kwargs.get('days'))
 
-        # 2) Calculate the cost for the retrival costs
+        # 2) Calculate the cost for the retrival costs; None if some of the objects can't be restored at that tier
         t2cs = {}
-        for t in ['Expedited', 'Standard', 'Bulk']:
-            t2cs[t] = [(num_obs / 1000) * TIER2REQUEST2COST[t], size_obs * TIER2REQUEST2SIZE_COST[t]]
+        for t in glrestore.planner.TIERS:
+            t2cs[t] = [0, 0]
+            for sclass, num in totals.num_to_restore_by_class.items():
+                cost = glrestore.planner.estimate_cost(num, totals.bytes_to_restore_by_class[sclass], sclass, t)
+                if cost is None:
+                    t2cs[t] = None
+                    break
+                t2cs[t] = [t2cs[t][0] + cost[0], t2cs[t][1] + cost[1]]
 
         # Display this info
         msg = "\n$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$$\n"
 
         msg += f"It will cost the following to restore {num_obs} objects totalling {size_obs:.2f}GB:\n"
         for t, d in t2cs.items():
-            msg += f"\t{t}: ${d[0]:.2f} + ${d[1]:.2f}\n"
+            if d is None:
+                msg += f"\t{t}: not available for {', '.join(c for c in totals.num_to_restore_by_class if glrestore.planner.estimate_cost(0, 0, c, t) is None)} objects\n"
+            else:
+                msg += f"\t{t}: ${d[0]:.2f} + ${d[1]:.2f}\n"
 
         msg += f"It will also cost ${storage_cost:.2f} to restore the {size_obs:.3f}GB of data for {self.kwargs.get('days')} days"
         msg += '\n----------------------------\n'
-        msg += f"Your TOTAL COST at {tier} speed will be ${storage_cost + sum(t2cs[tier]):0.2f}\n"
+        if self.restore_plan is not None:
+            msg += glrestore.planner.summarize_plan(self.restore_plan, days=self.kwargs.get('days')) + '\n'
+            tier = 'the planned'
+        elif t2cs[tier] is None:
+            msg += f"Some of these objects can't be restored at {tier} speed\n"
+        else:
+            msg += f"Your TOTAL COST at {tier} speed will be ${storage_cost + sum(t2cs[tier]):0.2f}\n"
         msg += '\n----------------------------\n'
 
         if sleep:
@@ -206,40 +679,279 @@ class RestoreController(object):
         """
         Actually do the file restoring
         """
-        files_to_restore_filtered = self.files_to_restore_filtered
+        counts = defaultdict(int)
+        failed = []
+        self.journal_queue()
+        waves = self.restore_waves()
+        for i, groups in enumerate(waves, start=1):
+            if len(waves) > 1:
+                logging.info(f"Wave {i} of {len(waves)}: restoring {sum(len(files) for speed, files in groups)} objects")
+            for speed, files in groups:
+                if self.restore_plan is not None:
+                    logging.info(f"Restoring {len(files)} objects at {speed} speed")
+                tier_counts, tier_failed = self.issue_restores(files, speed=speed)
+                for status, count in tier_counts.items():
+                    counts[status] += count
+                failed.extend(tier_failed)
+
+            # The next wave waits for this one (and the last one too, if there's a hook to run)
+            if self.waving() and ((i < len(waves)) or (self.kwargs.get('wave_hook') is not None)):
+                self.finish_wave(i, len(waves), groups)
+
+        self.restore_counts = counts
+        self.num_failed = len(failed)
+        self.log_restore_counts(counts)
+
+        if len(failed) > 0:
+            self.write_failed(failed)
+
+    def waving(self):
+        """
+        Return True if objects are to be restored in waves (--wave-bytes / --wave-objects)
+        """
+        return (self.kwargs.get('wave_bytes') is not None) or (self.kwargs.get('wave_objects') is not None)
+
+    def restore_waves(self):
+        """
+        Return the waves to restore in, each in the form [(tier, files)] (just the one, unless waving)
+        """
+        groups = self.plan_groups()
+        if not self.waving():
+            return [groups]
+
+        sizes = None
+        if self.kwargs.get('wave_bytes') is not None:
+            cdb = getattr(self, 'file_classifications', None)
+            if cdb is None:
+                logging.warning("Object sizes aren't known when resuming from a journal, so --wave-bytes is ignored")
+            else:
+                sizes = dict(zip(cdb['file'].tolist(), cdb['size_bytes'].tolist()))
+        waves = glrestore.waves.split_waves(groups, sizes=sizes, max_objects=self.kwargs.get('wave_objects'),
+                                            max_bytes=self.kwargs.get('wave_bytes') if sizes is not None else None)
+        self.wave_sizes = sizes
+        logging.info(f"Restoring in {len(waves)} waves")
+        return waves
+
+    def finish_wave(self, wave, num_waves, groups):
+        """
+        Wait for a wave to be restored, then run --wave-hook on it
+        """
+        files = [f for speed, tier_files in groups for f in tier_files]
+        self.wait_for_restore(files=files, speed=groups[0][0])
+        self.files_already_waited_on.update(files)
+        self.metrics.tick('waves_finished')
 
-        for f in files_to_restore_filtered:
+        if self.kwargs.get('wave_hook') is not None:
+            num_bytes = sum(self.wave_sizes.get(f, 0) for f in files) if self.wave_sizes is not None else None
+            glrestore.waves.run_hook(self.kwargs.get('wave_hook'), wave, num_waves, files, num_bytes=num_bytes)
 
-            glrestore.s3_utils.restore_file(f, **self.kwargs)
+    def batch_restore(self):
+        """
+        Restore the files with S3 Batch Operations jobs, and add each object's result to the object table
+        """
+        if self.kwargs.get('batch_ops_location') is None or self.kwargs.get('batch_ops_role') is None:
+            raise Exception("--batch-ops needs --batch-ops-location and --batch-ops-role")
+
+        import pandas as pd
+
+        self.journal_queue()
+        reports = []
+        done = 0
+        for speed, files in self.plan_groups():
+            def _progress(finished, before=done):
+                self.metrics.set('restores_finished', before + finished)
+
+            reports.append(glrestore.batch_ops.batch_restore(files, self.kwargs.get('batch_ops_location'),
+                                                             self.kwargs.get('batch_ops_role'),
+                                                             interval=self.kwargs.get('batch_ops_interval'),
+                                                             progress=_progress, **dict(self.kwargs, speed=speed)))
+            done += len(files)
+        report = pd.concat(reports, ignore_index=True)
+        self.file_classifications = glrestore.batch_ops.apply_report(self.file_classifications, report)
+
+        succeeded = report['batch_status'] == 'succeeded'
+        if self.journal is not None:
+            for f, ok, error in zip(report['file'], succeeded, report['batch_error']):
+                self.journal.record(f, 'issued', None if ok else error)
+        self.restore_counts['issued'] += int(succeeded.sum())
+        self.restore_counts['failed'] += int((~succeeded).sum())
+        self.log_restore_counts(self.restore_counts)
+
+        failed = list(zip(report.loc[~succeeded, 'file'], report.loc[~succeeded, 'batch_error']))
+        self.num_failed = len(failed)
+        if len(failed) > 0:
+            self.write_failed(failed)
+
+    def journal_queue(self):
+        """
+        Write every object about to be restored (and its tier) to the journal, unless it's already there
+        """
+        if (self.journal is None) or (self.resume_groups is not None):
+            return
+        for speed, files in self.plan_groups():
+            self.journal.queue(files, speed)
+        self.journal.complete()
 
-        logging.info(f"Restore commands finished launching")
+    def stream_restore(self):
+        """
+        Classify and restore at the same time, without ever holding the whole object table in memory
 
-    def wait_for_restore(self):
+        Objects flow from the listings straight into the restore workers (which only pull more objects when they
+        have room), and the status / cost summary is kept as running totals
         """
-        Enter the loop where you wait for objects to restore before exiting the program
+        totals = self.totals = StatusTotals()
+        wait = self.kwargs.get('wait', False)
+        self.files_to_restore_filtered = []
+        failed = {'handle': None, 'num': 0, 'first': None}
+
+        logging.info("Restoring objects as they are found; the cost summary will be printed at the end")
+
+        def _to_restore():
+            for cdb in self.iter_classified(totals):
+                files = cdb.loc[glrestore.s3_utils.needs_restore(cdb), 'file'].tolist()
+                if self.journal is not None:
+                    self.journal.queue(files, self.kwargs.get('speed'))
+
+                # Waiting means remembering what needs to be waited on
+                if wait:
+                    self.files_to_restore_filtered.extend(files)
+                if len(self.transfers()) > 0:
+                    self.start_transfers(cdb)
+                for f in files:
+                    yield f
+            if self.journal is not None:
+                self.journal.complete()
+
+        def _on_failed(f, error):
+            if failed['handle'] is None:
+                failed['handle'] = open(self.kwargs.get('failed'), 'w')
+                failed['first'] = (f, error)
+            failed['handle'].write(f + '\n')
+            failed['num'] += 1
+
+        try:
+            counts, _ = self.issue_restores(_to_restore(), on_failed=_on_failed)
+        finally:
+            if failed['handle'] is not None:
+                failed['handle'].close()
+
+        self.restore_counts = counts
+        self.num_failed = failed['num']
+        self.log_restore_counts(counts)
+        self.log_status(totals, sleep=False)
+
+        if failed['num'] > 0:
+            logging.error(f"{failed['num']} restore requests failed (for example {failed['first'][0]}: {failed['first'][1]}). Re-run with -f {self.kwargs.get('failed')} to retry them")
+
+    def transfers(self):
         """
-        remaining = self.files_to_restore_filtered
-        print(f"I am going to wait for {len(remaining)} files to be restored")
+        Return the --download / --copy-to-class pools in use
+        """
+        return [pool for pool in [self.downloader, self.copier] if pool is not None]
 
-        start = time.time()
-        while True:
-            sleep(300)
+    def start_transfers(self, cdb):
+        """
+        Start downloading / copying the objects in cdb that are available now; the ones that are already restoring
+        are waited on along with the new restores and handled as they finish
+        """
+        if self.downloader is not None:
+            self.downloader.submit(cdb.loc[glrestore.download.available_mask(cdb), 'file'].tolist())
+        if self.copier is not None:
+            self.copier.submit(cdb.loc[glrestore.copier.copyable_mask(cdb), 'file'].tolist())
+        self.files_to_transfer_later.extend(cdb.loc[cdb['restore_status'] == 'restoring', 'file'].tolist())
 
-            cdb = self.get_files_to_restore_v2(remaining)
-            remaining = cdb[(cdb['restore_status'] == "restoring")]['file'].tolist()
+    def on_restored(self, files):
+        """
+        Hand objects that just finished restoring to --download / --copy-to-class
+        """
+        for pool in self.transfers():
+            pool.submit(files)
 
-            if len(remaining) == 0:
-                break
+    def log_restore_counts(self, counts):
+        """
+        Print what happened to the restore requests
+        """
+        logging.info(f"Restore commands finished launching: {counts['issued']} issued, {counts['in-progress']} already in progress, {counts['already-restored']} already restored, {counts['failed']} failed")
+
+    def write_failed(self, failed):
+        """
+        Write the objects that failed to restore to a file that can be passed straight back to -f
+        """
+        outloc = self.kwargs.get('failed')
+        with open(outloc, 'w') as o:
+            for f, error in failed:
+                o.write(f + '\n')
+
+        logging.error(f"{len(failed)} restore requests failed (for example {failed[0][0]}: {failed[0][1]}). Re-run with -f {outloc} to retry them")
+
+    def wait_for_restore(self, files=None, speed=None):
+        """
+        Enter the loop where you wait for objects to restore before exiting the program
 
+        With files, only wait for those (one wave of --wave-bytes / --wave-objects, restored at "speed")
+        """
+        final = files is None
+        if final:
+            remaining = [f for f in self.files_to_restore_filtered if f not in self.files_already_waited_on] + self.files_to_transfer_later
+        else:
+            remaining = list(files)
+        total = len(remaining)
+        on_restored = self.on_restored if len(self.transfers()) > 0 else None
+        print(f"I am going to wait for {total} files to be restored")
+
+        # One listing sweep over the objects being checked rather than a HEAD per object
+        def _classify(files):
+            return self.classify(files)
+
+        start = time.time()
+        def _progress(waiter):
             elapsed = time.time() - start
+            self.metrics.set('objects_restored', total - len(waiter.remaining))
 
             sys.stdout.write('\r')
             # the exact output you're looking for:
-            sys.stdout.write(f'Ive been waiting for {time.strftime("%Hh%Mm%Ss", time.gmtime(elapsed))}: {len(remaining)} files remain')
+            sys.stdout.write(f'Ive been waiting for {time.strftime("%Hh%Mm%Ss", time.gmtime(elapsed))}: {len(waiter.remaining)} files remain')
             sys.stdout.flush()
 
+        # Listen for restore completion events, and poll for anything they didn't account for
+        if self.kwargs.get('wait_backend') == 'sqs':
+            if self.kwargs.get('sqs_queue_url') is None:
+                raise Exception("--wait-backend sqs needs --sqs-queue-url")
+            waiter = glrestore.notifications.RestoreEventWaiter(remaining, self.kwargs.get('sqs_queue_url'), _classify,
+                                                                timeout=self.kwargs.get('sqs_timeout'),
+                                                                max_idle_receives=self.kwargs.get('sqs_max_idle'),
+                                                                on_restored=on_restored, **self.kwargs)
+            waiter.wait(progress=_progress)
+            remaining = waiter.remaining
+
+        # Poll on the schedule of the fastest tier anything was restored at
+        if speed is None:
+            groups = self.plan_groups()
+            speed = groups[0][0] if len(groups) > 0 else self.kwargs.get('speed')
+        poller = glrestore.polling.RestorePoller(remaining, _classify, speed=speed,
+                                                 interval=self.kwargs.get('poll_interval'), on_restored=on_restored)
+        poller.wait(progress=_progress)
+
         elapsed = time.time() - start
         print(f'All done! The restore took {time.strftime("%Hh%Mm%Ss", time.gmtime(elapsed))}')
+        logging.debug(f"Waiting took {poller.polls} polls and {poller.objects_checked} object checks")
+
+        # Whatever finished restoring last is still downloading / copying
+        if not final:
+            return
+        if self.copier is not None:
+            with self.metrics.phase('copy', counter='objects_copied', label='Copying'):
+                self.copier.close()
+        if self.downloader is not None:
+            with self.metrics.phase('download', counter='objects_downloaded', label='Downloading'):
+                self.downloader.close()
+
+    def log_cache_stats(self):
+        """
+        Print the status cache statistics
+        """
+        if self.kwargs.get('status_cache') is not None:
+            self.kwargs['status_cache'].log_stats()
 
     def setup_log(self):
         args = self.kwargs
@@ -268,6 +980,58 @@ class RestoreController(object):
         logging.debug("!" * 80 + '\n')
 
 
+class StatusTotals(object):
+    """
+    Running totals of the object table, so the status and cost summary don't need the whole table in memory
+    """
+    def __init__(self):
+        self.num_files = 0
+        self.num_restoring = 0
+        self.num_not_glacier = 0
+        self.num_to_restore = 0
+        self.bytes_to_restore = 0
+        self.num_to_restore_by_class = {}
+        self.bytes_to_restore_by_class = {}
+
+    def add_table(self, cdb):
+        """
+        Add a batch of rows of the object table
+        """
+        archived = cdb['storage_class'].isin(glrestore.s3_utils.ARCHIVE_STORAGE_CLASSES)
+        to_restore = glrestore.s3_utils.needs_restore(cdb)
+
+        self.num_files += len(cdb)
+        self.num_restoring += int((cdb['restore_status'] != 'not-restored').sum())
+        self.num_not_glacier += int((~archived).sum())
+        self.num_to_restore += int(to_restore.sum())
+        self.bytes_to_restore += int(cdb.loc[to_restore, 'size_bytes'].sum())
+
+        by_class = cdb.loc[to_restore].groupby('storage_class', observed=True)['size_bytes'].agg(['size', 'sum'])
+        for sclass, row in by_class.iterrows():
+            self.num_to_restore_by_class[sclass] = self.num_to_restore_by_class.get(sclass, 0) + int(row['size'])
+            self.bytes_to_restore_by_class[sclass] = self.bytes_to_restore_by_class.get(sclass, 0) + int(row['sum'])
+        return self
+
+    def add_totals(self, totals):
+        """
+        Add another set of totals (as a dictionary, like vars() of a StatusTotals)
+        """
+        for name, value in totals.items():
+            if isinstance(value, dict):
+                mine = getattr(self, name)
+                for key, v in value.items():
+                    mine[key] = mine.get(key, 0) + v
+            else:
+                setattr(self, name, getattr(self, name) + value)
+        return self
+
+    @classmethod
+    def from_table(cls, cdb):
+        """
+        Make the totals for a whole object table at once
+        """
+        return cls().add_table(cdb)
+
 def controller(args):
     """ Main entry point of the app """
     logging.info("hello world")
@@ -278,7 +1042,7 @@ def parse_args():
 
     parser.add_argument(
         '-f', '--files',
-        help="File or files to be restored (or a list of files). Can include wildcards. Must start with the bucket in the format (s3://)",
+        help="File or files to be restored, or manifests listing them (plain, gzip or zstd files, - for stdin, or @s3://bucket/key). Can include wildcards. Must start with the bucket in the format (s3://)",
         nargs='*', default=[])
 
     parser.add_argument(
@@ -291,6 +1055,74 @@ def parse_args():
         help="Speed at which to restore the data; faster is more expensive. Expedited=(1-5 min), Standard=(3-5 hr), Bulk=(12 hr)",
         default='Expedited', choices=['Expedited', 'Standard', 'Bulk'],)
 
+    parser.add_argument(
+        '--deadline',
+        help="Hours by which every object should be available. Instead of restoring everything at --speed, each object gets the cheapest tier (given its storage class and size) that makes it available in time",
+        type=float)
+
+    parser.add_argument(
+        '--budget',
+        help="Most dollars to spend on the restore (including keeping the restored copies for --days). Each object gets the cheapest tier that meets --deadline, and what's left of the budget restores the objects listed first in -f at faster tiers. With --processes each shard gets an equal share",
+        type=float)
+
+    parser.add_argument(
+        '-t', '--threads',
+        help="Number of restore requests to issue in parallel",
+        default=32, type=int)
+
+    parser.add_argument(
+        '--retries',
+        help="Number of times to retry a restore request that was throttled or hit an S3 server error",
+        default=8, type=int)
+
+    parser.add_argument(
+        '--failed',
+        help="Where to write objects whose restore request failed. This file can be passed straight back to -f",
+        default='glrestore_failed.txt')
+
+    parser.add_argument(
+        '--journal',
+        help="Write each object to restore, and the outcome of its restore request, to this file as the restore goes (fsync'd in batches), so an interrupted restore can be picked up with --resume")
+
+    parser.add_argument(
+        '--resume',
+        help="Carry on an interrupted restore from its --journal. Objects that already have restore requests are skipped, and if the journal has the full list of objects to restore nothing is classified again",
+        default=False, action="store_true")
+
+    parser.add_argument(
+        '--engine',
+        help="How to drive the S3 requests. \"threads\" uses a pool of --threads threads; \"asyncio\" keeps up to --max-in-flight requests going on a single thread (needs aiobotocore)",
+        default='threads', choices=['threads', 'asyncio'])
+
+    parser.add_argument(
+        '--max-in-flight',
+        help="Maximum number of S3 requests in flight at once with --engine asyncio",
+        default=1000, type=int)
+
+    parser.add_argument(
+        '--max-per-prefix',
+        help="Most restore requests any one prefix (directory) can have in flight. Each prefix starts low, ramps up while S3 keeps up, and backs off when it returns SlowDown. Defaults to the number of --threads (or --max-in-flight)",
+        type=int)
+
+    parser.add_argument(
+        '--max-pool-connections',
+        help="Maximum number of open connections to S3 per region. Defaults to the number of --threads",
+        type=int)
+
+    parser.add_argument(
+        '--cache',
+        help="Location of the object status cache. Restored objects are trusted until they expire and non-glacier objects for --cache-max-age, so reruns only check objects whose state could have changed. Defaults to ~/.glrestore/status_cache.sqlite")
+
+    parser.add_argument(
+        '--cache-max-age',
+        help="Hours to trust the cached status of objects that aren't archived (a lifecycle rule can move them to an archive class without changing them). Defaults to 24",
+        type=float, default=24)
+
+    parser.add_argument(
+        '--no-cache',
+        help="Don't read or write the object status cache",
+        default=False, action="store_true")
+
     parser.add_argument(
         '--profile',
         help="AWS credential profile to use. Will use default by default")
@@ -305,11 +1137,175 @@ def parse_args():
         help='Where to store the --report information',
         default='glrestore_report.txt')
 
+    parser.add_argument(
+        '--report-format',
+        help='Format of the --report: csv, gzipped csv, or parquet (compressed and typed; needs pyarrow). Reports are written a chunk at a time, and as objects are found with --stream',
+        default='csv', choices=['csv', 'csv.gz', 'parquet'])
+
+    parser.add_argument(
+        '--from-report',
+        help='Take the objects and their status from one or more earlier --report files (any --report-format) instead of classifying -f again',
+        nargs='*', default=[])
+
+    parser.add_argument(
+        '--stream',
+        help='Restore objects as soon as they are found instead of classifying everything first (with --report, write the report as they are found). Memory use stays constant no matter how many objects there are, but the cost summary is only printed at the end',
+        default=False, action="store_true")
+
     parser.add_argument(
         '--wait',
         help='Wait for restore to finish before exiting the program. Works with --report too',
         default=False, action="store_true")
 
+    parser.add_argument(
+        '--download',
+        help='Download the objects to this directory (as DIR/bucket/key), each one as soon as it is restored while the others are still restoring. Implies --wait. Re-running picks up partial downloads where they stopped',
+        metavar='DIR')
+
+    parser.add_argument(
+        '--download-threads',
+        help='Number of ranged GETs to run at once, shared by every object being downloaded',
+        default=16, type=int)
+
+    parser.add_argument(
+        '--download-rate',
+        help='Most MB per second to download, shared by every object being downloaded. Unlimited by default',
+        type=float)
+
+    parser.add_argument(
+        '--download-part-size',
+        help='MB fetched by each ranged GET',
+        default=16, type=float)
+
+    parser.add_argument(
+        '--copy-to-class',
+        help='Copy each object to this storage class as soon as it is restored (in place, or to --copy-to), so it stays un-archived. Objects bigger than --copy-part-size are copied in parts with UploadPartCopy. Implies --wait. Copies are recorded in the status cache, so a rerun only retries the ones that failed',
+        choices=['STANDARD', 'INTELLIGENT_TIERING', 'STANDARD_IA', 'ONEZONE_IA', 'GLACIER_IR'])
+
+    parser.add_argument(
+        '--copy-to',
+        help='s3:// location to copy restored objects to (each object keeps its key under it) instead of copying them in place')
+
+    parser.add_argument(
+        '--copy-threads',
+        help='Number of copy requests (CopyObject / UploadPartCopy) to run at once',
+        default=16, type=int)
+
+    parser.add_argument(
+        '--copy-part-size',
+        help='MB copied by each UploadPartCopy (between 5 and 5120); smaller objects are copied with one CopyObject',
+        default=1024, type=float)
+
+    parser.add_argument(
+        '--wave-bytes',
+        help='Restore in waves of at most this much data (like 20TB, 500GB or 1.5TiB), waiting for each wave to be restored before requesting the next, so only one wave of restored copies is paid for at a time',
+        type=glrestore.waves.parse_size)
+
+    parser.add_argument(
+        '--wave-objects',
+        help='Restore in waves of at most this many objects (with --wave-bytes, whichever limit is hit first)',
+        type=int)
+
+    parser.add_argument(
+        '--wave-hook',
+        help='Shell command to run once each wave is restored; the next wave is only requested once it exits successfully. It gets GLRESTORE_WAVE, GLRESTORE_WAVES, GLRESTORE_WAVE_OBJECTS, GLRESTORE_WAVE_BYTES and GLRESTORE_WAVE_FILES (a file listing the wave\'s objects)')
+
+    parser.add_argument(
+        '--poll-interval',
+        help='Seconds between checks when using --wait (at least 1). By default this depends on --speed (starting at 1 minute for Expedited, 15 minutes for Standard, and 30 minutes for Bulk) and grows while nothing finishes',
+        type=int)
+
+    parser.add_argument(
+        '--wait-backend',
+        help='How --wait finds out that objects have finished restoring. "poll" checks S3 periodically; "sqs" listens for s3:ObjectRestore:Completed event notifications on --sqs-queue-url and then does one final check',
+        default='poll', choices=['poll', 'sqs'])
+
+    parser.add_argument(
+        '--sqs-queue-url',
+        help='SQS queue that receives the bucket\'s s3:ObjectRestore:Completed event notifications (for --wait-backend sqs)')
+
+    parser.add_argument(
+        '--sqs-endpoint-url',
+        help='Endpoint to use for SQS instead of AWS (for example a local ElasticMQ)')
+
+    parser.add_argument(
+        '--sqs-timeout',
+        help='Stop listening for events after this many seconds and go back to polling for whatever is left',
+        type=int)
+
+    parser.add_argument(
+        '--sqs-max-idle',
+        help='Stop listening for events once this many receives in a row (of up to 20 seconds each) bring no event for an object being waited on, check everything once, and go back to polling for whatever is left',
+        type=int, default=180)
+
+    parser.add_argument(
+        '--batch-ops',
+        help='Restore with S3 Batch Operations jobs (one per bucket) instead of one request per object. Needs --batch-ops-location and --batch-ops-role, and --speed Standard or Bulk',
+        default=False, action="store_true")
+
+    parser.add_argument(
+        '--batch-ops-location',
+        help='s3:// location to upload the Batch Operations manifest to and write the completion report under')
+
+    parser.add_argument(
+        '--batch-ops-role',
+        help='ARN of the IAM role the Batch Operations job runs as')
+
+    parser.add_argument(
+        '--batch-ops-account-id',
+        help='AWS account to create the Batch Operations job in. Looked up from the credentials by default')
+
+    parser.add_argument(
+        '--batch-ops-interval',
+        help='Seconds between checks on the Batch Operations job',
+        default=30, type=int)
+
+    parser.add_argument(
+        '--shard',
+        help='Only handle shard i of N of the objects (for example 0/4, 1/4, 2/4 and 3/4), so one restore can be spread over several machines. Reports get the shard in their name; combine them with --merge-reports')
+
+    parser.add_argument(
+        '--shard-by',
+        help='How to split objects into shards. "hash" splits objects evenly by a stable hash of their location (entries naming single objects are only looked up by their own shard, but every shard lists each prefix and wildcard); "prefix" gives each shard a contiguous range of the -f entries (nothing is listed twice, but shards are only as even as the entries)',
+        default='hash', choices=['hash', 'prefix'])
+
+    parser.add_argument(
+        '--processes',
+        help='Run this many shards in parallel local processes and combine their results. The cost summary is printed at the end',
+        default=1, type=int)
+
+    parser.add_argument(
+        '--merge-reports',
+        help='Combine the --report CSVs from several shards into one report at -o (with the combined status and costs) instead of doing anything else',
+        nargs='*', default=[])
+
+    parser.add_argument(
+        '--serve',
+        help='Run as a long-running service that other glrestore processes send restores to with --connect. The service keeps its S3 clients and status table warm, sends each object one restore request however many clients ask for it, and polls once for everyone. Listens on --socket, or on localhost with --port',
+        default=False, action="store_true")
+
+    parser.add_argument(
+        '--socket',
+        help='Unix socket for --serve to listen on (~/.glrestore/glrestore.sock by default)')
+
+    parser.add_argument(
+        '--port',
+        help='Listen on this localhost port with --serve instead of a Unix socket (0 picks a free one)',
+        type=int)
+
+    parser.add_argument(
+        '--connect',
+        help='Send the restore (-f, --speed, --days, --wait) to the --serve service at this Unix socket or http://host:port instead of running it here')
+
+    parser.add_argument(
+        '--metrics-out',
+        help='Write where the run\'s time went (wall time of each phase, S3 requests by API and outcome, request latency histograms, retries and peak memory) to this file as JSON, and next to it as a Prometheus textfile (foo.json and foo.prom)')
+
+    parser.add_argument(
+        '--progress-interval',
+        help='Seconds between progress lines (throughput and ETA) while classifying, restoring and waiting. 0 turns them off',
+        default=30, type=int)
+
     parser.add_argument(
         '--debug',
         help='Create debugging log file',
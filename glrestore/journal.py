@@ -0,0 +1,184 @@
+"""
+An append-only journal of restore requests, so an interrupted restore can pick up where it stopped (--resume)
+
+The journal first gets a "queued" line (with its tier) for every object to restore, then a "complete" line once
+they've all been queued, then a line with the outcome of each restore request as it finishes. Lines are written
+as they happen and fsync'd in batches, so a crash loses at most the last batch of outcomes (and those objects
+just get another restore request, which S3 answers with "already in progress")
+
+Each line is "status<TAB>tier<TAB>s3 location"
+"""
+
+import os
+import time
+import logging
+import threading
+
+# Outcomes that mean an object doesn't need another restore request
+DONE_STATUSES = set(['issued', 'in-progress', 'already-restored'])
+
+def escape(f):
+    """
+    Make an s3 location safe to put on one journal line
+    """
+    if ('\\' in f) or ('\n' in f) or ('\r' in f) or ('\t' in f):
+        f = f.replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+    return f
+
+def unescape(f):
+    """
+    Undo escape
+    """
+    if '\\' not in f:
+        return f
+    out = []
+    i = 0
+    while i < len(f):
+        if (f[i] == '\\') and (i + 1 < len(f)):
+            out.append({'n': '\n', 'r': '\r', 't': '\t'}.get(f[i + 1], f[i + 1]))
+            i += 2
+        else:
+            out.append(f[i])
+            i += 1
+    return ''.join(out)
+
+def truncate_partial_line(loc):
+    """
+    Cut off a line that was half-written when the last run was interrupted, so new lines start cleanly
+    """
+    with open(loc, 'rb+') as h:
+        end = h.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - 65536)
+            h.seek(start)
+            chunk = h.read(pos - start)
+            i = chunk.rfind(b'\n')
+            if i >= 0:
+                pos = start + i + 1
+                break
+            pos = start
+        if pos < end:
+            h.truncate(pos)
+
+class RestoreJournal(object):
+    """
+    Writes the journal at loc (adding to it if append, for --resume), fsync-ing every sync_every outcomes or
+    sync_interval seconds (whichever is first)
+    """
+    def __init__(self, loc, append=False, sync_every=1000, sync_interval=1.0):
+        self.loc = loc
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        if append and os.path.exists(loc):
+            truncate_partial_line(loc)
+        self.handle = open(loc, 'a' if append else 'w', encoding='utf-8', newline='\n')
+
+        self.unsynced = 0
+        self.last_sync = time.time()
+        self.records = 0
+
+    def write(self, status, tier, f):
+        self.handle.write(f"{status}\t{tier or ''}\t{escape(f)}\n")
+
+    def queue(self, files, tier):
+        """
+        Record that files are going to be restored at tier; they're on disk when this returns
+        """
+        with self.lock:
+            for f in files:
+                self.write('queued', tier, f)
+            self._sync()
+
+    def complete(self):
+        """
+        Record that every object to restore has been queued, so --resume doesn't need to classify anything
+        """
+        with self.lock:
+            self.handle.write("complete\t\t\n")
+            self._sync()
+
+    def record(self, f, status, error=None):
+        """
+        Record the outcome of the restore request for f ("failed" if error isn't None)
+        """
+        with self.lock:
+            self.write('failed' if error is not None else status, None, f)
+            self.records += 1
+            self.unsynced += 1
+            if (self.unsynced >= self.sync_every) or (time.time() - self.last_sync >= self.sync_interval):
+                self._sync()
+
+    def _sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+        self.unsynced = 0
+        self.last_sync = time.time()
+
+    def close(self):
+        with self.lock:
+            if not self.handle.closed:
+                self._sync()
+                self.handle.close()
+
+class JournalState(object):
+    """
+    What a journal says happened: the objects queued (in order, with their tiers), the objects that are done, and
+    whether every object to restore was queued
+    """
+    def __init__(self):
+        self.queued = {}
+        self.done = set()
+        self.complete = False
+        self.lines = 0
+
+    def remaining(self):
+        """
+        Return [(tier, files)] of the queued objects that aren't done, in the order they were queued
+        """
+        tier2files = {}
+        for f, tier in self.queued.items():
+            if f not in self.done:
+                tier2files.setdefault(tier, []).append(f)
+        return list(tier2files.items())
+
+def replay(loc, block_size=16 * 1024 * 1024):
+    """
+    Read the journal at loc into a JournalState. Half-written lines (from a crash) are ignored
+
+    Reads big blocks and splits them into lines in one go, which keeps replaying millions of entries to a few seconds
+    """
+    state = JournalState()
+    queued = state.queued
+    done = state.done
+
+    with open(loc, 'r', encoding='utf-8', newline='\n') as r:
+        leftover = ''
+        while True:
+            block = r.read(block_size)
+            if len(block) == 0:
+                break
+            lines = (leftover + block).split('\n')
+            # The last piece hasn't had its newline yet
+            leftover = lines.pop()
+            for line in lines:
+                parts = line.split('\t', 2)
+                if len(parts) != 3:
+                    logging.debug(f"Ignoring a half-written line of {loc}")
+                    continue
+                status, tier, f = parts
+                if '\\' in f:
+                    f = unescape(f)
+                if status == 'queued':
+                    queued[f] = tier
+                elif status in DONE_STATUSES:
+                    done.add(f)
+                elif status == 'failed':
+                    done.discard(f)
+                elif status == 'complete':
+                    state.complete = True
+            state.lines += len(lines)
+        if len(leftover) > 0:
+            logging.debug(f"Ignoring the half-written last line of {loc}")
+    return state
@@ -0,0 +1,197 @@
+"""
+Read the lists of s3 locations passed to -f ("manifests") as streams, whatever they're stored in
+
+A manifest can be a local file, "-" for stdin, or "@s3://bucket/key" for a manifest stored in S3, and can be
+plain text, gzip or zstd (zstd needs the zstandard package). Lines are read one at a time, so a manifest never
+has to fit in memory
+"""
+
+import io
+import os
+import sys
+import gzip
+import sqlite3
+import hashlib
+import logging
+import tempfile
+
+import glrestore.s3_utils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+def is_manifest(loc):
+    """
+    Return True if an -f argument is a manifest rather than an s3 location
+    """
+    return (loc == '-') or loc.startswith('@') or not loc.startswith('s3://')
+
+def open_binary(loc, **kwargs):
+    """
+    Return a binary stream of the manifest at loc ("-", "@s3://bucket/key" or a local path)
+    """
+    if loc == '-':
+        return sys.stdin.buffer
+    if loc.startswith('@'):
+        loc = loc[1:]
+    if loc.startswith('s3://'):
+        bucket, key = glrestore.s3_utils.get_bucket_key(loc)
+        client = glrestore.s3_utils.get_client_for_bucket(bucket, **kwargs)
+        return client.get_object(Bucket=bucket, Key=key)['Body']
+    return open(loc, 'rb')
+
+def decompress(stream):
+    """
+    Return a text stream of a binary stream, gunzipping / un-zstding it if it starts with their magic bytes
+    """
+    if not hasattr(stream, 'peek'):
+        stream = io.BufferedReader(_Readable(stream))
+    magic = stream.peek(4)[:4]
+
+    if magic.startswith(GZIP_MAGIC):
+        stream = gzip.GzipFile(fileobj=stream)
+    elif magic.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise Exception("This manifest is zstd compressed; install zstandard to read it (pip install zstandard)")
+        stream = zstandard.ZstdDecompressor().stream_reader(stream)
+    return io.TextIOWrapper(stream, encoding='utf-8', errors='replace')
+
+def iter_manifest_lines(loc, **kwargs):
+    """
+    Yield the stripped, non-blank lines of the manifest at loc
+    """
+    raw = open_binary(loc, **kwargs)
+    text = decompress(raw)
+    try:
+        for line in text:
+            line = line.strip()
+            if len(line) > 0:
+                yield line
+    finally:
+        # Don't close stdin
+        if loc == '-':
+            text.detach()
+        else:
+            text.close()
+            raw.close()
+
+class _Readable(io.RawIOBase):
+    """
+    Make a stream with only read() (like a botocore StreamingBody) look like a file so it can be buffered
+    """
+    def __init__(self, body):
+        self.body = body
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        data = self.body.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self.body.close()
+        super().close()
+
+class SeenSet(object):
+    """
+    Remembers which strings have been seen using bounded memory
+
+    Keeps 16-byte digests in memory until there are max_in_memory of them, then moves them to a temporary SQLite
+    database on disk
+    """
+    def __init__(self, max_in_memory=1000000):
+        self.max_in_memory = max_in_memory
+        self.memory = set()
+        self.conn = None
+        self.path = None
+
+    def add(self, item):
+        """
+        Remember item; return True if it hadn't been seen before
+        """
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        if digest in self.memory:
+            return False
+        if (self.conn is not None) and \
+                self.conn.execute("SELECT 1 FROM seen WHERE digest = ?", (digest,)).fetchone() is not None:
+            return False
+
+        self.memory.add(digest)
+        if len(self.memory) >= self.max_in_memory:
+            self.spill()
+        return True
+
+    def spill(self):
+        """
+        Move the in-memory digests to disk
+        """
+        if self.conn is None:
+            fd, self.path = tempfile.mkstemp(prefix='glrestore_seen_', suffix='.sqlite')
+            os.close(fd)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            logging.debug(f"Spilling manifest deduplication to {self.path}")
+        self.conn.executemany("INSERT OR IGNORE INTO seen VALUES (?)", ((d,) for d in self.memory))
+        self.conn.commit()
+        self.memory = set()
+
+    def close(self):
+        """
+        Remove the on-disk part, if there is one
+        """
+        if self.conn is not None:
+            self.conn.close()
+            os.remove(self.path)
+            self.conn = None
+
+class ManifestReader(object):
+    """
+    Yields the deduplicated s3 locations of -f arguments, counting (rather than logging) lines that aren't s3 locations
+    """
+    def __init__(self, locs, max_in_memory=1000000, **kwargs):
+        self.locs = locs
+        self.max_in_memory = max_in_memory
+        self.kwargs = kwargs
+
+        self.lines = 0
+        self.duplicates = 0
+        self.malformed = 0
+        self.first_malformed = None
+
+    def __iter__(self):
+        seen = SeenSet(self.max_in_memory)
+        try:
+            for loc in self.locs:
+                loc = loc.strip()
+                lines = iter_manifest_lines(loc, **self.kwargs) if is_manifest(loc) else [loc]
+                for line in lines:
+                    self.lines += 1
+                    if not line.startswith('s3://'):
+                        self.malformed += 1
+                        if self.first_malformed is None:
+                            self.first_malformed = (loc, line)
+                        continue
+                    if not seen.add(line):
+                        self.duplicates += 1
+                        continue
+                    yield line
+        finally:
+            seen.close()
+            self.log_stats()
+
+    def log_stats(self):
+        """
+        Report the lines that were skipped
+        """
+        if self.malformed > 0:
+            loc, line = self.first_malformed
+            logging.error(f"Ignored {self.malformed} lines that don't start with s3:// (the first was {line} in {loc})")
+        if self.duplicates > 0:
+            logging.debug(f"Skipped {self.duplicates} duplicate lines out of {self.lines}")
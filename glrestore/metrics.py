@@ -0,0 +1,297 @@
+"""
+Measure where a run's time goes: per-phase wall time, S3 requests by API and outcome, request latency histograms,
+retries and peak memory, plus periodic progress lines with throughput and ETA
+
+Metrics are written with --metrics-out as JSON and as a Prometheus textfile (for node_exporter's textfile collector)
+"""
+
+import os
+import sys
+import time
+import json
+import bisect
+import logging
+import resource
+import threading
+import contextlib
+
+from collections import defaultdict
+
+# Upper bounds (in seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# The RunMetrics that glrestore is currently recording into (see activate)
+_ACTIVE = None
+
+def activate(metrics):
+    """
+    Make metrics the RunMetrics that tick / timer / count_retry record into (None to stop recording)
+    """
+    global _ACTIVE
+    _ACTIVE = metrics
+
+def tick(counter, n=1):
+    """
+    Add n to a counter of the active RunMetrics, if there is one
+    """
+    if _ACTIVE is not None:
+        _ACTIVE.tick(counter, n)
+
+def count_retry(api):
+    """
+    Record that glrestore retried a request to api (an API name like "RestoreObject", or a client method name
+    like "restore_object")
+    """
+    if _ACTIVE is not None:
+        if '_' in api:
+            api = ''.join(w[:1].upper() + w[1:] for w in api.split('_'))
+        _ACTIVE.count_retry(api)
+
+def attach(session):
+    """
+    Record every request made through a boto3 (or aiobotocore) session while a RunMetrics is active. Clients
+    copy their session's event handlers when they're made, so this has to happen before any clients are
+    """
+    # boto3 sessions have .events; botocore (and aiobotocore) sessions register directly
+    register = session.events.register if hasattr(session, 'events') else session.register
+    register('before-call', _before_call, unique_id='glrestore-metrics-before-call')
+    register('after-call', _after_call, unique_id='glrestore-metrics-after-call')
+    register('after-call-error', _after_call_error, unique_id='glrestore-metrics-after-call-error')
+
+def _before_call(context=None, **kwargs):
+    if (_ACTIVE is not None) and (context is not None):
+        context['glrestore_start'] = time.perf_counter()
+
+def _after_call(model=None, parsed=None, context=None, **kwargs):
+    start = (context or {}).get('glrestore_start')
+    if (_ACTIVE is None) or (model is None) or (start is None):
+        return
+    parsed = parsed or {}
+    outcome = parsed.get('Error', {}).get('Code', 'ok')
+    retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    _ACTIVE.record_request(model.name, outcome, time.perf_counter() - start, retries)
+
+def _after_call_error(model=None, exception=None, context=None, **kwargs):
+    start = (context or {}).get('glrestore_start')
+    if (_ACTIVE is None) or (model is None) or (start is None):
+        return
+    _ACTIVE.record_request(model.name, type(exception).__name__, time.perf_counter() - start)
+
+@contextlib.contextmanager
+def timer(name):
+    """
+    Add the time spent in the block to the active RunMetrics' timer "name"
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if _ACTIVE is not None:
+            _ACTIVE.add_time(name, time.perf_counter() - start)
+
+def peak_rss_bytes():
+    """
+    Return the peak resident set size of this process so far
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class RunMetrics(object):
+    """
+    Everything measured during one run
+    """
+    def __init__(self, progress_interval=30):
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+
+        self.phases = {}
+        self.timers = defaultdict(float)
+        self.counters = defaultdict(int)
+        self.requests = defaultdict(int)
+        self.retries = defaultdict(int)
+        self.latency_counts = defaultdict(lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+        self.latency_sums = defaultdict(float)
+        self.phase_peak_rss = {}
+        self.start = time.time()
+
+        self.progress = None
+
+    def tick(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def set(self, counter, value):
+        with self.lock:
+            self.counters[counter] = value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.timers[name] += seconds
+
+    def count_retry(self, api):
+        with self.lock:
+            self.retries[api] += 1
+
+    def record_request(self, api, outcome, seconds, retries=0):
+        """
+        Record one request: the API, its outcome ("ok" or the error code), how long it took and how many times
+        botocore itself retried it
+        """
+        with self.lock:
+            self.requests[(api, outcome)] += 1
+            self.latency_counts[api][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.latency_sums[api] += seconds
+            if retries > 0:
+                self.retries[api] += retries
+
+    @contextlib.contextmanager
+    def phase(self, name, counter=None, label=None, total=None, unit='objects'):
+        """
+        Time the block as phase "name". If counter is given, log a progress line for it every progress_interval
+        seconds (with an ETA if the total is known)
+        """
+        start = time.perf_counter()
+        if counter is not None:
+            self.start_progress(counter, label or name, total=total, unit=unit)
+        try:
+            yield
+        finally:
+            self.stop_progress()
+            with self.lock:
+                self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - start
+                self.phase_peak_rss[name] = peak_rss_bytes()
+
+    def start_progress(self, counter, label, total=None, unit='objects'):
+        """
+        Start logging "label: N unit (rate/s), ETA" for counter every progress_interval seconds
+        """
+        self.stop_progress()
+        if (self.progress_interval is None) or (self.progress_interval <= 0):
+            return
+        self.progress = ProgressReporter(self, counter, label, total=total, unit=unit, interval=self.progress_interval)
+        self.progress.start()
+
+    def stop_progress(self):
+        if self.progress is not None:
+            self.progress.stop()
+            self.progress = None
+
+    def to_dict(self):
+        """
+        Return the metrics as a JSON-able dictionary
+        """
+        with self.lock:
+            requests = defaultdict(dict)
+            for (api, outcome), count in self.requests.items():
+                requests[api][outcome] = count
+            latency = {}
+            for api, counts in self.latency_counts.items():
+                latency[api] = {'buckets': dict(zip([str(b) for b in LATENCY_BUCKETS] + ['+Inf'], counts)),
+                                'count': sum(counts), 'sum_seconds': self.latency_sums[api]}
+            return {'wall_seconds': time.time() - self.start,
+                    'phases': dict(self.phases),
+                    'timers': dict(self.timers),
+                    'counters': dict(self.counters),
+                    'requests': dict(requests),
+                    'retries': dict(self.retries),
+                    'latency': latency,
+                    'peak_rss_bytes': peak_rss_bytes(),
+                    'phase_peak_rss_bytes': dict(self.phase_peak_rss)}
+
+    def to_prometheus(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        d = self.to_dict()
+        lines = []
+
+        def _metric(name, kind, help, samples):
+            lines.append(f"# HELP glrestore_{name} {help}")
+            lines.append(f"# TYPE glrestore_{name} {kind}")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"glrestore_{name}{{{label_text}}} {value}" if label_text else f"glrestore_{name} {value}")
+
+        _metric('run_seconds', 'gauge', 'Wall time of the run', [({}, d['wall_seconds'])])
+        _metric('phase_seconds', 'gauge', 'Wall time of each phase', [({'phase': p}, s) for p, s in d['phases'].items()])
+        _metric('timer_seconds', 'gauge', 'Time spent in instrumented steps', [({'step': t}, s) for t, s in d['timers'].items()])
+        _metric('objects', 'gauge', 'Objects handled, by counter', [({'counter': c}, v) for c, v in d['counters'].items()])
+        _metric('requests_total', 'counter', 'S3 requests by API and outcome',
+                [({'api': api, 'outcome': o}, c) for api, outcomes in d['requests'].items() for o, c in outcomes.items()])
+        _metric('retries_total', 'counter', 'Retried S3 requests by API', [({'api': api}, c) for api, c in d['retries'].items()])
+
+        samples = []
+        for api, hist in d['latency'].items():
+            cumulative = 0
+            for bound, count in hist['buckets'].items():
+                cumulative += count
+                samples.append(({'api': api, 'le': bound}, cumulative))
+        lines.append("# HELP glrestore_request_seconds Latency of S3 requests by API")
+        lines.append("# TYPE glrestore_request_seconds histogram")
+        for labels, value in samples:
+            lines.append(f'glrestore_request_seconds_bucket{{api="{labels["api"]}",le="{labels["le"]}"}} {value}')
+        for api, hist in d['latency'].items():
+            lines.append(f'glrestore_request_seconds_sum{{api="{api}"}} {hist["sum_seconds"]}')
+            lines.append(f'glrestore_request_seconds_count{{api="{api}"}} {hist["count"]}')
+
+        _metric('peak_rss_bytes', 'gauge', 'Peak resident memory of the run', [({}, d['peak_rss_bytes'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, loc):
+        """
+        Write the metrics to loc as JSON and next to it as a Prometheus textfile (foo.json and foo.prom)
+        """
+        base, ext = os.path.splitext(loc)
+        if ext not in ['.json', '.prom']:
+            base = loc
+
+        with open(base + '.json', 'w') as o:
+            json.dump(self.to_dict(), o, indent=2)
+
+        # Write then rename, so the textfile collector never sees half a file
+        with open(base + '.prom.tmp', 'w') as o:
+            o.write(self.to_prometheus())
+        os.replace(base + '.prom.tmp', base + '.prom')
+        logging.info(f"Wrote run metrics to {base}.json and {base}.prom")
+
+class ProgressReporter(object):
+    """
+    Logs the throughput (and ETA, if the total is known) of one counter every "interval" seconds from a background thread
+    """
+    def __init__(self, metrics, counter, label, total=None, unit='objects', interval=30):
+        self.metrics = metrics
+        self.counter = counter
+        self.label = label
+        self.total = total
+        self.unit = unit
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.begin = time.time()
+        self.base = self.metrics.counters.get(self.counter, 0)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def line(self, now=None):
+        """
+        Return the progress line
+        """
+        elapsed = max(1e-9, (now or time.time()) - self.begin)
+        done = self.metrics.counters.get(self.counter, 0) - self.base
+        rate = done / elapsed
+        msg = f"{self.label}: {done:,} {self.unit} in {time.strftime('%H:%M:%S', time.gmtime(elapsed))} ({rate:,.1f}/s)"
+        if self.total is not None:
+            msg += f", {done / self.total:.0%} of {self.total:,}" if self.total > 0 else ''
+            if rate > 0:
+                msg += f", ETA {time.strftime('%H:%M:%S', time.gmtime(max(0, self.total - done) / rate))}"
+        return msg
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            logging.info(self.line())
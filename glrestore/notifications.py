@@ -0,0 +1,150 @@
+"""
+Wait for objects to finish restoring by listening for S3 "ObjectRestore:Completed" events on an SQS queue
+"""
+
+import json
+import time
+import logging
+import urllib.parse
+
+import glrestore.s3_utils
+
+def parse_restore_events(body):
+    """
+    Return the objects that an SQS message body says have finished restoring
+
+    Understands S3 event notifications sent straight to SQS, wrapped in an SNS notification, or via EventBridge
+    """
+    try:
+        message = json.loads(body)
+    except ValueError:
+        return []
+
+    # Delivered through SNS
+    if isinstance(message, dict) and ('Message' in message) and ('Records' not in message):
+        return parse_restore_events(message['Message'])
+
+    files = []
+    if not isinstance(message, dict):
+        return files
+
+    # Delivered through EventBridge
+    if message.get('detail-type') == 'Object Restore Completed':
+        detail = message.get('detail', {})
+        files.append(f"s3://{detail['bucket']['name']}/{detail['object']['key']}")
+        return files
+
+    for record in message.get('Records', []):
+        if not record.get('eventName', '').startswith('ObjectRestore:Completed'):
+            continue
+        bucket = record['s3']['bucket']['name']
+        key = urllib.parse.unquote_plus(record['s3']['object']['key'])
+        files.append(f"s3://{bucket}/{key}")
+    return files
+
+def is_test_event(body):
+    """
+    Return True for the s3:TestEvent message S3 sends when notifications are first set up
+    """
+    try:
+        return json.loads(body).get('Event') == 's3:TestEvent'
+    except (ValueError, AttributeError):
+        return False
+
+def get_sqs_client(queue_url, **kwargs):
+    """
+    Return a pooled SQS client for queue_url, pointed at --sqs-endpoint-url if given (for ElasticMQ and friends)
+    """
+    region = None
+    host = urllib.parse.urlparse(queue_url).hostname or ''
+    if host.startswith('sqs.') and host.endswith('.amazonaws.com'):
+        region = host.split('.')[1]
+    return glrestore.s3_utils.get_service_client('sqs', region=region, endpoint_url=kwargs.get('sqs_endpoint_url'), **kwargs)
+
+class RestoreEventWaiter(object):
+    """
+    Long-poll an SQS queue for restore completion events until every object in "remaining" has been seen
+
+    Messages about objects we're waiting on (and S3 test events) are deleted; everything else is left on the queue
+    for whoever else is listening to it. Once the events run out, "timeout" passes or max_idle_receives receives
+    in a row bring no event for an object being waited on, one reconciliation sweep over all of the objects catches
+    anything whose event was missed (whatever is still restoring after that is left to polling)
+    """
+    def __init__(self, remaining, queue_url, classify, sqs_client=None, timeout=None, wait_seconds=20,
+                 max_idle_receives=180, on_restored=None, **kwargs):
+        """
+        "classify" is a function that takes a list of objects and returns their object table. "on_restored" is
+        called with each batch of objects found to be restored
+        """
+        self.objects = list(remaining)
+        self.remaining = set(remaining)
+        self.queue_url = queue_url
+        self.classify = classify
+        self.on_restored = on_restored
+        self.sqs = sqs_client if sqs_client is not None else get_sqs_client(queue_url, **kwargs)
+        self.timeout = timeout
+        self.wait_seconds = wait_seconds
+        self.max_idle_receives = max_idle_receives
+
+        self.receives = 0
+        self.messages = 0
+        self.events = 0
+
+    def receive(self):
+        """
+        Receive and handle one batch of messages; return how many messages there were
+        """
+        response = self.sqs.receive_message(QueueUrl=self.queue_url, MaxNumberOfMessages=10,
+                                            WaitTimeSeconds=self.wait_seconds)
+        self.receives += 1
+
+        to_delete = []
+        messages = response.get('Messages', [])
+        for message in messages:
+            files = parse_restore_events(message['Body'])
+            matched = [f for f in files if f in self.remaining]
+            self.remaining.difference_update(matched)
+            self.events += len(matched)
+            if (self.on_restored is not None) and (len(matched) > 0):
+                self.on_restored(matched)
+
+            if (len(matched) > 0) or is_test_event(message['Body']):
+                to_delete.append({'Id': str(len(to_delete)), 'ReceiptHandle': message['ReceiptHandle']})
+
+        if len(to_delete) > 0:
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=to_delete)
+        self.messages += len(messages)
+        return len(messages)
+
+    def reconcile(self):
+        """
+        Check every object once, and make "remaining" the ones that are really still restoring
+        """
+        cdb = self.classify(self.objects)
+        self.remaining = set(cdb.loc[cdb['restore_status'] == 'restoring', 'file'])
+        if self.on_restored is not None:
+            self.on_restored(cdb.loc[cdb['restore_status'] == 'restored', 'file'].tolist())
+
+    def wait(self, progress=None):
+        """
+        Receive events until nothing is left (or the timeout passes, or the queue goes quiet), then reconcile.
+        "progress" is called with this object after every batch
+        """
+        start = time.time()
+        idle = 0
+        while len(self.remaining) > 0:
+            if (self.timeout is not None) and (time.time() - start > self.timeout):
+                logging.info(f"No restore event for {len(self.remaining)} objects after {self.timeout} seconds")
+                break
+            if (self.max_idle_receives is not None) and (idle >= self.max_idle_receives):
+                logging.info(f"No restore event for {len(self.remaining)} objects in {idle} receives in a row")
+                break
+
+            before = len(self.remaining)
+            self.receive()
+            idle = idle + 1 if len(self.remaining) == before else 0
+            if progress is not None:
+                progress(self)
+
+        self.reconcile()
+        logging.debug(f"Received {self.messages} messages in {self.receives} requests; {self.events} matched objects being waited on")
@@ -0,0 +1,177 @@
+"""
+Choose a restore tier for each object to meet a deadline and / or a budget
+
+Rather than restoring everything at one --speed, each object gets the cheapest tier that makes it available by the
+--deadline. Whatever is left of the --budget then buys faster tiers for the objects that were asked for first (the
+order of -f), so the data needed first is usable as early as the money allows
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import glrestore.s3_utils
+
+# Restore tiers, fastest first
+TIERS = ['Expedited', 'Standard', 'Bulk']
+
+# (storage class, tier) -> ($ per 1,000 restore requests, $ per GB retrieved). S3 list prices in us-east-1;
+# DEEP_ARCHIVE can't be restored at Expedited speed
+RESTORE_PRICES = {
+    ('GLACIER', 'Expedited'): (10.0, 0.03),
+    ('GLACIER', 'Standard'): (0.05, 0.01),
+    ('GLACIER', 'Bulk'): (0.0, 0.0),
+    ('DEEP_ARCHIVE', 'Standard'): (0.10, 0.02),
+    ('DEEP_ARCHIVE', 'Bulk'): (0.025, 0.0025),
+}
+
+# (storage class, tier) -> hours until the restored copy is available, at the slow end of what S3 quotes
+RESTORE_HOURS = {
+    ('GLACIER', 'Expedited'): 5 / 60,
+    ('GLACIER', 'Standard'): 5,
+    ('GLACIER', 'Bulk'): 12,
+    ('DEEP_ARCHIVE', 'Standard'): 12,
+    ('DEEP_ARCHIVE', 'Bulk'): 48,
+}
+
+# S3 doesn't promise Expedited restores for objects bigger than this, so the planner doesn't count on them
+EXPEDITED_MAX_BYTES = 250 * 1024 * 1024
+
+# Storage of the restored copy, per GB per month
+S3_COST_PER_GB_PER_MONTH = 0.022
+
+def estimate_cost(num, size_bytes, storage_class, tier):
+    """
+    Return ($ for the requests, $ for the data) to restore num objects totalling size_bytes of storage_class at tier,
+    or None if that storage class can't be restored at that tier
+    """
+    if (storage_class, tier) not in RESTORE_PRICES:
+        return None
+    per_request, per_gb = RESTORE_PRICES[(storage_class, tier)]
+    return (num / 1000) * per_request, (size_bytes / 1e9) * per_gb
+
+def storage_cost(size_bytes, days):
+    """
+    Return what it costs to keep size_bytes of restored copies for days
+    """
+    return (size_bytes / 1e9) * (days / 30) * S3_COST_PER_GB_PER_MONTH
+
+def tier_table(cdb, tiers=TIERS):
+    """
+    Return (costs, hours): arrays with a row per object and a column per tier of what restoring it at that tier costs
+    and how long it takes (inf where it can't be restored at that tier)
+    """
+    storage_class = cdb['storage_class'].astype(str)
+    size = cdb['size_bytes'].to_numpy(dtype='float64')
+
+    costs = np.full((len(cdb), len(tiers)), np.inf)
+    hours = np.full((len(cdb), len(tiers)), np.inf)
+    for j, tier in enumerate(tiers):
+        per_request = storage_class.map(lambda c: RESTORE_PRICES.get((c, tier), (np.nan, np.nan))[0]).to_numpy(dtype='float64')
+        per_gb = storage_class.map(lambda c: RESTORE_PRICES.get((c, tier), (np.nan, np.nan))[1]).to_numpy(dtype='float64')
+        hour = storage_class.map(lambda c: RESTORE_HOURS.get((c, tier), np.nan)).to_numpy(dtype='float64')
+
+        available = ~np.isnan(per_request)
+        if tier == 'Expedited':
+            available &= size <= EXPEDITED_MAX_BYTES
+        costs[available, j] = per_request[available] / 1000 + (size[available] / 1e9) * per_gb[available]
+        hours[available, j] = hour[available]
+    return costs, hours
+
+def priority_order(cdb, s3_locs):
+    """
+    Return the order (positions in cdb) objects should be favoured in: by the first -f entry that covers them, then
+    by location
+    """
+    rank = pd.Series(len(s3_locs), index=cdb.index, dtype='int64')
+    files = cdb['file']
+
+    first = {}
+    for i, loc in enumerate(s3_locs):
+        first.setdefault(loc, i)
+    exact = files.map(first)
+    rank = rank.where(exact.isna(), exact.fillna(0).astype('int64'))
+
+    # Prefixes and wildcards (anything that isn't one of the objects)
+    known = set(files)
+    for i, loc in reversed(list(enumerate(s3_locs))):
+        if loc in known:
+            continue
+        if glrestore.s3_utils.has_wildcard(loc):
+            covered = files.map(glrestore.s3_utils.GlobPattern(loc).matches)
+        else:
+            covered = files.str.startswith(loc)
+        rank = rank.where(~(covered & (rank > i)), i)
+
+    return np.lexsort((files.to_numpy(), rank.to_numpy()))
+
+def plan_restores(cdb, deadline=None, budget=None, days=7, tiers=TIERS, order=None):
+    """
+    Choose a tier for each object in cdb (objects that need restoring); returns cdb's file, storage_class and
+    size_bytes with the chosen tier, its cost and the hours until the object is available
+
+    Each object gets the cheapest tier that makes it available within "deadline" hours (or the fastest it can have,
+    if none can). If there's a "budget" (in $, including keeping the restored copies for "days"), what's left of
+    it upgrades objects to the fastest tiers it can pay for, one at a time in "order" (positions in cdb; see
+    priority_order)
+    """
+    cdb = cdb.reset_index(drop=True)
+    rows = np.arange(len(cdb))
+    costs, hours = tier_table(cdb, tiers)
+
+    feasible = np.isfinite(costs)
+    if deadline is not None:
+        in_time = feasible & (hours <= deadline)
+        late = ~in_time.any(axis=1)
+        if late.any():
+            logging.warning(f"{int(late.sum())} objects can't be restored within {deadline} hours; they will be restored as fast as they can be")
+            fastest = hours[late].min(axis=1)
+            in_time[late] = feasible[late] & (hours[late] == fastest[:, None])
+        feasible = in_time
+
+    if (len(cdb) > 0) and (~feasible.any(axis=1)).any():
+        raise Exception(f"Some objects can't be restored at any of {', '.join(tiers)}")
+
+    chosen = np.where(feasible, costs, np.inf).argmin(axis=1) if len(cdb) > 0 else np.zeros(0, dtype='int64')
+    total = costs[rows, chosen].sum() + storage_cost(cdb['size_bytes'].sum(), days)
+
+    if budget is not None:
+        if total > budget + 1e-9:
+            raise Exception(f"The cheapest restore that meets the deadline costs ${total:.2f}, which is over the ${budget:.2f} budget")
+
+        # Spend what's left on making the first objects available sooner: in order, each object gets the fastest
+        # tier the rest of the budget can pay for
+        if order is None:
+            order = rows
+        remaining = budget - total
+        faster = feasible & (hours < hours[rows, chosen][:, None])
+        extra = np.where(faster, costs - costs[rows, chosen][:, None], np.inf)
+        cheapest = extra.min(axis=1) if len(cdb) > 0 else extra
+        for i in order:
+            if cheapest[i] > remaining + 1e-9:
+                continue
+            affordable = np.flatnonzero(extra[i] <= remaining + 1e-9)
+            j = affordable[np.argmin(hours[i, affordable])]
+            remaining -= extra[i, j]
+            chosen[i] = j
+
+    plan = cdb[['file', 'storage_class', 'size_bytes']].copy()
+    plan['tier'] = pd.Categorical(np.array(tiers, dtype=object)[chosen] if len(cdb) > 0 else [], categories=tiers)
+    plan['cost'] = costs[rows, chosen]
+    plan['ready_hours'] = hours[rows, chosen]
+    return plan
+
+def summarize_plan(plan, days=7):
+    """
+    Return a message describing a plan: the objects, data, cost and worst-case availability of each tier
+    """
+    msg = "Restore plan:\n"
+    total = 0
+    for tier, group in plan.groupby('tier', observed=True):
+        cost = group['cost'].sum()
+        total += cost
+        msg += f"\t{tier}: {len(group)} objects ({group['size_bytes'].sum() / 1e9:.2f}GB) for ${cost:.2f}, available within {group['ready_hours'].max():.1f} hours\n"
+    keep = storage_cost(plan['size_bytes'].sum(), days)
+    msg += f"Plus ${keep:.2f} to keep the restored copies for {days} days; TOTAL COST ${total + keep:.2f}"
+    return msg
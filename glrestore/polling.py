@@ -0,0 +1,98 @@
+"""
+Wait for objects to finish restoring, polling on a schedule that fits the restore tier
+"""
+
+import time
+import random
+import logging
+
+# (first check, starting interval, longest interval) in seconds for each restore tier
+TIER2POLLING = {
+    'Expedited': (60, 60, 5 * 60),
+    'Standard': (3 * 3600, 15 * 60, 3600),
+    'Bulk': (5 * 3600, 30 * 60, 2 * 3600),
+}
+
+# The shortest wait between polls, so --poll-interval 0 doesn't hammer S3
+MIN_POLL_INTERVAL = 1
+
+class RestorePoller(object):
+    """
+    Keeps the set of objects that are still restoring and shrinks it as they finish
+
+    Each poll checks a random sample of the remaining objects, and only sweeps all of them once the sample shows
+    that objects are finishing. The wait between polls follows the restore tier and widens while nothing finishes
+    """
+    def __init__(self, remaining, classify, speed='Expedited', interval=None, sample_size=100, backoff=1.5,
+                 sleep=None, on_restored=None):
+        """
+        "classify" is a function that takes a list of objects and returns their object table. "on_restored" is
+        called with each batch of objects found to be restored
+        """
+        self.remaining = set(remaining)
+        self.classify = classify
+        self.on_restored = on_restored
+        self.sample_size = sample_size
+        self.backoff = backoff
+        self.sleep = sleep if sleep is not None else time.sleep
+
+        self.first_check, self.base_interval, self.max_interval = TIER2POLLING[speed]
+        if interval is not None:
+            interval = max(MIN_POLL_INTERVAL, interval)
+            self.first_check = self.base_interval = interval
+            self.max_interval = max(self.max_interval, interval)
+
+        self.polls = 0
+        self.objects_checked = 0
+
+    def check(self, files):
+        """
+        Classify files and remove the ones that aren't restoring anymore; return how many that was
+        """
+        files = list(files)
+        cdb = self.classify(files)
+        self.objects_checked += len(files)
+
+        restoring = set(cdb.loc[cdb['restore_status'] == 'restoring', 'file'])
+        finished = [f for f in files if f not in restoring]
+        self.remaining.difference_update(finished)
+
+        if (self.on_restored is not None) and (len(finished) > 0):
+            restored = set(cdb.loc[cdb['restore_status'] == 'restored', 'file'])
+            self.on_restored([f for f in finished if f in restored])
+        return len(finished)
+
+    def poll(self):
+        """
+        Check a sample of the remaining objects, and all of them if any of the sample have finished
+        """
+        self.polls += 1
+        if len(self.remaining) <= self.sample_size:
+            return self.check(self.remaining)
+
+        finished = self.check(random.sample(list(self.remaining), self.sample_size))
+        if finished == 0:
+            return 0
+
+        logging.debug(f"{finished} of a sample of {self.sample_size} objects have finished restoring; checking all of them")
+        return finished + self.check(self.remaining)
+
+    def wait(self, progress=None):
+        """
+        Poll until nothing is left restoring. "progress" is called with this object after every poll
+        """
+        delay = self.first_check
+        interval = self.base_interval
+        while len(self.remaining) > 0:
+            self.sleep(delay)
+            finished = self.poll()
+
+            if progress is not None:
+                progress(self)
+
+            # Objects are finishing, so check again soon; otherwise back off
+            if finished > 0:
+                interval = self.base_interval
+            else:
+                interval = min(self.max_interval, interval * self.backoff)
+            delay = interval
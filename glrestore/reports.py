@@ -0,0 +1,109 @@
+"""
+Write --report object tables a chunk at a time, and read them back (for --merge-reports and --from-report)
+
+Reports can be plain CSV, gzipped CSV or Parquet (Parquet needs pyarrow). Each chunk is written (and flushed) as soon
+as it's classified, so a long --stream --report run never holds the whole table in memory, and an interrupted CSV
+report keeps everything written before it stopped
+"""
+
+import gzip
+import logging
+
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# --report-format -> the extension of the report
+FORMAT2EXTENSION = {'csv': '.csv', 'csv.gz': '.csv.gz', 'parquet': '.parquet'}
+
+def report_format(loc):
+    """
+    Return the format of the report at loc, from its extension
+    """
+    for fmt, ext in sorted(FORMAT2EXTENSION.items(), key=lambda x: -len(x[1])):
+        if loc.endswith(ext):
+            return fmt
+    return 'csv'
+
+def report_location(loc, fmt='csv'):
+    """
+    Return where a report in fmt goes for -o loc (the extension is added if it isn't there)
+    """
+    ext = FORMAT2EXTENSION[fmt]
+    return loc if loc.endswith(ext) else loc + ext
+
+def require_pyarrow():
+    """
+    Raise a helpful exception if Parquet reports can't be used
+    """
+    if pyarrow is None:
+        raise Exception("Parquet reports need pyarrow; install it with pip install pyarrow (or pip install glrestore[parquet])")
+
+class ReportWriter(object):
+    """
+    Writes an object table to loc a chunk at a time. Use as "with ReportWriter(loc) as writer: writer.write(cdb)"
+    """
+    def __init__(self, loc, chunk_size=100000):
+        self.loc = loc
+        self.fmt = report_format(loc)
+        self.chunk_size = chunk_size
+        self.rows = 0
+
+        self.handle = None
+        self.parquet = None
+        self.schema = None
+        if self.fmt == 'parquet':
+            require_pyarrow()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, cdb):
+        """
+        Add the rows of cdb to the report
+        """
+        for start in range(0, len(cdb), self.chunk_size):
+            self.write_chunk(cdb.iloc[start:start + self.chunk_size])
+        if (len(cdb) == 0) and (self.handle is None) and (self.parquet is None):
+            # Still write the header / schema of an empty report
+            self.write_chunk(cdb)
+
+    def write_chunk(self, chunk):
+        if self.fmt == 'parquet':
+            table = pyarrow.Table.from_pandas(chunk, schema=self.schema, preserve_index=False)
+            if self.parquet is None:
+                self.schema = table.schema
+                self.parquet = pyarrow.parquet.ParquetWriter(self.loc, self.schema, compression='zstd')
+            self.parquet.write_table(table)
+        else:
+            header = self.handle is None
+            if header:
+                self.handle = gzip.open(self.loc, 'wt', newline='') if self.fmt == 'csv.gz' else open(self.loc, 'w', newline='')
+            chunk.to_csv(self.handle, header=header, index=False)
+            self.handle.flush()
+        self.rows += len(chunk)
+
+    def close(self):
+        if self.parquet is not None:
+            self.parquet.close()
+            self.parquet = None
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+        logging.debug(f"Wrote {self.rows} rows to {self.loc}")
+
+def read_raw(loc):
+    """
+    Read the report at loc (CSV, gzipped CSV or Parquet) as it was written
+    """
+    if report_format(loc) == 'parquet':
+        require_pyarrow()
+        return pd.read_parquet(loc)
+    return pd.read_csv(loc)
@@ -1,27 +1,117 @@
+import time
 import boto3
+import re
+import random
 import logging
-import datetime
-import awswrangler
+import threading
+import queue
+import bisect
+import fnmatch
+import functools
+import itertools
+import posixpath
+import botocore.config
+import concurrent.futures
 
 import pandas as pd
 
 from collections import defaultdict
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
 
-def get_boto3_client(**kwargs):
+import glrestore.metrics
+import glrestore.reports
+import glrestore.manifests
+
+# Error codes that mean "slow down" or "S3 had a problem"; these are worth retrying
+RETRYABLE_ERROR_CODES = set(['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                             'TooManyRequests', 'RequestTimeout', 'InternalError', 'ServiceUnavailable',
+                             'GlacierExpeditedRetrievalNotAvailable'])
+
+# Process-wide caches so every request doesn't pay for a new session, credential lookup and connection
+_SESSIONS = {}
+_CLIENTS = {}
+_BUCKET_REGIONS = {}
+_POOL_LOCK = threading.Lock()
+
+def get_boto3_session(**kwargs):
+    """
+    Return the (cached) boto3 session for the "profile" in kwargs
+    """
+    profile_name = kwargs.get('profile')
+    with _POOL_LOCK:
+        if profile_name not in _SESSIONS:
+            _SESSIONS[profile_name] = boto3.session.Session(profile_name=profile_name)
+            glrestore.metrics.attach(_SESSIONS[profile_name])
+        return _SESSIONS[profile_name]
+
+def get_boto3_client(region=None, **kwargs):
     """
     The point of this is really to handle the "profile" option when setting up boto3
+
+    Clients are cached by profile, region and max_pool_connections and are shared by all threads
     """
     # This means you already have a client made
-    if 'client' in kwargs:
+    if kwargs.get('client') is not None:
         return kwargs.get('client')
 
-    # This means I'll make you a new client
-    if 'profile' in kwargs:
-        profile_name = kwargs.get('profile')
-        session = boto3.session.Session(profile_name=profile_name)
-    else:
-        session = boto3.session.Session()
-    return session.client("s3")
+    # Size the connection pool to the number of threads that will be sharing it
+    max_pool_connections = kwargs.get('max_pool_connections') or max(10, kwargs.get('threads') or 0)
+    profile_name = kwargs.get('profile')
+
+    key = ('s3', profile_name, region, None, max_pool_connections)
+    return _get_cached_client(key, **kwargs)
+
+def get_service_client(service_name, region=None, endpoint_url=None, **kwargs):
+    """
+    Return a pooled client for an AWS service other than S3 (for example SQS), cached like get_boto3_client
+    """
+    key = (service_name, kwargs.get('profile'), region, endpoint_url, 10)
+    return _get_cached_client(key, **kwargs)
+
+def _get_cached_client(key, **kwargs):
+    """
+    Return the client for key = (service, profile, region, endpoint_url, max_pool_connections), making it if need be
+    """
+    if key not in _CLIENTS:
+        session = get_boto3_session(**kwargs)
+        service_name, profile_name, region, endpoint_url, max_pool_connections = key
+        with _POOL_LOCK:
+            if key not in _CLIENTS:
+                config = botocore.config.Config(max_pool_connections=max_pool_connections)
+                _CLIENTS[key] = session.client(service_name, region_name=region, endpoint_url=endpoint_url, config=config)
+    return _CLIENTS[key]
+
+def get_bucket_region(bucket, **kwargs):
+    """
+    Return the region "bucket" lives in (cached), so requests go straight there instead of via a redirect
+    """
+    if bucket not in _BUCKET_REGIONS:
+        client = get_boto3_client(**kwargs)
+        try:
+            headers = client.head_bucket(Bucket=bucket)['ResponseMetadata']['HTTPHeaders']
+        except ClientError as e:
+            # S3 still reports the region on 301 / 403 responses
+            headers = e.response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        _BUCKET_REGIONS[bucket] = headers.get('x-amz-bucket-region')
+        logging.debug(f"Bucket {bucket} is in region {_BUCKET_REGIONS[bucket]}")
+    return _BUCKET_REGIONS[bucket]
+
+def get_client_for_bucket(bucket, **kwargs):
+    """
+    Return a pooled client pointed at the region that "bucket" lives in
+    """
+    if kwargs.get('client') is not None:
+        return kwargs.get('client')
+    return get_boto3_client(region=get_bucket_region(bucket, **kwargs), **kwargs)
+
+def clear_client_cache():
+    """
+    Forget all cached sessions, clients and bucket regions
+    """
+    with _POOL_LOCK:
+        _SESSIONS.clear()
+        _CLIENTS.clear()
+        _BUCKET_REGIONS.clear()
 
 def get_bucket_key(s3_loc):
     """
@@ -81,54 +171,587 @@ def get_bucket_key(s3_loc):
 #     else:
 #         return sclass, rclass
 
-def get_object_storage_class_v2(s3_locs, extra_info=False, **kwargs):
+# Storage classes that need to be restored before they can be read
+ARCHIVE_STORAGE_CLASSES = ['GLACIER', 'DEEP_ARCHIVE']
+
+# Columns of the object table made by get_object_storage_class_v2, and of the raw rows it's made from
+TABLE_COLUMNS = ['file', 'storage_class', 'restore_status', 'LastModified', 'size_bytes', 'restore_expiry', 'etag']
+RAW_COLUMNS = ['file', 'storage_class', 'size_bytes', 'LastModified', 'etag', 'restore_header', 'restore_ongoing', 'restore_expiry']
+
+# Values of the "restore_status" column
+RESTORE_STATUSES = ['not-restored', 'restoring', 'restored']
+
+# When looking up a list of objects, keep listing a directory only while each page finds at least
+# this many of the objects we want. Otherwise it's cheaper to just HEAD the rest of them
+MIN_KEYS_PER_LIST_PAGE = 20
+
+def has_wildcard(s3_loc):
     """
-    Return the storage class and restoring status of an s3_loc
+    Return True if s3_loc contains a glob character
+    """
+    return any(c in s3_loc for c in '*?[')
+
+def literal_prefix(key):
+    """
+    Return the part of a key before its first glob character
+    """
+    for i, c in enumerate(key):
+        if c in '*?[':
+            return key[:i]
+    return key
+
+def iter_list_pages(bucket, prefix, delimiter=None, start_after=None, **kwargs):
+    """
+    Yield the "Contents" of each ListObjectsV2 page under prefix, including each object's RestoreStatus
+    """
+    client = get_client_for_bucket(bucket, **kwargs)
+    params = {'Bucket': bucket, 'Prefix': prefix, 'OptionalObjectAttributes': ['RestoreStatus']}
+    if delimiter is not None:
+        params['Delimiter'] = delimiter
+    if start_after is not None:
+        params['StartAfter'] = start_after
+
+    while True:
+        page = call_with_backoff(client.list_objects_v2, retries=kwargs.get('retries', 8), **params)
+        yield page.get('Contents', [])
+
+        if not page.get('IsTruncated', False):
+            break
+        params['ContinuationToken'] = page['NextContinuationToken']
+
+def list_common_prefixes(bucket, prefix, **kwargs):
+    """
+    Return the "directories" (CommonPrefixes, delimited by "/") directly under prefix
+    """
+    client = get_client_for_bucket(bucket, **kwargs)
+    params = {'Bucket': bucket, 'Prefix': prefix, 'Delimiter': '/'}
+
+    prefixes = []
+    while True:
+        page = call_with_backoff(client.list_objects_v2, retries=kwargs.get('retries', 8), **params)
+        prefixes.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
 
-    If "extra_info", return a dictionary including creation date, last modified date, and size
+        if not page.get('IsTruncated', False):
+            break
+        params['ContinuationToken'] = page['NextContinuationToken']
+    return prefixes
+
+def head_object(s3_loc, **kwargs):
+    """
+    Return the head_object response for s3_loc, or None if it doesn't exist
+    """
+    bucket, key = get_bucket_key(s3_loc)
+    client = get_client_for_bucket(bucket, **kwargs)
+    try:
+        return call_with_backoff(client.head_object, retries=kwargs.get('retries', 8), Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ['404', 'NoSuchKey']:
+            logging.warning(f"{s3_loc} does not exist")
+            return None
+        raise
+
+def head_to_record(f, response):
+    """
+    Turn a head_object response into a raw row of the object table (see records_to_table)
+    """
+    # If STANDARD, StorageClass won't be in this. If not restored, 'Restore' won't be in this
+    return {'file': f, 'storage_class': response.get('StorageClass', 'STANDARD'), 'size_bytes': response['ContentLength'],
+            'LastModified': response['LastModified'], 'etag': response.get('ETag'), 'restore_header': response.get('Restore')}
+
+def listing_to_record(bucket, entry):
+    """
+    Turn an entry from a ListObjectsV2 page into a raw row of the object table (see records_to_table)
+    """
+    # If not restored, 'RestoreStatus' won't be in this
+    record = {'file': f"s3://{bucket}/{entry['Key']}", 'storage_class': entry.get('StorageClass', 'STANDARD'),
+              'size_bytes': entry['Size'], 'LastModified': entry['LastModified'], 'etag': entry.get('ETag')}
+    if 'RestoreStatus' in entry:
+        record['restore_ongoing'] = entry['RestoreStatus'].get('IsRestoreInProgress', False)
+        record['restore_expiry'] = entry['RestoreStatus'].get('RestoreExpiryDate')
+    return record
+
+class SweepState(object):
+    """
+    The bookkeeping for listing a directory once to find a group of keys or prefixes (see sweep)
+
+    Kept separate from the requests themselves so the threaded and asyncio engines make the same decisions
     """
-    #assert type(s3_locs) == type([])
-    f2re = awswrangler.s3.describe_objects(s3_locs)
+    def __init__(self, bucket, items, exact=True):
+        self.bucket = bucket
+        self.items = sorted(set(items))
+        self.wanted = set(self.items)
+        self.exact = exact
+        self.prefix = posixpath.commonprefix(self.items)
+        self.delimiter = '/' if exact else None
+
+        self.found = set()
+        self.matched = 0
+        self.pages = 0
+        self.complete = False
+        self.done = False
+        self.last_seen = None
+
+    def matches(self, key):
+        """
+        Return True if key is one of the items (exact) or falls under one of them
+        """
+        if self.exact:
+            return key in self.wanted
+        i = bisect.bisect_right(self.items, key) - 1
+        return (i >= 0) and key.startswith(self.items[i])
+
+    def passed(self, key, item):
+        """
+        Return True if a listing that has reached key can't find anything more for item
+        """
+        return (key > item) and not (key.startswith(item) and not self.exact)
+
+    def add_page(self, contents):
+        """
+        Return the raw table rows on a page of the directory listing, and set "done" once no more pages are needed
+
+        A page can be empty and still not be the last one (with a delimiter, it may hold nothing but
+        subdirectories), so whether the listing is over is left to the caller
+        """
+        self.pages += 1
+        records = []
+        for entry in contents:
+            if self.matches(entry['Key']):
+                self.matched += 1
+                if self.exact:
+                    self.found.add(entry['Key'])
+                records.append(listing_to_record(self.bucket, entry))
+        if len(contents) > 0:
+            self.last_seen = contents[-1]['Key']
 
-    table = defaultdict(list)
-    for f, re in f2re.items():
+        if ((self.last_seen is not None) and self.passed(self.last_seen, self.items[-1])) or \
+                (self.exact and len(self.found) == len(self.items)):
+            self.complete = self.done = True
+        elif self.pages * MIN_KEYS_PER_LIST_PAGE > self.matched + MIN_KEYS_PER_LIST_PAGE:
+            logging.debug(f"s3://{self.bucket}/{self.prefix} is too sparse to list; will look up the remaining items one by one")
+            self.done = True
+        return records
 
-        # Get the storage class. If STANDARD, StorageClass won't be in this
-        if ('ResponseMetadata' in re) & ('StorageClass' not in re):
-            sclass = 'STANDARD'
+    def leftovers(self):
+        """
+        Return the keys that still need a HEAD, and the (prefix, start_after) that still need their own listing
+        """
+        heads = []
+        relists = []
+        for item in self.items:
+            if self.complete or ((self.last_seen is not None) and self.passed(self.last_seen, item)):
+                if self.exact and (item not in self.found):
+                    logging.warning(f"s3://{self.bucket}/{item} does not exist")
+            elif self.exact:
+                if item not in self.found:
+                    heads.append(item)
+            else:
+                # Pick up where the directory listing left off if it got part way through this prefix
+                start_after = self.last_seen if ((self.last_seen is not None) and self.last_seen.startswith(item)) else None
+                relists.append((item, start_after))
+        return heads, relists
+
+def sweep(bucket, items, exact=True, **kwargs):
+    """
+    Yield the raw table rows for a group of keys (exact=True) or prefixes (exact=False) that share a directory
+
+    Lists the directory once instead of sending a request for every item. Items the listing doesn't resolve
+    (or all remaining items, when the directory is so big that listing it would be more work) fall back to a
+    HEAD (keys) or their own listing (prefixes)
+    """
+    state = SweepState(bucket, items, exact=exact)
+    try:
+        for contents in iter_list_pages(bucket, state.prefix, delimiter=state.delimiter, **kwargs):
+            for record in state.add_page(contents):
+                yield record
+            if state.done:
+                break
         else:
-            sclass = re['StorageClass']
+            state.complete = True
+    except ClientError as e:
+        logging.debug(f"Could not list s3://{bucket}/{state.prefix} ({e}); will look up the items one by one")
 
-        # Get the restore status. If not restored, 'Restore' won't be in this
-        if 'Restore' not in re:
-            rclass = False
+    heads, relists = state.leftovers()
+    for key in heads:
+        f = f"s3://{bucket}/{key}"
+        response = head_object(f, **kwargs)
+        if response is not None:
+            yield head_to_record(f, response)
+    for prefix, start_after in relists:
+        for contents in iter_list_pages(bucket, prefix, start_after=start_after, **kwargs):
+            for entry in contents:
+                yield listing_to_record(bucket, entry)
+
+def translate_segment(segment):
+    """
+    Return a regular expression for a glob that has to stay within one "/"-delimited segment of a key
+    """
+    regex = ''
+    i = 0
+    while i < len(segment):
+        c = segment[i]
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif (c == '[') and (segment.find(']', i + 2) != -1):
+            j = segment.find(']', i + 2)
+            body = segment[i + 1:j]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex += '[' + body.replace('\\', '\\\\') + ']'
+            i = j
         else:
-            r = re['Restore']
-            active_restore = 'ongoing-request="true"' in r
-            # if not active_restore:
-            #     expiry_date = r.split('expiry-date=\"')[1]
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+class GlobPattern(object):
+    """
+    A glob over the keys of a bucket, compiled so a listing only has to visit the parts of the bucket it can match
+
+    Listing starts at the directory of the longest literal prefix. Each later directory segment is matched one
+    level at a time against the "/"-delimited CommonPrefixes, so subtrees that can't match are never listed; in
+    these segments "*" and "?" don't match "/", and a "**" segment matches any number of directories. The last
+    segment is listed recursively and matched like fnmatch (so there "*" still matches "/")
+    """
+    def __init__(self, pattern):
+        self.pattern = pattern
+        head = literal_prefix(pattern)
+        self.base = head[:head.rfind('/') + 1]
+
+        parts = pattern[len(self.base):].split('/')
+        self.segments = parts[:-1]
+        self.depth = self.segments.index('**') if '**' in self.segments else len(self.segments)
+        self.segment_regexes = [re.compile(translate_segment(seg)) for seg in self.segments[:self.depth]]
+
+        regex = re.escape(self.base)
+        for seg in self.segments:
+            regex += '(?:[^/]*/)*' if seg == '**' else translate_segment(seg) + '/'
+        self.regex = re.compile(regex + fnmatch.translate(parts[-1]))
+
+        # What's left to match (recursively) once the walk is over
+        self.remainder = '/'.join(parts[self.depth:])
+
+    def level_prefix(self, d, i):
+        """
+        Return the prefix to list under directory d to find the candidates for segment i
+        """
+        return d + literal_prefix(self.segments[i])
+
+    def child_matches(self, i, d, child):
+        """
+        Return True if the directory "child" (a CommonPrefix of d) matches segment i
+        """
+        return self.segment_regexes[i].fullmatch(child[len(d):-1]) is not None
+
+    def final_prefix(self, d):
+        """
+        Return the prefix to list recursively under a directory the walk ended at
+        """
+        return d + literal_prefix(self.remainder)
+
+    def matches(self, key):
+        """
+        Return True if key matches the whole pattern
+        """
+        return self.regex.match(key) is not None
+
+def walk_glob(bucket, glob, **kwargs):
+    """
+    Return the directories a GlobPattern's last segment has to be listed under, listing each level in parallel
+    """
+    dirs = [glob.base]
+    for i, seg in enumerate(glob.segments[:glob.depth]):
+        if not has_wildcard(seg):
+            dirs = [d + seg + '/' for d in dirs]
+            continue
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=kwargs.get('threads') or 32) as executor:
+            children = list(executor.map(lambda d: list_common_prefixes(bucket, glob.level_prefix(d, i), **kwargs), dirs))
+        dirs = [c for d, cs in zip(dirs, children) for c in cs if glob.child_matches(i, d, c)]
+        logging.debug(f"{len(dirs)} directories match s3://{bucket}/{glob.pattern} to level {i + 1}")
+        if len(dirs) == 0:
+            break
+    return dirs
+
+def list_matching(bucket, glob, d, **kwargs):
+    """
+    Yield the raw table rows for the objects under directory d that match a GlobPattern
+    """
+    for contents in iter_list_pages(bucket, glob.final_prefix(d), **kwargs):
+        for entry in contents:
+            if glob.matches(entry['Key']):
+                yield listing_to_record(bucket, entry)
 
-            if active_restore:
-                rclass = 'restoring'
+def list_wildcard(bucket, pattern, **kwargs):
+    """
+    Yield the raw table rows for every object in bucket whose key matches the glob pattern (see GlobPattern)
+    """
+    glob = GlobPattern(pattern)
+    dirs = walk_glob(bucket, glob, **kwargs)
+    jobs = [(functools.partial(list_matching, **kwargs), bucket, glob, d) for d in dirs]
+    for record in iter_concurrently(jobs, threads=kwargs.get('threads') or 32):
+        yield record
+
+def plan_s3_locs(s3_locs):
+    """
+    Normalise and deduplicate s3_locs (prefixes and wildcards) and group them by bucket
+
+    Returns a dictionary of bucket -> [prefixes, wildcards]. Prefixes and wildcards that fall under a shorter
+    prefix are dropped, since listing the shorter prefix already finds everything they would
+    """
+    bucket2locs = defaultdict(lambda: [set(), set()])
+    for s3_loc in s3_locs:
+        bucket, key = get_bucket_key(s3_loc.strip())
+        bucket2locs[bucket][1 if has_wildcard(key) else 0].add(key)
+
+    plan = {}
+    for bucket, (prefixes, wildcards) in bucket2locs.items():
+        kept = []
+        for p in sorted(prefixes):
+            if (len(kept) == 0) or (not p.startswith(kept[-1])):
+                kept.append(p)
+
+        def _covered(w):
+            lp = literal_prefix(w)
+            i = bisect.bisect_right(kept, lp) - 1
+            return (i >= 0) and lp.startswith(kept[i])
+
+        plan[bucket] = [kept, sorted(w for w in wildcards if not _covered(w))]
+    return plan
+
+def iter_concurrently(jobs, threads=32, queue_size=10000):
+    """
+    Run each job (a generator function followed by its arguments) in a pool of "threads" workers, and yield
+    everything the generators yield as it arrives
+
+    At most queue_size items are buffered; workers wait for the consumer to catch up beyond that
+    """
+    items = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+        raise _Stopped()
+
+    def _run(job):
+        try:
+            for item in job[0](*job[1:]):
+                _put(item)
+            _put(done)
+        except _Stopped:
+            pass
+        except Exception as e:
+            try:
+                _put(e)
+            except _Stopped:
+                pass
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    try:
+        for job in jobs:
+            executor.submit(_run, job)
+
+        remaining = len(jobs)
+        while remaining > 0:
+            item = items.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
             else:
-                rclass = 'restored'
+                yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+
+class _Stopped(Exception):
+    """
+    Raised inside iter_concurrently workers once the consumer has gone away
+    """
+    pass
+
+def normalise_s3_locs(s3_locs, exact=None):
+    """
+    Return s3_locs as a list, and whether they are objects (exact) or prefixes / wildcards
+
+    By default a string is a prefix / wildcard and a list is a list of objects
+    """
+    if isinstance(s3_locs, str):
+        return [s3_locs], (False if exact is None else exact)
+    return s3_locs, (True if exact is None else exact)
+
+def plan_lookups(s3_locs, exact):
+    """
+    Return the lookups needed to find every object matched by s3_locs (see iter_object_records)
+
+    Each is either ('sweep', bucket, items, exact) for a group of keys / prefixes in one directory, or
+    ('wildcard', bucket, pattern)
+    """
+    lookups = []
+    if not exact:
+        for bucket, (prefixes, wildcards) in plan_s3_locs(s3_locs).items():
+            for d, group in group_by_directory(prefixes).items():
+                lookups.append(('sweep', bucket, group, False))
+            for w in wildcards:
+                lookups.append(('wildcard', bucket, w))
+    else:
+        bucket2keys = defaultdict(list)
+        for f in s3_locs:
+            bucket, key = get_bucket_key(f)
+            bucket2keys[bucket].append(key)
+        for bucket, keys in bucket2keys.items():
+            for d, group in group_by_directory(keys).items():
+                lookups.append(('sweep', bucket, group, True))
+    return lookups
+
+def iter_object_records(s3_locs, exact=None, dedupe=True, seen=None, **kwargs):
+    """
+    Yield a raw row of the object table (see records_to_table) for every object matched by s3_locs
+
+    If exact, s3_locs are objects; otherwise they are prefixes / wildcards. By default a string is treated as a
+    prefix / wildcard and a list is treated as a list of objects. Everything is looked up in one concurrent
+    pass, and rows are yielded as they are found. If dedupe, each object is only reported once (the objects
+    already reported are remembered in a SeenSet, which moves to disk once it gets big). Passing a SeenSet as seen
+    shares it between calls, so nothing any of them reported is reported again
+    """
+    s3_locs, exact = normalise_s3_locs(s3_locs, exact)
+
+    # Objects whose state can't have changed since they were last seen don't need to go to S3 at all
+    cached = []
+    cache = kwargs.get('status_cache')
+    if cache is not None:
+        cached, s3_locs = cache.split(s3_locs, exact)
+
+    jobs = []
+    for lookup in plan_lookups(s3_locs, exact):
+        if lookup[0] == 'sweep':
+            jobs.append((functools.partial(sweep, exact=lookup[3], **kwargs), lookup[1], lookup[2]))
+        else:
+            jobs.append((functools.partial(list_wildcard, **kwargs), lookup[1], lookup[2]))
+
+    own = dedupe and (seen is None)
+    if own:
+        seen = glrestore.manifests.SeenSet()
+    try:
+        for record in itertools.chain(cached, iter_concurrently(jobs, threads=kwargs.get('threads') or 32)):
+            if (seen is not None) and not seen.add(record['file']):
+                continue
+            glrestore.metrics.tick('objects_classified')
+            yield record
+    finally:
+        if own:
+            seen.close()
+
+def group_by_directory(keys):
+    """
+    Return a dictionary of directory -> keys in that directory
+    """
+    d2keys = defaultdict(list)
+    for key in keys:
+        d2keys[posixpath.dirname(key)].append(key)
+    return d2keys
+
+def needs_restore(cdb):
+    """
+    Return a mask of the rows of the object table that are archived and not restored (or being restored)
+    """
+    return (cdb['restore_status'] == 'not-restored') & cdb['storage_class'].isin(ARCHIVE_STORAGE_CLASSES)
 
-        table['file'].append(f)
-        table['storage_class'].append(sclass)
-        table['restore_status'].append(rclass)
+def records_to_table(records):
+    """
+    Make the object table from an iterable of raw rows
+
+    Raw rows have file, storage_class, size_bytes and LastModified, plus the restore state as either a Restore
+    header (restore_header, from HEAD) or restore_ongoing / restore_expiry (from listings). All of the parsing
+    is done on whole columns at once, and the table is stored compactly: categorical storage_class and
+    restore_status, int64 size_bytes, and datetime64 (UTC) LastModified and restore_expiry
+    """
+    records = list(records)
+    with glrestore.metrics.timer('build_table'):
+        return _records_to_table(records)
+
+def _records_to_table(records):
+    """
+    Make the object table from a list of raw rows (timed separately from fetching them)
+    """
+    raw = pd.DataFrame(records, columns=RAW_COLUMNS)
+
+    # Restore state from either the header or the listing
+    header = raw['restore_header'].astype('string')
+    ongoing = raw['restore_ongoing'].astype('boolean')
+    ongoing = ongoing.mask(header.notna(), header.str.contains('ongoing-request="true"', regex=False))
+    restore_status = pd.Series('not-restored', index=raw.index)
+    restore_status[ongoing.fillna(False).astype(bool)] = 'restoring'
+    restore_status[(~ongoing).fillna(False).astype(bool)] = 'restored'
+
+    header_expiry = pd.to_datetime(header.str.extract(r'expiry-date="([^"]+)"', expand=False),
+                                   format="%a, %d %b %Y %H:%M:%S GMT", utc=True)
+    restore_expiry = pd.to_datetime(raw['restore_expiry'], utc=True).fillna(header_expiry)
+
+    db = pd.DataFrame({
+        'file': raw['file'].astype(str),
+        'storage_class': raw['storage_class'].astype('category'),
+        'restore_status': pd.Categorical(restore_status, categories=RESTORE_STATUSES),
+        'LastModified': pd.to_datetime(raw['LastModified'], utc=True).dt.tz_convert(None),
+        'size_bytes': raw['size_bytes'].astype('int64'),
+        'restore_expiry': restore_expiry.dt.tz_convert(None),
+        'etag': raw['etag'].astype('string')})
+    return db
+
+def format_table(raw):
+    """
+    Give a DataFrame with the object table's columns (for example one read back from a --report CSV) the same
+    compact types records_to_table uses
+    """
+    return pd.DataFrame({
+        'file': raw['file'].astype(str),
+        'storage_class': raw['storage_class'].astype(str).astype('category'),
+        'restore_status': pd.Categorical(raw['restore_status'].astype(str), categories=RESTORE_STATUSES),
+        'LastModified': pd.to_datetime(raw['LastModified'], utc=True).dt.tz_convert(None),
+        'size_bytes': raw['size_bytes'].astype('int64'),
+        'restore_expiry': pd.to_datetime(raw['restore_expiry'], utc=True).dt.tz_convert(None),
+        'etag': raw['etag'].astype('string')})[TABLE_COLUMNS]
 
-        re_header = re['ResponseMetadata']['HTTPHeaders']
-        for name, rname in zip(['LastModified', 'size_bytes'], ['last-modified', 'content-length']):
-            if rname in re_header:
-                val = re_header[rname]
+def read_table(loc):
+    """
+    Read an object table written by --report (CSV, gzipped CSV or Parquet)
+    """
+    return format_table(glrestore.reports.read_raw(loc))
 
-                if name in ['LastModified']:
-                    val = datetime.datetime.strptime(val, "%a, %d %b %Y %H:%M:%S %Z")
+def iter_table_batches(records, batch_size=10000):
+    """
+    Yield object tables of up to batch_size rows from an iterable of raw rows
+    """
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield records_to_table(batch)
+            batch = []
+    if len(batch) > 0:
+        yield records_to_table(batch)
 
-                table[name].append(val)
+def get_object_storage_class_v2(s3_locs, extra_info=False, exact=None, **kwargs):
+    """
+    Return the storage class and restoring status of an s3_loc
 
-    db = pd.DataFrame(table)
-    db['size_bytes'] = db['size_bytes'].astype(float)
+    Uses ListObjectsV2 (which returns up to 1000 objects per request) and only falls back to HEAD for objects
+    that can't be found that way. See iter_object_records for what "exact" does
+    """
+    db = records_to_table(iter_object_records(s3_locs, exact=exact, **kwargs))
+
+    cache = kwargs.get('status_cache')
+    if cache is not None:
+        s3_locs, exact = normalise_s3_locs(s3_locs, exact)
+        cache.update(db, prefixes=None if exact else s3_locs)
     return db
 
 # def glacier_status(s3_loc, **kwargs):
@@ -174,7 +797,7 @@ def glacier_status_v2(s3_loc, **kwargs):
         return 'no-glacier'
 
     # Object is in glacier with no active restored
-    elif rclass == False:
+    elif rclass == 'not-restored':
         if sclass == 'GLACIER':
             return 'glacier-no-restore'
         elif sclass == 'DEEP_ARCHIVE':
@@ -208,21 +831,107 @@ def glacier_status_v2(s3_loc, **kwargs):
 #     db['size_bytes'] = db['size_bytes'].astype(float)
 #     return db
 
+def is_retryable_error(e):
+    """
+    Return True if the exception "e" is a throttling / 5xx / network error that should be retried
+    """
+    if isinstance(e, (ConnectionError, ReadTimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return (code in RETRYABLE_ERROR_CODES) or (status >= 500)
+    return False
+
+def backoff_delay(attempt, base_delay=0.5, max_delay=60):
+    """
+    Return how long to wait before retry number "attempt" (full-jitter exponential backoff)
+    """
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+def call_with_backoff(func, retries=8, base_delay=0.5, max_delay=60, **kwargs):
+    """
+    Call func(**kwargs), retrying throttling / 5xx errors with full-jitter exponential backoff
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(**kwargs)
+        except Exception as e:
+            if (attempt >= retries) or (not is_retryable_error(e)):
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logging.debug(f"Retrying {func.__name__} in {delay:.2f}s after {e}")
+            glrestore.metrics.count_retry(func.__name__)
+            time.sleep(delay)
+            attempt += 1
+
 def restore_file(f, **kwargs):
     """
     Restore "f" using the parameters in kwargs
-    """
-    client = get_boto3_client(**kwargs)
 
+    Returns "issued" if a new restore was started, "in-progress" if one was already running, and
+    "already-restored" if the object was already restored (S3 just extends the expiry in that case)
+    """
     obucket, okey = get_bucket_key(f)
+    client = get_client_for_bucket(obucket, **kwargs)
 
-    response = client.restore_object(
-        Bucket=obucket,
-        Key=okey,
-        RestoreRequest={
-            'Days': kwargs.get('days'),
-            'GlacierJobParameters': {
-             'Tier': str(kwargs.get('speed'))}})
+    try:
+        response = call_with_backoff(client.restore_object, retries=kwargs.get('retries', 8),
+            Bucket=obucket,
+            Key=okey,
+            RestoreRequest={
+                'Days': kwargs.get('days'),
+                'GlacierJobParameters': {
+                 'Tier': str(kwargs.get('speed'))}})
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'RestoreAlreadyInProgress':
+            return 'in-progress'
+        raise
 
     if kwargs.get('debug', False):
-        logging.debug(response)
\ No newline at end of file
+        logging.debug(response)
+
+    if response['ResponseMetadata']['HTTPStatusCode'] == 200:
+        return 'already-restored'
+    return 'issued'
+
+def restore_files(s3_locs, threads=32, on_failed=None, on_finished=None, scheduler=None, **kwargs):
+    """
+    Issue restore requests for all "s3_locs" using a pool of "threads" workers
+
+    Requests are spread across prefixes by a PrefixScheduler (see glrestore.scheduler), so one hot prefix backs
+    off on its own instead of stalling everything. "s3_locs" can be any iterable and is consumed lazily.
+    Returns a dictionary of status -> count and a list of (file, error message) for requests that failed. If
+    on_failed is given, it's called with (file, error message) for each failure instead of building that list.
+    on_finished, if given, is called with (file, status, exception) as each request finishes
+    """
+    import glrestore.scheduler
+
+    counts = defaultdict(int)
+    failed = []
+
+    if scheduler is None:
+        scheduler = glrestore.scheduler.PrefixScheduler(concurrency=threads, max_limit=kwargs.get('max_per_prefix'))
+
+    # The scheduler does the retrying, so it can tell which prefix is being throttled
+    func = functools.partial(restore_file, **dict(kwargs, retries=0))
+    for f, status, error in glrestore.scheduler.run_threaded(s3_locs, func, scheduler, retries=kwargs.get('retries', 8)):
+        glrestore.metrics.tick('restores_finished')
+        if on_finished is not None:
+            on_finished(f, status, error)
+        if error is None:
+            counts[status] += 1
+            continue
+
+        logging.debug(f"Restore of {f} failed: {error}")
+        counts['failed'] += 1
+        if on_failed is not None:
+            on_failed(f, str(error))
+        else:
+            failed.append((f, str(error)))
+
+    if scheduler.throttles > 0:
+        logging.info(f"S3 throttled {scheduler.throttles} restore requests; the busiest prefixes were:")
+        scheduler.log_stats(level=logging.INFO)
+    return counts, failed
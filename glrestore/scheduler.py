@@ -0,0 +1,294 @@
+"""
+Spread requests across S3 prefixes, with each prefix's concurrency adapting to how hard S3 is pushing back
+
+S3 throttles per prefix (503 SlowDown), so rather than letting a pool of workers pile onto one hot prefix and
+spend its time in retries, each prefix gets an AIMD (additive increase, multiplicative decrease) limit on the
+requests it can have in flight, and ready prefixes take turns
+"""
+
+import time
+import queue
+import logging
+import posixpath
+import concurrent.futures
+
+from collections import deque
+from botocore.exceptions import ClientError
+
+import glrestore.metrics
+import glrestore.s3_utils
+
+# Error codes that mean "this prefix is getting too many requests"
+THROTTLE_ERROR_CODES = set(['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                            'TooManyRequests'])
+
+def is_throttle_error(e):
+    """
+    Return True if the exception "e" means S3 wants fewer requests (as opposed to some other retryable error)
+    """
+    if isinstance(e, ClientError):
+        code = e.response.get('Error', {}).get('Code')
+        status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return (code in THROTTLE_ERROR_CODES) or (status == 503)
+    return False
+
+def prefix_of(f):
+    """
+    Return the prefix S3 would throttle f under; we use the bucket and directory
+    """
+    bucket, key = glrestore.s3_utils.get_bucket_key(f)
+    return f"s3://{bucket}/{posixpath.dirname(key)}"
+
+class PrefixState(object):
+    """
+    The queue, concurrency limit and counters of one prefix
+    """
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.queue = deque()
+        self.resume_at = 0
+        self.throttle_streak = 0
+
+        self.completed = 0
+        self.throttled = 0
+        self.failed = 0
+        self.recent = deque()
+
+class PrefixScheduler(object):
+    """
+    Decides which request goes next. Knows nothing about threads or asyncio, so both engines share it
+
+    Every prefix starts out allowed "initial_limit" requests in flight. Each success adds 1 / limit (so about one
+    more per round of requests), up to "max_limit"; each throttle multiplies the limit by "decrease" and pauses
+    the prefix for a jittered backoff. Prefixes with work take turns, and no more than "concurrency" requests are
+    in flight overall
+    """
+    def __init__(self, concurrency=32, initial_limit=4, max_limit=None, decrease=0.5, max_buffered=10000,
+                 rate_window=60, prefix_of=prefix_of):
+        self.concurrency = concurrency
+        self.initial_limit = min(initial_limit, concurrency)
+        self.max_limit = max_limit or concurrency
+        self.decrease = decrease
+        self.max_buffered = max(max_buffered, concurrency * 2)
+        self.rate_window = rate_window
+        self.prefix_of = prefix_of
+
+        self.prefixes = {}
+        self.ready = deque()
+        self.in_flight = 0
+        self.buffered = 0
+        self.throttles = 0
+        self.retries = 0
+
+    def _state(self, prefix):
+        if prefix not in self.prefixes:
+            self.prefixes[prefix] = PrefixState(self.initial_limit)
+        return self.prefixes[prefix]
+
+    def can_add(self):
+        """
+        Return True if there's room to buffer another item
+        """
+        return self.buffered < self.max_buffered
+
+    def add(self, item, attempt=0, front=False):
+        """
+        Queue an item (attempt is how many times it has already been tried)
+        """
+        prefix = self.prefix_of(item)
+        state = self._state(prefix)
+        if len(state.queue) == 0:
+            self.ready.append(prefix)
+        if front:
+            state.queue.appendleft((item, attempt))
+        else:
+            state.queue.append((item, attempt))
+        self.buffered += 1
+
+    def next_ready(self, now):
+        """
+        Return the next (item, attempt) to send, or None if nothing can go right now
+        """
+        if self.in_flight >= self.concurrency:
+            return None
+
+        for _ in range(len(self.ready)):
+            prefix = self.ready.popleft()
+            state = self.prefixes[prefix]
+            if (state.in_flight >= int(state.limit)) or (state.resume_at > now):
+                self.ready.append(prefix)
+                continue
+
+            item, attempt = state.queue.popleft()
+            if len(state.queue) > 0:
+                self.ready.append(prefix)
+            state.in_flight += 1
+            self.in_flight += 1
+            self.buffered -= 1
+            return item, attempt
+        return None
+
+    def _finished(self, item):
+        state = self.prefixes[self.prefix_of(item)]
+        state.in_flight -= 1
+        self.in_flight -= 1
+        return state
+
+    def succeeded(self, item, now):
+        """
+        Record that a request for item worked
+        """
+        state = self._finished(item)
+        state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+        state.throttle_streak = 0
+        state.completed += 1
+        state.recent.append(now)
+        while (len(state.recent) > 0) and (state.recent[0] < now - self.rate_window):
+            state.recent.popleft()
+
+    def throttled(self, item, attempt, now):
+        """
+        Record that S3 throttled the request for item, and queue it to go again once the prefix has backed off
+        """
+        state = self._finished(item)
+        state.limit = max(1.0, state.limit * self.decrease)
+        state.resume_at = max(state.resume_at, now + glrestore.s3_utils.backoff_delay(state.throttle_streak))
+        state.throttle_streak += 1
+        state.throttled += 1
+        self.throttles += 1
+        self.add(item, attempt + 1, front=True)
+
+    def retry(self, item, attempt, now):
+        """
+        Queue item to go again after some other retryable error, without changing the prefix's limit
+        """
+        state = self._finished(item)
+        state.resume_at = max(state.resume_at, now + glrestore.s3_utils.backoff_delay(attempt))
+        self.retries += 1
+        self.add(item, attempt + 1, front=True)
+
+    def failed(self, item):
+        """
+        Record that the request for item failed for good
+        """
+        self._finished(item).failed += 1
+
+    def idle(self):
+        """
+        Return True if nothing is queued or in flight
+        """
+        return (self.buffered == 0) and (self.in_flight == 0)
+
+    def next_wakeup(self, now):
+        """
+        Return the soonest time a paused prefix with queued items can go again (or None)
+        """
+        times = [self.prefixes[p].resume_at for p in self.ready if self.prefixes[p].resume_at > now]
+        return min(times) if len(times) > 0 else None
+
+    def stats(self, now=None):
+        """
+        Return a dictionary of prefix -> live statistics (limit, in flight, queued, completed, throttled, failed,
+        and requests per second over the last rate_window seconds)
+        """
+        if now is None:
+            now = time.time()
+        stats = {}
+        for prefix, state in self.prefixes.items():
+            recent = [t for t in state.recent if t >= now - self.rate_window]
+            stats[prefix] = {'limit': state.limit, 'in_flight': state.in_flight, 'queued': len(state.queue),
+                             'completed': state.completed, 'throttled': state.throttled, 'failed': state.failed,
+                             'rate': len(recent) / self.rate_window}
+        return stats
+
+    def log_stats(self, now=None, top=5, level=logging.DEBUG):
+        """
+        Log the busiest prefixes
+        """
+        stats = self.stats(now)
+        busiest = sorted(stats.items(), key=lambda x: (x[1]['rate'], x[1]['completed']), reverse=True)[:top]
+        for prefix, s in busiest:
+            logging.log(level, f"{prefix}: {s['rate']:.1f} requests/s, limit {s['limit']:.1f}, {s['in_flight']} in flight, {s['queued']} queued, {s['completed']} done, {s['throttled']} throttled, {s['failed']} failed")
+
+def handle_outcome(scheduler, item, attempt, error, retries, now, api='RestoreObject'):
+    """
+    Tell the scheduler how a request (to "api") went; return True if it's finished (worked or failed for good)
+    """
+    if error is None:
+        scheduler.succeeded(item, now)
+        return True
+    if (attempt < retries) and glrestore.s3_utils.is_retryable_error(error):
+        glrestore.metrics.count_retry(api)
+        if is_throttle_error(error):
+            scheduler.throttled(item, attempt, now)
+        else:
+            scheduler.retry(item, attempt, now)
+        return False
+    scheduler.failed(item)
+    return True
+
+def run_threaded(items, func, scheduler, retries=8, stats_interval=60):
+    """
+    Call func(item) for every item in a pool of scheduler.concurrency threads, in the order the scheduler picks
+
+    func shouldn't retry anything itself; retryable errors are retried here (up to "retries" times per item)
+    so throttling can slow down the right prefix. Yields (item, result, exception) as each item finishes.
+    "items" can be any iterable and is consumed lazily
+    """
+    results = queue.Queue()
+    items = iter(items)
+    exhausted = False
+    last_stats = time.time()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=scheduler.concurrency) as executor:
+        while True:
+            # Top up the buffer (a round of requests at a time, so sending isn't held up by a slow iterable)
+            for _ in range(scheduler.concurrency):
+                if exhausted or not scheduler.can_add():
+                    break
+                try:
+                    scheduler.add(next(items))
+                except StopIteration:
+                    exhausted = True
+
+            now = time.time()
+            while True:
+                ready = scheduler.next_ready(now)
+                if ready is None:
+                    break
+                item, attempt = ready
+                future = executor.submit(func, item)
+                future.add_done_callback(lambda fu, item=item, attempt=attempt: results.put((item, attempt, fu)))
+
+            if exhausted and scheduler.idle():
+                break
+
+            if now - last_stats > stats_interval:
+                scheduler.log_stats(now)
+                last_stats = now
+
+            # Wait for something to finish, or for a paused prefix to be allowed to go again
+            wakeup = scheduler.next_wakeup(now)
+            if scheduler.in_flight == 0:
+                if wakeup is not None:
+                    time.sleep(max(0, wakeup - now))
+                continue
+            timeout = None if wakeup is None else max(0.001, wakeup - now)
+            if (timeout is None) and (not exhausted) and scheduler.can_add():
+                timeout = 0.001
+            try:
+                finished = [results.get(timeout=timeout)]
+            except queue.Empty:
+                continue
+            while True:
+                try:
+                    finished.append(results.get_nowait())
+                except queue.Empty:
+                    break
+
+            now = time.time()
+            for item, attempt, future in finished:
+                error = future.exception()
+                if handle_outcome(scheduler, item, attempt, error, retries, now):
+                    yield item, (future.result() if error is None else None), error
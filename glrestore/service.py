@@ -0,0 +1,352 @@
+"""
+A long-running restore service (--serve) that many clients share (--connect)
+
+The service keeps its boto3 clients and status cache warm between requests and keeps one table of every object it
+has been asked about. A restore request for an object that some other client already asked for isn't sent to S3
+again; it just joins the existing restore. One poller checks everything that's restoring, and wakes every client
+waiting on an object when it's restored
+
+Clients talk to it with JSON over HTTP, on a Unix socket (--socket) or on localhost (--port):
+    POST /restore {"files": [...], "speed": "Bulk", "days": 7} -> {"objects": {file: status}, "counts": {...}}
+    POST /wait {"files": [...], "timeout": 60} -> {"objects": {file: status}, "pending": n}
+    GET /stats -> what the service has done so far
+
+The client side only needs the standard library, so "glrestore --connect" starts quickly
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import threading
+import http.client
+import http.server
+import socketserver
+
+from collections import defaultdict
+
+# Statuses of objects in the service's table that are still waiting on S3
+PENDING_STATUSES = set(['requested', 'restoring'])
+
+def default_socket_location():
+    """
+    Where the service listens unless --socket or --port say otherwise
+    """
+    return os.path.join(os.path.expanduser('~'), '.glrestore', 'glrestore.sock')
+
+class RestoreService(object):
+    """
+    The shared state of the service: the table of objects (file -> status) and the poller that keeps it current
+
+    Statuses are "requested" (a restore request is being sent), "restoring", "restored", "available" (not
+    archived), "not-restored" (a restore that finished without the object being restored, e.g. it expired) and
+    "failed"
+    """
+    def __init__(self, classify, poll_interval=300, **kwargs):
+        """
+        "classify" is a function that takes a list of s3 locations (objects, prefixes or wildcards) and returns
+        their object table
+        """
+        import glrestore.polling
+
+        self.classify = classify
+        self.poll_interval = poll_interval
+        self.kwargs = kwargs
+
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.objects = {}
+        self.errors = {}
+        self.stats = defaultdict(int)
+
+        # The poller only runs on its own thread; new restores are handed to it through to_poll
+        self.to_poll = []
+        self.poller = glrestore.polling.RestorePoller([], classify, interval=poll_interval, on_restored=self._restored)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._poll_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def expand(self, entries):
+        """
+        Return the s3 locations in -f style entries (s3 locations and manifests)
+        """
+        import glrestore.manifests
+        return list(glrestore.manifests.ManifestReader(entries, **self.kwargs))
+
+    def restore(self, entries, speed=None, days=None):
+        """
+        Make sure everything in entries is restored (or being restored); returns (file -> status, counts)
+
+        Objects this service already knows are being restored aren't checked or requested again
+        """
+        import glrestore.s3_utils
+
+        s3_locs = self.expand(entries)
+        with self.lock:
+            self.stats['requests'] += 1
+            known = [f for f in s3_locs if self.objects.get(f) in PENDING_STATUSES]
+            to_check = [f for f in s3_locs if self.objects.get(f) not in PENDING_STATUSES]
+
+        statuses = {}
+        counts = defaultdict(int)
+        counts['coalesced'] += len(known)
+        to_issue = []
+        if len(to_check) > 0:
+            cdb = self.classify(to_check, exact=False)
+            archived = cdb['storage_class'].isin(glrestore.s3_utils.ARCHIVE_STORAGE_CLASSES).tolist()
+            restoring = []
+            with self.lock:
+                for f, is_archived, status in zip(cdb['file'].tolist(), archived, cdb['restore_status'].astype(str).tolist()):
+                    if not is_archived:
+                        self.objects[f] = 'available'
+                    elif status == 'not-restored':
+                        if self.objects.get(f) in PENDING_STATUSES:
+                            # Another client asked for it since it was classified
+                            counts['coalesced'] += 1
+                            continue
+                        self.objects[f] = 'requested'
+                        to_issue.append(f)
+                    else:
+                        self.objects[f] = status
+                        if status == 'restoring':
+                            restoring.append(f)
+                    statuses[f] = self.objects[f]
+                self.to_poll.extend(restoring)
+                self.stats['objects_checked'] += len(cdb)
+
+        if len(to_issue) > 0:
+            kwargs = dict(self.kwargs, speed=speed or self.kwargs.get('speed'), days=days or self.kwargs.get('days'))
+            counts.update(glrestore.s3_utils.restore_files(to_issue, on_finished=self._requested, **kwargs)[0])
+
+        with self.lock:
+            self.stats['restores_issued'] += counts.get('issued', 0)
+            self.stats['coalesced'] += counts['coalesced']
+            for f in known + to_issue:
+                statuses[f] = self.objects[f]
+        return statuses, dict(counts)
+
+    def _requested(self, f, status, error):
+        with self.lock:
+            if error is not None:
+                self.objects[f] = 'failed'
+                self.errors[f] = str(error)
+            elif status == 'already-restored':
+                self.objects[f] = 'restored'
+            else:
+                self.objects[f] = 'restoring'
+                self.to_poll.append(f)
+            self.changed.notify_all()
+
+    def _restored(self, files):
+        with self.lock:
+            for f in files:
+                self.objects[f] = 'restored'
+            self.changed.notify_all()
+
+    def poll(self):
+        """
+        Check the objects that are restoring (see RestorePoller.poll) and wake whoever is waiting on them
+        """
+        with self.lock:
+            self.poller.remaining.update(self.to_poll)
+            self.to_poll = []
+        before = set(self.poller.remaining)
+        if len(before) == 0:
+            return
+
+        self.poller.poll()
+        with self.lock:
+            self.stats['polls'] += 1
+            for f in before - self.poller.remaining:
+                if self.objects.get(f) == 'restoring':
+                    self.objects[f] = 'not-restored'
+            self.changed.notify_all()
+
+    def _poll_forever(self):
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as e:
+                logging.error(f"Polling failed: {e}")
+
+    def wait(self, files, timeout=None):
+        """
+        Wait (up to timeout seconds) for none of files to be pending; returns (file -> status, number still pending)
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self.lock:
+            while True:
+                pending = sum(1 for f in files if self.objects.get(f) in PENDING_STATUSES)
+                left = None if end is None else end - time.time()
+                if (pending == 0) or ((left is not None) and (left <= 0)):
+                    break
+                self.changed.wait(left)
+            statuses = dict((f, self.objects.get(f, 'unknown')) for f in files)
+        return statuses, pending
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['objects'] = len(self.objects)
+            stats['pending'] = sum(1 for s in self.objects.values() if s in PENDING_STATUSES)
+        return stats
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers the JSON requests of one client connection
+    """
+    service = None
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.reply(200, self.service.get_stats())
+        else:
+            self.reply(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if self.path == '/restore':
+                statuses, counts = self.service.restore(body.get('files', []), speed=body.get('speed'), days=body.get('days'))
+                self.reply(200, {'objects': statuses, 'counts': counts,
+                                 'errors': dict((f, self.service.errors[f]) for f in statuses if f in self.service.errors)})
+            elif self.path == '/wait':
+                statuses, pending = self.service.wait(body.get('files', []), timeout=body.get('timeout'))
+                self.reply(200, {'objects': statuses, 'pending': pending})
+            else:
+                self.reply(404, {'error': f"Unknown path {self.path}"})
+        except Exception as e:
+            logging.error(f"Request to {self.path} failed: {e}")
+            self.reply(500, {'error': str(e)})
+
+    def reply(self, code, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+def make_server(service, socket_loc=None, port=None):
+    """
+    Return an HTTP server for service on localhost:port, or on the Unix socket socket_loc
+    """
+    handler = type('Handler', (ServiceHandler,), {'service': service})
+    if port is not None:
+        return http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+
+    if os.path.dirname(socket_loc) != '':
+        os.makedirs(os.path.dirname(socket_loc), exist_ok=True)
+    if os.path.exists(socket_loc):
+        os.remove(socket_loc)
+    return UnixHTTPServer(socket_loc, handler)
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_loc, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_loc = socket_loc
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_loc)
+
+class ServiceClient(object):
+    """
+    Talks to a service at address: a Unix socket, or http://host:port
+    """
+    def __init__(self, address):
+        self.address = address
+
+    def connection(self):
+        if self.address.startswith('http://'):
+            return http.client.HTTPConnection(self.address[len('http://'):].rstrip('/'))
+        return UnixHTTPConnection(self.address)
+
+    def call(self, method, path, payload=None):
+        conn = self.connection()
+        try:
+            conn.request(method, path, body=None if payload is None else json.dumps(payload),
+                         headers={'Content-Type': 'application/json'})
+            response = conn.getresponse()
+            result = json.loads(response.read())
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise Exception(f"The glrestore service at {self.address} said: {result.get('error')}")
+        return result
+
+    def restore(self, files, speed=None, days=None):
+        return self.call('POST', '/restore', {'files': files, 'speed': speed, 'days': days})
+
+    def wait(self, files, timeout=None):
+        return self.call('POST', '/wait', {'files': files, 'timeout': timeout})
+
+    def stats(self):
+        return self.call('GET', '/stats')
+
+def client_entries(files):
+    """
+    Return -f entries the service can read: stdin is read here, and local manifests get absolute paths
+    """
+    entries = []
+    for f in files:
+        if f == '-':
+            entries.extend(line.strip() for line in sys.stdin if line.strip() != '')
+        elif f.startswith('s3://') or f.startswith('@'):
+            entries.append(f)
+        else:
+            entries.append(os.path.abspath(f))
+    return entries
+
+def run_client(args, wait_interval=60):
+    """
+    Send a restore to the service at args.connect (and wait for it with --wait); returns the exit code
+    """
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    client = ServiceClient(args.connect)
+
+    result = client.restore(client_entries(args.files), speed=args.speed, days=args.days)
+    objects = result['objects']
+    counts = defaultdict(int, result['counts'])
+    by_status = defaultdict(int)
+    for status in objects.values():
+        by_status[status] += 1
+    logging.info(f"The service has {len(objects)} objects: {by_status['available']} not archived, {by_status['restored']} restored, {by_status['restoring'] + by_status['requested']} restoring ({counts['issued']} newly requested, {counts['coalesced']} already requested by another client) and {by_status['failed']} failed")
+    for f, error in list(result['errors'].items())[:1]:
+        logging.error(f"{by_status['failed']} restore requests failed (for example {f}: {error})")
+
+    if args.wait:
+        start = time.time()
+        files = [f for f, status in objects.items() if status in PENDING_STATUSES]
+        while len(files) > 0:
+            result = client.wait(files, timeout=wait_interval)
+            files = [f for f, status in result['objects'].items() if status in PENDING_STATUSES]
+            objects.update(result['objects'])
+            sys.stdout.write('\r')
+            sys.stdout.write(f'Ive been waiting for {time.strftime("%Hh%Mm%Ss", time.gmtime(time.time() - start))}: {len(files)} files remain')
+            sys.stdout.flush()
+        print(f'All done! The restore took {time.strftime("%Hh%Mm%Ss", time.gmtime(time.time() - start))}')
+
+    return 1 if any(status == 'failed' for status in objects.values()) else 0
@@ -0,0 +1,156 @@
+"""
+Split one restore into shards that can run in separate processes or on separate machines, and merge their reports
+"""
+
+import os
+import copy
+import zlib
+import bisect
+import logging
+import multiprocessing
+import concurrent.futures
+
+import pandas as pd
+
+import glrestore.reports
+import glrestore.s3_utils
+
+def parse_shard(shard):
+    """
+    Turn "i/N" into (i, N). Shards are numbered from 0, so the shards of a 4-way split are 0/4, 1/4, 2/4 and 3/4
+    """
+    try:
+        i, n = [int(x) for x in shard.split('/')]
+    except (ValueError, AttributeError):
+        raise Exception(f"--shard needs to look like i/N (for example 0/4), not {shard}")
+    if (n < 1) or (i < 0) or (i >= n):
+        raise Exception(f"--shard {shard} is out of range; i needs to be between 0 and N - 1")
+    return i, n
+
+def shard_name(loc, i, n):
+    """
+    Return the per-shard version of an output location (glrestore_report.csv -> glrestore_report.shard0of4.csv)
+    """
+    base, ext = os.path.splitext(loc)
+    # Keep compound extensions like .csv.gz together
+    if ext == '.gz':
+        base, inner = os.path.splitext(base)
+        ext = inner + ext
+    return f"{base}.shard{i}of{n}{ext}"
+
+def key_shard(f, n):
+    """
+    Return the shard an object belongs to. Uses CRC32 of the whole s3 location, so it is the same on every machine
+    """
+    return zlib.crc32(f.encode()) % n
+
+def hash_s3_locs(s3_locs, i, n):
+    """
+    Return the -f entries shard i of n looks up in "hash" mode, and the ones it owns outright
+
+    An entry that looks like a single object (no trailing "/" and no wildcard) is owned by the shard its location
+    hashes to, so no other shard looks it up. Prefixes and wildcards are listed by every shard, each keeping the
+    objects that hash to it (see owns). The owned entries are returned sorted, without ones under another
+    """
+    locs = []
+    owned = []
+    for loc in s3_locs:
+        if loc.endswith('/') or glrestore.s3_utils.has_wildcard(loc):
+            locs.append(loc)
+        elif key_shard(loc, n) == i:
+            locs.append(loc)
+            owned.append(loc)
+
+    kept = []
+    for loc in sorted(owned):
+        if (len(kept) == 0) or (not loc.startswith(kept[-1])):
+            kept.append(loc)
+    return locs, kept
+
+def owns(f, i, n, owned=None):
+    """
+    Return True if object f belongs to shard i of n: it hashes to the shard, or it's under one of the shard's
+    owned entries (see hash_s3_locs), so an entry that turns out to be a prefix is handled whole by one shard
+    """
+    if key_shard(f, n) == i:
+        return True
+    if not owned:
+        return False
+    j = bisect.bisect_right(owned, f) - 1
+    return (j >= 0) and f.startswith(owned[j])
+
+def shard_mask(cdb, i, n, owned=None):
+    """
+    Return a boolean mask of the rows of the object table that belong to shard i of n (see owns)
+    """
+    return cdb['file'].map(lambda f: owns(f, i, n, owned)).astype(bool)
+
+def shard_s3_locs(s3_locs, i, n):
+    """
+    Return the s3_locs (prefixes / wildcards) that belong to shard i of n in "prefix" mode
+
+    The entries are deduplicated (dropping ones that fall under a shorter prefix, so no object is found by two
+    shards) and sorted, and each shard gets one contiguous range of them
+    """
+    locs = []
+    for bucket, (prefixes, wildcards) in sorted(glrestore.s3_utils.plan_s3_locs(s3_locs).items()):
+        locs.extend(f"s3://{bucket}/{p}" for p in sorted(prefixes + wildcards))
+
+    start = (len(locs) * i) // n
+    end = (len(locs) * (i + 1)) // n
+    return locs[start:end]
+
+def read_reports(locs):
+    """
+    Return one object table made from the reports at locs, dropping objects reported by more than one shard
+    """
+    tables = [glrestore.reports.read_raw(loc) for loc in locs]
+    raw = pd.concat(tables, ignore_index=True) if len(tables) > 0 else pd.DataFrame(columns=glrestore.s3_utils.TABLE_COLUMNS)
+    raw = raw.drop_duplicates(subset=['file'], keep='first').reset_index(drop=True)
+    return glrestore.s3_utils.format_table(raw)
+
+def run_shard(args, i, n):
+    """
+    Run shard i of n of a restore in this process, and return a summary of what it did
+
+    Used by run_local_shards; each process gets its own report / failed file
+    """
+    import glrestore.glrestore
+
+    args = copy.deepcopy(args)
+    args.shard = f"{i}/{n}"
+    args.processes = 1
+    args.failed = shard_name(args.failed, i, n)
+    args.shard_worker = True
+    if getattr(args, 'metrics_out', None) is not None:
+        args.metrics_out = shard_name(args.metrics_out, i, n)
+    if getattr(args, 'journal', None) is not None:
+        args.journal = shard_name(args.journal, i, n)
+    # Hash shards are even, so they can split the budget (and the download rate and waves) evenly
+    if getattr(args, 'budget', None) is not None:
+        args.budget = args.budget / n
+    if getattr(args, 'download_rate', None) is not None:
+        args.download_rate = args.download_rate / n
+    if getattr(args, 'wave_bytes', None) is not None:
+        args.wave_bytes = max(1, args.wave_bytes // n)
+    if getattr(args, 'wave_objects', None) is not None:
+        args.wave_objects = max(1, args.wave_objects // n)
+
+    RC = glrestore.glrestore.RestoreController(args)
+    RC.main()
+    return {'shard': i, 'totals': vars(RC.totals) if RC.totals is not None else None,
+            'counts': dict(RC.restore_counts), 'report': RC.report_loc, 'failed': RC.num_failed}
+
+def run_local_shards(args, n):
+    """
+    Run n shards of a restore in parallel, in a pool of n local processes; returns the shard summaries in order
+
+    Processes are started fresh ("spawn") rather than forked, since boto3 clients aren't safe to share
+    """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n, mp_context=context) as executor:
+        futures = [executor.submit(run_shard, args, i, n) for i in range(n)]
+        summaries = []
+        for future in futures:
+            summaries.append(future.result())
+    return summaries
@@ -0,0 +1,80 @@
+"""
+Restore in waves (--wave-bytes / --wave-objects): each wave is restored and waited on (and handed to --wave-hook)
+before the next is requested, so only one wave's restored copies are paid for at a time and the restore queue
+gets a steady stream of work rather than everything at once
+"""
+
+import os
+import logging
+import tempfile
+import subprocess
+
+# Size suffixes for --wave-bytes (decimal, like AWS prices; "i" for binary)
+SIZE_UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'P': 1e15,
+              'KI': 1024, 'MI': 1024 ** 2, 'GI': 1024 ** 3, 'TI': 1024 ** 4, 'PI': 1024 ** 5}
+
+def parse_size(text):
+    """
+    Return the number of bytes in a size like "20TB", "500G", "1.5TiB" or "1000000"
+    """
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    number = text.rstrip('KMGTPI')
+    unit = text[len(number):]
+    if (unit not in SIZE_UNITS) or (number == ''):
+        raise ValueError(f"Can't understand the size {text}; use something like 20TB, 500GB or 1.5TiB")
+    return int(float(number) * SIZE_UNITS[unit])
+
+def split_waves(groups, sizes=None, max_bytes=None, max_objects=None):
+    """
+    Split [(tier, files)] into waves of at most max_bytes (going by sizes, a dictionary of file -> bytes) and
+    max_objects objects, keeping the order. Returns a list of waves, each in the form [(tier, files)]
+
+    An object bigger than max_bytes gets a wave of its own
+    """
+    waves = []
+    wave = []
+    wave_bytes = 0
+    wave_objects = 0
+    for tier, files in groups:
+        for f in files:
+            size = sizes.get(f, 0) if sizes is not None else 0
+            full = ((max_objects is not None) and (wave_objects + 1 > max_objects)) or \
+                   ((max_bytes is not None) and (wave_bytes + size > max_bytes))
+            if full and (wave_objects > 0):
+                waves.append(wave)
+                wave = []
+                wave_bytes = 0
+                wave_objects = 0
+
+            if (len(wave) == 0) or (wave[-1][0] != tier):
+                wave.append((tier, []))
+            wave[-1][1].append(f)
+            wave_bytes += size
+            wave_objects += 1
+    if wave_objects > 0:
+        waves.append(wave)
+    return waves
+
+def run_hook(cmd, wave, num_waves, files, num_bytes=None):
+    """
+    Run the --wave-hook cmd (with a shell) once wave (1-based) of num_waves is restored. The hook gets the wave in
+    GLRESTORE_WAVE / GLRESTORE_WAVES and a file listing its objects in GLRESTORE_WAVE_FILES; the next wave is only
+    restored once it exits successfully
+    """
+    with tempfile.NamedTemporaryFile('w', prefix=f'glrestore_wave_{wave}_', suffix='.txt', delete=False) as o:
+        for f in files:
+            o.write(f + '\n')
+    env = dict(os.environ, GLRESTORE_WAVE=str(wave), GLRESTORE_WAVES=str(num_waves), GLRESTORE_WAVE_FILES=o.name,
+               GLRESTORE_WAVE_OBJECTS=str(len(files)))
+    if num_bytes is not None:
+        env['GLRESTORE_WAVE_BYTES'] = str(num_bytes)
+
+    logging.info(f"Running the wave hook for wave {wave} of {num_waves}: {cmd}")
+    try:
+        code = subprocess.run(cmd, shell=True, env=env).returncode
+    finally:
+        os.remove(o.name)
+    if code != 0:
+        raise Exception(f"The wave hook exited with {code} after wave {wave} of {num_waves}, so the rest weren't restored (re-run, or --resume with a --journal, to carry on)")
@@ -18,8 +18,13 @@ setup(name='glrestore',
       install_requires=[
           'awscli',
           'boto3',
-          'awswrangler'
+          'pandas'
       ],
+      extras_require={
+          'asyncio': ['aiobotocore'],
+          'zstd': ['zstandard'],
+          'parquet': ['pyarrow'],
+      },
       entry_points={
             'console_scripts': [
                   'glrestore=glrestore.glrestore:main',
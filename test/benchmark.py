@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+"""
+Benchmarks for glrestore against an in-process S3 stand-in (moto); no AWS account needed
+
+Seeds a bucket with a mix of STANDARD / GLACIER / DEEP_ARCHIVE objects in different restore states, then times
+each phase of a restore (wildcard expansion, classification, restoring, --wait polling cycles and report writing)
+and records the wall time, S3 requests and peak RSS of each one in a JSON file that can be compared between
+versions:
+
+    $ python benchmark.py --sizes 1000,100000 -o results.json
+    $ python benchmark.py --sizes 1000,100000 -o new.json --compare results.json
+
+Each size runs in its own process so peak RSS isn't shared between them. 1M objects needs several GB of memory
+for moto alone, and takes a while
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import platform
+import resource
+import tempfile
+import subprocess
+
+from collections import defaultdict
+
+BUCKET = 'glrestore-benchmark'
+OBJECTS_PER_DIRECTORY = 1000
+
+# (storage class, fraction of objects)
+STORAGE_CLASS_MIX = [('STANDARD', 0.4), ('GLACIER', 0.4), ('DEEP_ARCHIVE', 0.2)]
+
+# Of the archived objects, the fraction already restored and the fraction being restored
+RESTORED_FRACTION = 0.2
+RESTORING_FRACTION = 0.1
+
+# --wait cycles: the fraction of the objects being restored that finish between polls
+FINISHED_PER_POLL = 0.25
+
+def peak_rss_mb():
+    """
+    Return the peak resident set size of this process so far, in MB
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS bytes
+    return peak / 1024 if sys.platform != 'darwin' else peak / (1024 * 1024)
+
+class Benchmark(object):
+    """
+    Seeds moto and times each phase of a restore of "num_objects" objects
+    """
+    def __init__(self, num_objects, seed=0):
+        self.num_objects = num_objects
+        self.random = random.Random(seed)
+        self.requests = defaultdict(int)
+        self.phases = {}
+        self.restoring = []
+
+    def count_request(self, model, **kwargs):
+        self.requests[model.name] += 1
+
+    def add_restore_status(self, parsed, **kwargs):
+        """
+        moto doesn't support OptionalObjectAttributes=['RestoreStatus'], so fill it in from its backend
+        """
+        for entry in parsed.get('Contents', []):
+            key = self.backend.get_object(BUCKET, entry['Key'])
+            # moto's own "status" moves itself along as it's read, so this benchmark keeps its own in _status
+            if key._expiry is not None:
+                entry['RestoreStatus'] = {'IsRestoreInProgress': key._status == 'IN_PROGRESS'}
+                if key._status != 'IN_PROGRESS':
+                    entry['RestoreStatus']['RestoreExpiryDate'] = key._expiry.replace(tzinfo=datetime.timezone.utc)
+
+    def seed(self):
+        """
+        Put the objects straight into moto's backend (going through the API would take far longer than the benchmark)
+        """
+        from moto.core import DEFAULT_ACCOUNT_ID
+        from moto.s3.models import s3_backends
+
+        self.backend = s3_backends[DEFAULT_ACCOUNT_ID]['aws']
+        self.backend.create_bucket(BUCKET, 'us-east-1')
+
+        classes = [c for c, f in STORAGE_CLASS_MIX]
+        weights = [f for c, f in STORAGE_CLASS_MIX]
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        for i in range(self.num_objects):
+            key = f"data/d{i // OBJECTS_PER_DIRECTORY:05d}/part-{i:08d}.dat"
+            storage = self.random.choices(classes, weights)[0]
+            fake = self.backend.put_object(BUCKET, key, b'x' * self.random.randint(1, 1000), storage=storage)
+
+            if storage != 'STANDARD':
+                r = self.random.random()
+                if r < RESTORED_FRACTION:
+                    fake._expiry = now + datetime.timedelta(days=7)
+                elif r < RESTORED_FRACTION + RESTORING_FRACTION:
+                    fake._expiry = now + datetime.timedelta(days=7)
+                    fake._status = 'IN_PROGRESS'
+                    self.restoring.append(f"s3://{BUCKET}/{key}")
+
+    def phase(self, name, func):
+        """
+        Run func as phase "name", recording its wall time, S3 requests and the peak RSS so far
+        """
+        self.requests.clear()
+        start = time.perf_counter()
+        result = func()
+        self.phases[name] = {'seconds': time.perf_counter() - start, 'requests': dict(self.requests),
+                             'total_requests': sum(self.requests.values()), 'peak_rss_mb': peak_rss_mb()}
+        print(f"{self.num_objects} objects - {name}: {self.phases[name]['seconds']:.2f}s, {self.phases[name]['total_requests']} requests, {self.phases[name]['peak_rss_mb']:.0f}MB peak RSS", file=sys.stderr)
+        return result
+
+    def finish_some(self, seconds):
+        """
+        Stand-in for time.sleep while waiting: some of the objects being restored finish
+        """
+        still = [f for f in self.restoring if self.backend.get_object(BUCKET, f.split(BUCKET + '/')[1])._status == 'IN_PROGRESS']
+        for f in self.random.sample(still, max(1, int(len(still) * FINISHED_PER_POLL)) if len(still) > 0 else 0):
+            self.backend.get_object(BUCKET, f.split(BUCKET + '/')[1])._status = 'RESTORED'
+
+    def run(self, workdir):
+        """
+        Run every phase and return the results
+        """
+        from unittest.mock import patch
+        from moto import mock_aws
+
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+        with mock_aws():
+            import glrestore.glrestore
+            import glrestore.polling
+            import glrestore.s3_utils
+
+            glrestore.s3_utils.clear_client_cache()
+            session = glrestore.s3_utils.get_boto3_session()
+            session.events.register('after-call.s3.ListObjectsV2', self.add_restore_status)
+            session.events.register('before-call.s3', self.count_request)
+
+            self.phase('seed', self.seed)
+
+            output = os.path.join(workdir, 'report')
+            with patch.object(sys, 'argv', ['glrestore', '-f', f"s3://{BUCKET}/data/", '--no-cache', '-d', '1',
+                                            '-o', output, '--poll-interval', '0']):
+                RC = glrestore.glrestore.RestoreController(glrestore.glrestore.parse_args())
+            RC.setup_log = lambda: None
+            RC.parse_arguments()
+
+            pattern = f"s3://{BUCKET}/data/d*1/part-*5.dat"
+            self.phase('wildcard_expansion', lambda: glrestore.s3_utils.get_object_storage_class_v2(pattern, **RC.kwargs))
+
+            RC.file_classifications = self.phase('get_files_to_restore_v2', lambda: RC.get_files_to_restore_v2(RC.kwargs.get('files')))
+            RC.print_status(sleep=False)
+            self.phase('restore_files', RC.restore_files)
+
+            poller = glrestore.polling.RestorePoller(self.restoring, RC.classify, speed='Expedited', interval=0,
+                                                     sleep=self.finish_some)
+            self.phase('wait_for_restore', poller.wait)
+            self.phases['wait_for_restore']['polls'] = poller.polls
+
+            self.phase('report', RC.create_report)
+
+        return {'objects': self.num_objects, 'restoring_objects': len(self.restoring), 'phases': self.phases}
+
+def run_in_subprocess(num_objects, seed):
+    """
+    Run the benchmark for one size in a new process, and return its results
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        out = os.path.join(workdir, 'result.json')
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--single', str(num_objects), '--seed', str(seed),
+                        '-o', out], check=True)
+        with open(out) as r:
+            return json.load(r)
+
+def compare(results, baseline):
+    """
+    Print how each phase changed from a baseline results file
+    """
+    base = dict((r['objects'], r) for r in baseline['results'])
+    for r in results['results']:
+        if r['objects'] not in base:
+            continue
+        for name, phase in r['phases'].items():
+            old = base[r['objects']]['phases'].get(name)
+            if old is None:
+                continue
+            ratio = phase['seconds'] / old['seconds'] if old['seconds'] > 0 else float('nan')
+            print(f"{r['objects']} objects - {name}: {old['seconds']:.2f}s -> {phase['seconds']:.2f}s ({ratio:.2f}x), "
+                  f"{old['total_requests']} -> {phase['total_requests']} requests, "
+                  f"{old['peak_rss_mb']:.0f} -> {phase['peak_rss_mb']:.0f}MB peak RSS")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', help='Comma-separated numbers of objects to benchmark', default='1000,100000')
+    parser.add_argument('-o', '--output', help='Where to write the JSON results', default='glrestore_benchmark.json')
+    parser.add_argument('--compare', help='A previous results file to compare against')
+    parser.add_argument('--seed', help='Random seed for the object mix', default=0, type=int)
+    parser.add_argument('--single', help=argparse.SUPPRESS, type=int)
+    args = parser.parse_args()
+
+    # One size, in this process
+    if args.single is not None:
+        with tempfile.TemporaryDirectory() as workdir:
+            result = Benchmark(args.single, seed=args.seed).run(workdir)
+        with open(args.output, 'w') as o:
+            json.dump(result, o)
+        return
+
+    import glrestore
+    results = {'glrestore_version': glrestore.__version__, 'python': platform.python_version(),
+               'platform': platform.platform(), 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+               'results': []}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results['results'].append(run_in_subprocess(size, args.seed))
+
+    with open(args.output, 'w') as o:
+        json.dump(results, o, indent=2)
+    print(f"Wrote results to {args.output}", file=sys.stderr)
+
+    if args.compare is not None:
+        with open(args.compare) as r:
+            compare(results, json.load(r))
+
+if __name__ == '__main__':
+    main()
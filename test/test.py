@@ -5,14 +5,17 @@ Tests for glrestore
 import os
 import sys
 import time
+import email.utils
 import shutil
 import pytest
 import importlib
 import logging
 import subprocess
+import boto3
 import pandas as pd
 from time import sleep
 from threading import Thread
+from collections import defaultdict
 
 import glrestore
 import glrestore.s3_utils
@@ -59,6 +62,72 @@ def BTO():
     yield self
     self.teardown()
 
+@pytest.fixture()
+def moto_s3(monkeypatch, tmp_path):
+    """
+    A local, in-process S3 (moto) with a bucket full of objects in different storage classes
+
+    Does not touch any real AWS buckets
+    """
+    from moto import mock_aws
+
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    monkeypatch.chdir(tmp_path)
+
+    with mock_aws():
+        glrestore.s3_utils.clear_client_cache()
+        self = TestingClass()
+        self.bucket = 'glrestore-test'
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=self.bucket)
+
+        self.glacier_files = []
+        for i in range(5):
+            key = f'archive/glacier_{i}.txt'
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=b'x' * 100, StorageClass='GLACIER')
+            self.glacier_files.append(f's3://{self.bucket}/{key}')
+        for i in range(3):
+            key = f'archive/deep/deep_{i}.txt'
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=b'x' * 1000, StorageClass='DEEP_ARCHIVE')
+            self.glacier_files.append(f's3://{self.bucket}/{key}')
+        self.standard_file = f's3://{self.bucket}/archive/standard.txt'
+        self.client.put_object(Bucket=self.bucket, Key='archive/standard.txt', Body=b'x' * 10)
+
+        # moto doesn't support OptionalObjectAttributes=['RestoreStatus'], so fill it in like S3 would
+        def add_restore_status(parsed, **kwargs):
+            for entry in parsed.get('Contents', []):
+                restore = self.client.head_object(Bucket=self.bucket, Key=entry['Key']).get('Restore')
+                if restore is not None:
+                    entry['RestoreStatus'] = {'IsRestoreInProgress': 'ongoing-request="true"' in restore}
+                    if 'expiry-date="' in restore:
+                        expiry = restore.split('expiry-date="')[1].split('"')[0]
+                        entry['RestoreStatus']['RestoreExpiryDate'] = email.utils.parsedate_to_datetime(expiry)
+
+        # Count the requests that glrestore sends
+        self.requests = defaultdict(int)
+        def count_request(model, **kwargs):
+            self.requests[model.name] += 1
+
+        session = glrestore.s3_utils.get_boto3_session()
+        session.events.register('after-call.s3.ListObjectsV2', add_restore_status)
+        session.events.register('before-call.s3', count_request)
+
+        self.test_dir = str(tmp_path)
+        yield self
+
+def make_controller(cmd):
+    """
+    Make a RestoreController as if cmd was passed on the command line, without running it
+    """
+    import glrestore.glrestore
+    from unittest.mock import patch
+    with patch.object(sys, 'argv', cmd.split(" ")):
+        args = glrestore.glrestore.parse_args()
+    return glrestore.glrestore.RestoreController(args)
+
 def run_glrestore(cmd):
     """
     Simulate as if you're calling glrestore from the command line
@@ -127,6 +196,1108 @@ def test_classify_glacier_objects_2(BTO):
     assert db['storage_class'].value_counts()['GLACIER'] == 3
 
 
+def test_import_time():
+    """
+    test that the command line entry point parses arguments without importing pandas / boto3, within a time budget
+    """
+    budget = 0.5
+    code = ("import sys, time\n"
+            "start = time.perf_counter()\n"
+            "import glrestore.glrestore\n"
+            "sys.argv = ['glrestore', '-f', 's3://bucket/key', '--report']\n"
+            "glrestore.glrestore.parse_args()\n"
+            "print(time.perf_counter() - start)\n"
+            "print(','.join(m for m in ['pandas', 'numpy', 'boto3', 'botocore', 'aiobotocore'] if m in sys.modules))\n")
+    out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.split('\n')
+    assert out[1] == ''
+    assert float(out[0]) < budget
+
+    out = subprocess.run([sys.executable, '-m', 'glrestore.glrestore', '--version'], capture_output=True, text=True)
+    assert out.returncode == 0
+    assert glrestore.__version__ in out.stdout
+
+def test_list_classifier(moto_s3):
+    """
+    test that "s3_utils.get_object_storage_class_v2" classifies objects from listings rather than HEADs
+    """
+    moto_s3.client.restore_object(Bucket=moto_s3.bucket, Key='archive/glacier_1.txt', RestoreRequest={'Days': 1})
+
+    # A prefix
+    db = glrestore.s3_utils.get_object_storage_class_v2(f's3://{moto_s3.bucket}/archive/')
+    assert len(db) == 9
+    assert db['storage_class'].value_counts().to_dict() == {'GLACIER': 5, 'DEEP_ARCHIVE': 3, 'STANDARD': 1}
+    assert db[db['restore_status'] == 'restored']['file'].tolist() == [moto_s3.glacier_files[1]]
+    assert set(db.columns) == set(glrestore.s3_utils.TABLE_COLUMNS)
+
+    # A wildcard
+    db = glrestore.s3_utils.get_object_storage_class_v2(f's3://{moto_s3.bucket}/archive/glacier_*.txt')
+    assert sorted(db['file'].tolist()) == sorted(moto_s3.glacier_files[:5])
+
+    # A list of objects, including one that doesn't exist
+    moto_s3.requests.clear()
+    missing = f's3://{moto_s3.bucket}/archive/does_not_exist.txt'
+    db = glrestore.s3_utils.get_object_storage_class_v2(moto_s3.glacier_files[:5] + [moto_s3.standard_file, missing])
+    assert sorted(db['file'].tolist()) == sorted(moto_s3.glacier_files[:5] + [moto_s3.standard_file])
+    assert moto_s3.requests['ListObjectsV2'] == 1
+    assert moto_s3.requests['HeadObject'] == 0
+
+    # Pages of nothing but subdirectories don't end the listing early; the rest are looked up one by one
+    for i in range(2500):
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=f'data/d{i:05d}/x', Body=b'x')
+    wanted = [f's3://{moto_s3.bucket}/data/a.txt', f's3://{moto_s3.bucket}/data/z.txt']
+    for f in wanted:
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=glrestore.s3_utils.get_bucket_key(f)[1], Body=b'x', StorageClass='GLACIER')
+    moto_s3.requests.clear()
+    db = glrestore.s3_utils.get_object_storage_class_v2(wanted)
+    assert sorted(db['file'].tolist()) == wanted
+    assert moto_s3.requests['HeadObject'] == 1
+
+    # A single object
+    assert glrestore.s3_utils.glacier_status_v2(moto_s3.glacier_files[1]) == 'glacier-restored'
+    assert glrestore.s3_utils.glacier_status_v2(moto_s3.glacier_files[5]) == 'deep-glacier-no-restore'
+    assert glrestore.s3_utils.glacier_status_v2(moto_s3.standard_file) == 'no-glacier'
+
+def test_wildcard_pruning(moto_s3):
+    """
+    test that wildcards only list the directories that can match
+    """
+    for run in ['r1', 'r2', 'r3']:
+        for year in ['2020', '2021']:
+            for i in range(3):
+                moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=f'runs/{run}/{year}/f{i}.csv', Body=b'x')
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=f'runs/{run}/2021/f.txt', Body=b'x')
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=f'runs/{run}/2021/sub/g.csv', Body=b'x')
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=f'runs/{run}/deep/2021/h.csv', Body=b'x')
+
+    def _keys(pattern):
+        db = glrestore.s3_utils.get_object_storage_class_v2(f's3://{moto_s3.bucket}/{pattern}', threads=4)
+        return sorted(f.split(moto_s3.bucket + '/')[1] for f in db['file'])
+
+    # One delimiter listing of runs/, then one listing per matching year directory
+    moto_s3.requests.clear()
+    keys = _keys('runs/*/2021/*.csv')
+    assert keys == sorted([f'runs/{r}/2021/f{i}.csv' for r in ['r1', 'r2', 'r3'] for i in range(3)] +
+                          [f'runs/{r}/2021/sub/g.csv' for r in ['r1', 'r2', 'r3']])
+    assert moto_s3.requests['ListObjectsV2'] == 4
+
+    # Subtrees are pruned as soon as a level doesn't match
+    moto_s3.requests.clear()
+    assert _keys('runs/r[12]/20?0/*') == sorted(f'runs/r{r}/2020/f{i}.csv' for r in [1, 2] for i in range(3))
+    assert moto_s3.requests['ListObjectsV2'] == 1 + 2 + 2
+    assert _keys('runs/x*/2021/*') == []
+
+    # ** matches any number of directories
+    assert _keys('runs/r1/**/h.csv') == ['runs/r1/deep/2021/h.csv']
+    assert _keys('runs/**/2021/f.txt') == [f'runs/{r}/2021/f.txt' for r in ['r1', 'r2', 'r3']]
+
+def test_records_to_table():
+    """
+    test that "s3_utils.records_to_table" parses HEAD and listing rows into a compact table
+    """
+    import datetime
+    lm = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+    records = [
+        {'file': 's3://b/head_restored', 'storage_class': 'GLACIER', 'size_bytes': 10, 'LastModified': lm,
+         'restore_header': 'ongoing-request="false", expiry-date="Fri, 21 Dec 2012 00:00:00 GMT"'},
+        {'file': 's3://b/head_restoring', 'storage_class': 'GLACIER', 'size_bytes': 10, 'LastModified': lm,
+         'restore_header': 'ongoing-request="true"'},
+        {'file': 's3://b/list_restored', 'storage_class': 'DEEP_ARCHIVE', 'size_bytes': 10, 'LastModified': lm,
+         'restore_ongoing': False, 'restore_expiry': datetime.datetime(2012, 12, 21, tzinfo=datetime.timezone.utc)},
+        {'file': 's3://b/list_restoring', 'storage_class': 'DEEP_ARCHIVE', 'size_bytes': 10, 'LastModified': lm,
+         'restore_ongoing': True, 'restore_expiry': None},
+        {'file': 's3://b/list_archived', 'storage_class': 'DEEP_ARCHIVE', 'size_bytes': 10, 'LastModified': lm},
+        {'file': 's3://b/list_standard', 'storage_class': 'STANDARD', 'size_bytes': 5 * 10 ** 12, 'LastModified': lm},
+    ]
+    db = glrestore.s3_utils.records_to_table(records)
+
+    assert db['restore_status'].tolist() == ['restored', 'restoring', 'restored', 'restoring', 'not-restored', 'not-restored']
+    assert db['restore_expiry'].iloc[0] == db['restore_expiry'].iloc[2] == pd.Timestamp('2012-12-21')
+    assert db['restore_expiry'].isna().tolist() == [False, True, False, True, True, True]
+    assert db['LastModified'].iloc[0] == pd.Timestamp('2022-01-01')
+    assert str(db['storage_class'].dtype) == 'category'
+    assert str(db['restore_status'].dtype) == 'category'
+    assert str(db['size_bytes'].dtype) == 'int64'
+    assert glrestore.s3_utils.needs_restore(db).tolist() == [False, False, False, False, True, False]
+
+    # An empty table still has all of the columns
+    assert list(glrestore.s3_utils.records_to_table([]).columns) == glrestore.s3_utils.TABLE_COLUMNS
+
+def test_batched_classification(moto_s3):
+    """
+    test that get_files_to_restore_v2 deduplicates overlapping inputs and classifies them in one pass
+    """
+    manifest = os.path.join(moto_s3.test_dir, 'manifest.txt')
+    with open(manifest, 'w') as o:
+        for f in moto_s3.glacier_files + moto_s3.glacier_files[:3]:
+            o.write(f + '\n')
+        o.write('\n')
+        o.write(f's3://{moto_s3.bucket}/archive/deep/\n')
+
+    RC = make_controller(f"glrestore -f {manifest} s3://{moto_s3.bucket}/archive/*_1.txt --report")
+
+    moto_s3.requests.clear()
+    db = RC.get_files_to_restore_v2(RC.kwargs.get('files'))
+    assert sorted(db['file'].tolist()) == sorted(moto_s3.glacier_files)
+    assert moto_s3.requests['HeadObject'] == 0
+    assert moto_s3.requests['ListObjectsV2'] == 3
+
+    # Prefixes and wildcards covered by a shorter prefix are dropped
+    plan = glrestore.s3_utils.plan_s3_locs([f's3://{moto_s3.bucket}/archive/deep/', f's3://{moto_s3.bucket}/archive/',
+                                            f's3://{moto_s3.bucket}/archive/*.txt', f's3://{moto_s3.bucket}/other/*.txt'])
+    assert plan == {moto_s3.bucket: [['archive/'], ['other/*.txt']]}
+
+def test_stream_restore(moto_s3, caplog):
+    """
+    test that --stream restores objects straight from the listings and still reports the totals
+    """
+    caplog.set_level(logging.INFO)
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 -t 2 --stream")
+    RC.main()
+
+    for f in moto_s3.glacier_files:
+        assert glrestore.s3_utils.glacier_status_v2(f) == 'glacier-restored'
+    assert "Identified 9 files" in caplog.text
+    assert "Restoring the remaining 8 objects" in caplog.text
+    assert "8 issued" in caplog.text
+    assert not os.path.exists(RC.kwargs.get('failed'))
+
+def test_stream_overlapping(moto_s3, caplog):
+    """
+    test that --stream only counts and restores objects matched by several -f entries once
+    """
+    caplog.set_level(logging.INFO)
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/glacier_* s3://{moto_s3.bucket}/archive/glacier_[0-2].txt -d 1 --stream --no-cache")
+    RC.main()
+
+    assert "Identified 5 files" in caplog.text
+    assert "5 issued" in caplog.text
+    assert moto_s3.requests['RestoreObject'] == 5
+
+def test_stream_chunks(moto_s3, monkeypatch, caplog):
+    """
+    test that --stream reads a manifest a chunk at a time, and objects matched from two chunks are restored once
+    """
+    import glrestore.glrestore
+    monkeypatch.setattr(glrestore.glrestore, 'STREAM_CHUNK_SIZE', 2)
+    caplog.set_level(logging.INFO)
+    with open('manifest.txt', 'w') as o:
+        for f in moto_s3.glacier_files[:3] + [f's3://{moto_s3.bucket}/archive/glacier_']:
+            o.write(f + '\n')
+
+    RC = make_controller(f"glrestore -f manifest.txt -d 1 --stream --no-cache")
+    chunks = RC.iter_s3_loc_chunks(['manifest.txt'])
+    assert next(chunks) == moto_s3.glacier_files[:2]
+    assert isinstance(RC.load_s3_locs(['manifest.txt']), glrestore.manifests.ManifestReader)
+
+    RC.main()
+    assert "Identified 5 files" in caplog.text
+    assert moto_s3.requests['RestoreObject'] == 5
+    assert RC.s3_locs == []
+
+def test_status_cache(moto_s3):
+    """
+    test that the status cache only sends objects whose state could have changed to S3
+    """
+    import glrestore.cache
+    cache = glrestore.cache.StatusCache(os.path.join(moto_s3.test_dir, 'cache.sqlite'))
+    moto_s3.client.restore_object(Bucket=moto_s3.bucket, Key='archive/glacier_1.txt', RestoreRequest={'Days': 1})
+    files = moto_s3.glacier_files + [moto_s3.standard_file]
+
+    db1 = glrestore.s3_utils.get_object_storage_class_v2(files, status_cache=cache)
+    assert (cache.hits, cache.writes) == (0, 9)
+
+    # The restored and the STANDARD object come from the cache; the rest go to S3
+    moto_s3.requests.clear()
+    db2 = glrestore.s3_utils.get_object_storage_class_v2(files, status_cache=cache)
+    assert cache.hits == 2
+    assert moto_s3.requests['ListObjectsV2'] == 2
+    assert moto_s3.requests['HeadObject'] == 0
+    cols = ['file', 'storage_class', 'restore_status', 'size_bytes', 'etag']
+    assert db1.sort_values('file')[cols].astype(str).values.tolist() == db2.sort_values('file')[cols].astype(str).values.tolist()
+
+    # A prefix is only served from the cache once a listing showed it only matches itself
+    glrestore.s3_utils.get_object_storage_class_v2([moto_s3.standard_file], exact=False, status_cache=cache)
+    moto_s3.requests.clear()
+    db3 = glrestore.s3_utils.get_object_storage_class_v2([moto_s3.standard_file], exact=False, status_cache=cache)
+    assert db3['file'].tolist() == [moto_s3.standard_file]
+    assert moto_s3.requests['ListObjectsV2'] == 0
+
+    # Changed objects are noticed when they're listed again
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key='archive/standard.txt', Body=b'changed')
+    glrestore.s3_utils.get_object_storage_class_v2(f's3://{moto_s3.bucket}/archive/', status_cache=cache)
+    assert cache.stale == 1
+
+    # A lifecycle transition to an archive class changes neither LastModified nor the ETag, so objects that aren't
+    # archived are only trusted for max_age
+    moto_s3.client.copy_object(Bucket=moto_s3.bucket, Key='archive/standard.txt', StorageClass='GLACIER',
+                               CopySource={'Bucket': moto_s3.bucket, 'Key': 'archive/standard.txt'})
+    assert cache.split([moto_s3.standard_file], True)[1] == []
+    assert cache.split([moto_s3.standard_file], True, now=time.time() + cache.max_age)[1] == [moto_s3.standard_file]
+    cache.max_age = 0
+    db4 = glrestore.s3_utils.get_object_storage_class_v2([moto_s3.standard_file], status_cache=cache)
+    assert db4['storage_class'].tolist() == ['GLACIER']
+
+def test_restore_poller():
+    """
+    test that the poller follows the restore tier, samples before sweeping, and backs off while nothing finishes
+    """
+    import glrestore.polling
+    files = [f's3://b/{i}' for i in range(500)]
+    clock = {'now': 0, 'sleeps': [], 'checked': []}
+
+    # Nothing finishes for the first 10 minutes, then everything does
+    def classify(fs):
+        clock['checked'].append(len(fs))
+        status = 'restored' if clock['now'] >= 600 else 'restoring'
+        return pd.DataFrame({'file': fs, 'restore_status': status})
+
+    def sleep(s):
+        clock['sleeps'].append(s)
+        clock['now'] += s
+
+    poller = glrestore.polling.RestorePoller(files, classify, speed='Expedited', sleep=sleep)
+    poller.wait()
+
+    assert len(poller.remaining) == 0
+    assert clock['sleeps'][:3] == [60, 90, 135]
+    assert max(clock['sleeps']) <= 300
+    assert clock['checked'][:-2] == [100] * (len(clock['checked']) - 2)
+    assert clock['checked'][-2:] == [100, 400]
+
+    # --poll-interval 0 still waits between polls
+    poller = glrestore.polling.RestorePoller(files, classify, interval=0, sleep=sleep)
+    assert (poller.first_check, poller.base_interval) == (1, 1)
+
+def test_wait_for_restore(moto_s3, monkeypatch):
+    """
+    test that --wait stops once everything has finished restoring
+    """
+    import glrestore.polling
+    sleeps = []
+    monkeypatch.setattr(time, 'sleep', sleeps.append)
+    pollers = []
+
+    class Poller(glrestore.polling.RestorePoller):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            pollers.append(self)
+    monkeypatch.setattr(glrestore.polling, 'RestorePoller', Poller)
+
+    RC = make_controller(f"glrestore -f {moto_s3.glacier_files[0]} -d 1 --wait --poll-interval 0 --no-cache")
+    RC.files_to_restore_filtered = moto_s3.glacier_files
+    RC.restore_files()
+    RC.wait_for_restore()
+
+    assert len(pollers) == 1
+    assert len(pollers[0].remaining) == 0
+    assert pollers[0].polls == 1
+    assert sleeps == [1]
+    db = glrestore.s3_utils.get_object_storage_class_v2(moto_s3.glacier_files)
+    assert (db['restore_status'] == 'restored').all()
+
+def s3_restore_event(bucket, key):
+    """
+    The body of an s3:ObjectRestore:Completed event notification
+    """
+    import json
+    import urllib.parse
+    return json.dumps({'Records': [{'eventName': 'ObjectRestore:Completed',
+                                    's3': {'bucket': {'name': bucket}, 'object': {'key': urllib.parse.quote_plus(key)}}}]})
+
+def test_restore_event_waiter(moto_s3):
+    """
+    test that --wait-backend sqs matches restore events against the objects being waited on
+    """
+    import json
+    import glrestore.notifications
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = sqs.create_queue(QueueName='glrestore-events')['QueueUrl']
+
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key='archive/with space.txt', Body=b'x', StorageClass='GLACIER')
+    waiting_on = moto_s3.glacier_files[:3] + [f's3://{moto_s3.bucket}/archive/with space.txt']
+    for f in waiting_on:
+        moto_s3.client.restore_object(Bucket=moto_s3.bucket, Key=glrestore.s3_utils.get_bucket_key(f)[1], RestoreRequest={'Days': 1})
+
+    sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'Event': 's3:TestEvent'}))
+    sqs.send_message(QueueUrl=queue_url, MessageBody=s3_restore_event(moto_s3.bucket, 'archive/glacier_0.txt'))
+    sqs.send_message(QueueUrl=queue_url, MessageBody=json.dumps({'Type': 'Notification', 'Message': s3_restore_event(moto_s3.bucket, 'archive/glacier_1.txt')}))
+    sqs.send_message(QueueUrl=queue_url, MessageBody=s3_restore_event(moto_s3.bucket, 'archive/with space.txt'))
+    sqs.send_message(QueueUrl=queue_url, MessageBody=s3_restore_event('someone-elses-bucket', 'file.txt'))
+
+    classify = lambda files: glrestore.s3_utils.get_object_storage_class_v2(files)
+    waiter = glrestore.notifications.RestoreEventWaiter(waiting_on, queue_url, classify, timeout=1, wait_seconds=0)
+    waiter.wait()
+
+    # glacier_2.txt never got an event, but the reconciliation sweep sees that it's done
+    assert waiter.events == 3
+    assert len(waiter.remaining) == 0
+
+    # Only the message nobody here was waiting for is left on the queue
+    left = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages', 'ApproximateNumberOfMessagesNotVisible'])['Attributes']
+    assert int(left['ApproximateNumberOfMessages']) + int(left['ApproximateNumberOfMessagesNotVisible']) == 1
+
+    # Without a timeout, a queue that goes quiet still ends the wait (the reconciliation sweep then finds the rest)
+    for f in moto_s3.glacier_files[3:5]:
+        moto_s3.client.restore_object(Bucket=moto_s3.bucket, Key=glrestore.s3_utils.get_bucket_key(f)[1], RestoreRequest={'Days': 1})
+    waiter = glrestore.notifications.RestoreEventWaiter(moto_s3.glacier_files[3:5], queue_url, classify, wait_seconds=0,
+                                                        max_idle_receives=2)
+    waiter.wait()
+    assert waiter.receives == 2
+    assert len(waiter.remaining) == 0
+
+def test_restore_engine_retries(moto_s3):
+    """
+    test that "s3_utils.restore_file" retries throttling and treats RestoreAlreadyInProgress as success
+    """
+    from botocore.stub import Stubber
+
+    client = boto3.client('s3', region_name='us-east-1')
+    params = {'Bucket': moto_s3.bucket, 'Key': 'archive/glacier_0.txt',
+              'RestoreRequest': {'Days': 1, 'GlacierJobParameters': {'Tier': 'Bulk'}}}
+
+    with Stubber(client) as stubber:
+        stubber.add_client_error('restore_object', service_error_code='SlowDown', http_status_code=503, expected_params=params)
+        stubber.add_response('restore_object', {'ResponseMetadata': {'HTTPStatusCode': 202}}, expected_params=params)
+        stubber.add_client_error('restore_object', service_error_code='RestoreAlreadyInProgress', http_status_code=409, expected_params=params)
+
+        assert glrestore.s3_utils.restore_file(moto_s3.glacier_files[0], client=client, days=1, speed='Bulk') == 'issued'
+        assert glrestore.s3_utils.restore_file(moto_s3.glacier_files[0], client=client, days=1, speed='Bulk') == 'in-progress'
+        stubber.assert_no_pending_responses()
+
+def test_batch_ops(moto_s3, monkeypatch, caplog):
+    """
+    test --batch-ops: the manifest is uploaded, the job is created and tracked, and the completion report is read back
+    """
+    import uuid
+    import glrestore.batch_ops
+    from botocore.stub import Stubber, ANY
+
+    token = '00000000-0000-0000-0000-000000000000'
+    monkeypatch.setattr(uuid, 'uuid4', lambda: token)
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+
+    # moto has no s3control jobs, so stub those
+    s3control = boto3.client('s3control', region_name='us-east-1')
+    stubber = Stubber(s3control)
+    stubber.add_response('create_job', {'JobId': 'job-0001'},
+                         {'AccountId': '123456789012', 'ConfirmationRequired': False, 'Operation': {'S3InitiateRestoreObject': {'ExpirationInDays': 3, 'GlacierJobTier': 'BULK'}},
+                          'Manifest': ANY, 'Report': ANY, 'ClientRequestToken': token, 'Description': ANY, 'Priority': 10, 'RoleArn': 'arn:aws:iam::123456789012:role/batch'})
+    stubber.add_response('describe_job', {'Job': {'Status': 'Active', 'ProgressSummary': {'TotalNumberOfTasks': 8}}},
+                         {'AccountId': '123456789012', 'JobId': 'job-0001'})
+    stubber.add_response('describe_job', {'Job': {'Status': 'Complete', 'ProgressSummary': {'TotalNumberOfTasks': 8, 'NumberOfTasksSucceeded': 7, 'NumberOfTasksFailed': 1}}},
+                         {'AccountId': '123456789012', 'JobId': 'job-0001'})
+    stubber.activate()
+
+    get_service_client = glrestore.s3_utils.get_service_client
+    monkeypatch.setattr(glrestore.s3_utils, 'get_service_client',
+                        lambda service, **kwargs: s3control if service == 's3control' else get_service_client(service, **kwargs))
+
+    # The completion report the job would write; one object failed
+    report = f'batch/glrestore-{token}/report/job-job-0001/'
+    rows = []
+    for i, f in enumerate(moto_s3.glacier_files):
+        key = glrestore.batch_ops.urllib.parse.quote(f.split(moto_s3.bucket + '/')[1])
+        result = 'failed,AccessDenied,403,Access Denied' if i == 0 else 'succeeded,,200,Successful'
+        rows.append(f"{moto_s3.bucket},{key},,{result}")
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=report + 'results/1.csv', Body='\n'.join(rows).encode())
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=report + 'manifest.json',
+                              Body=('{"Results": [{"TaskExecutionStatus": "succeeded", "Bucket": "%s", "Key": "%sresults/1.csv"}]}' % (moto_s3.bucket, report)).encode())
+
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 3 -s Bulk --no-cache --batch-ops --batch-ops-location s3://{moto_s3.bucket}/batch --batch-ops-role arn:aws:iam::123456789012:role/batch --batch-ops-interval 0")
+    caplog.set_level(logging.INFO)
+    RC.main()
+    stubber.assert_no_pending_responses()
+    assert "Job job-0001 is Active: 0 succeeded, 0 failed of 8" in caplog.text
+    assert RC.metrics.counters['restores_finished'] == 8
+
+    manifest = moto_s3.client.get_object(Bucket=moto_s3.bucket, Key=f'batch/glrestore-{token}/manifest.csv')['Body'].read().decode()
+    assert sorted(manifest.strip().split('\n')) == sorted(f"{moto_s3.bucket},{f.split(moto_s3.bucket + '/')[1]}" for f in moto_s3.glacier_files)
+
+    cdb = RC.file_classifications.set_index('file')
+    assert cdb.loc[moto_s3.glacier_files[0], 'batch_status'] == 'failed'
+    assert 'AccessDenied' in cdb.loc[moto_s3.glacier_files[0], 'batch_error']
+    assert (cdb.loc[moto_s3.glacier_files[1:], 'restore_status'] == 'restoring').all()
+    assert RC.restore_counts['issued'] == 7
+    with open(RC.kwargs.get('failed')) as r:
+        assert [l.strip() for l in r.readlines()] == [moto_s3.glacier_files[0]]
+
+    with pytest.raises(Exception):
+        glrestore.batch_ops.BatchRestoreJob(moto_s3.bucket, ['x'], 's3://b/p', 'role', speed='Expedited', account_id='1')
+
+    # The default --speed is rejected before anything is classified
+    moto_s3.requests.clear()
+    with pytest.raises(Exception, match='--speed Standard or --speed Bulk'):
+        make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ --no-cache --batch-ops --batch-ops-location s3://{moto_s3.bucket}/batch --batch-ops-role role").main()
+    assert moto_s3.requests['ListObjectsV2'] == 0
+
+def test_manifests(moto_s3, monkeypatch, caplog):
+    """
+    test reading -f manifests from plain / gzip files, stdin and S3, with duplicates and malformed lines
+    """
+    import io
+    import gzip
+    import glrestore.manifests
+
+    lines = moto_s3.glacier_files + moto_s3.glacier_files[:3] + ['not an s3 location', '', 'nope']
+    text = '\n'.join(lines) + '\n'
+    with open('manifest.txt', 'w') as o:
+        o.write(text)
+    with gzip.open('manifest.txt.gz', 'wt') as o:
+        o.write(text)
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key='manifests/m.txt.gz', Body=gzip.compress(text.encode()))
+
+    RC = make_controller(f"glrestore -f manifest.txt")
+    for loc in ['manifest.txt', 'manifest.txt.gz', f'@s3://{moto_s3.bucket}/manifests/m.txt.gz', '-']:
+        monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(io.BytesIO(gzip.compress(text.encode()))))
+        caplog.clear()
+        with caplog.at_level(logging.ERROR):
+            assert list(RC.load_s3_locs([loc])) == moto_s3.glacier_files
+        errors = [r.getMessage() for r in caplog.records if r.levelno == logging.ERROR]
+        assert len(errors) == 1 and 'Ignored 2 lines' in errors[0]
+
+    # Entries on the command line and in several manifests are deduplicated together
+    reader = glrestore.manifests.ManifestReader([moto_s3.standard_file, 'manifest.txt', 'manifest.txt.gz'], max_in_memory=3)
+    assert list(reader) == [moto_s3.standard_file] + moto_s3.glacier_files
+    assert (reader.lines, reader.duplicates, reader.malformed) == (27, 14, 4)
+
+    seen = glrestore.manifests.SeenSet(max_in_memory=2)
+    assert [seen.add(x) for x in ['a', 'b', 'c', 'a', 'c', 'd', 'b']] == [True, True, True, False, False, True, False]
+    path = seen.path
+    seen.close()
+    assert not os.path.exists(path)
+
+    if glrestore.manifests.zstandard is not None:
+        with open('manifest.txt.zst', 'wb') as o:
+            o.write(glrestore.manifests.zstandard.ZstdCompressor().compress(text.encode()))
+        assert list(RC.load_s3_locs(['manifest.txt.zst'])) == moto_s3.glacier_files
+
+def test_prefix_scheduler():
+    """
+    test that the prefix scheduler interleaves prefixes and adapts each prefix's concurrency
+    """
+    import glrestore.scheduler
+    from botocore.exceptions import ClientError
+
+    scheduler = glrestore.scheduler.PrefixScheduler(concurrency=8, initial_limit=2)
+    for i in range(10):
+        scheduler.add(f's3://b/hot/{i}')
+    scheduler.add('s3://b/cold/0')
+
+    # The cold prefix gets a turn even though the hot one was queued first, and the hot one is held to its limit
+    sent = []
+    while True:
+        ready = scheduler.next_ready(0)
+        if ready is None:
+            break
+        sent.append(ready[0])
+    assert sent == ['s3://b/hot/0', 's3://b/cold/0', 's3://b/hot/1']
+
+    # Successes raise the limit a little; a throttle halves it and pauses the prefix
+    scheduler.succeeded('s3://b/hot/0', 0)
+    assert scheduler.prefixes['s3://b/hot'].limit == 2.5
+    scheduler.throttled('s3://b/hot/1', 0, 0)
+    assert scheduler.prefixes['s3://b/hot'].limit == 1.25
+    assert scheduler.stats(0)['s3://b/hot']['throttled'] == 1
+    assert scheduler.next_ready(0) is None
+    assert scheduler.next_ready(100)[0] == 's3://b/hot/1'
+
+    # Throttled requests are retried by the threaded driver until they work
+    tries = defaultdict(int)
+    def _flaky(f):
+        tries[f] += 1
+        if tries[f] == 1:
+            raise ClientError({'Error': {'Code': 'SlowDown'}, 'ResponseMetadata': {'HTTPStatusCode': 503}}, 'RestoreObject')
+        if f.endswith('bad'):
+            raise ClientError({'Error': {'Code': 'AccessDenied'}, 'ResponseMetadata': {'HTTPStatusCode': 403}}, 'RestoreObject')
+        return 'issued'
+
+    files = [f's3://b/p{i % 3}/{i}' for i in range(30)] + ['s3://b/p0/bad']
+    scheduler = glrestore.scheduler.PrefixScheduler(concurrency=4)
+    done = list(glrestore.scheduler.run_threaded(iter(files), _flaky, scheduler, retries=3))
+    assert sorted(f for f, status, error in done if status == 'issued') == sorted(files[:-1])
+    assert [f for f, status, error in done if error is not None] == ['s3://b/p0/bad']
+    assert scheduler.throttles == 31
+    assert scheduler.idle()
+
+def test_client_pool(moto_s3):
+    """
+    test that s3 clients are shared and pointed at the region each bucket lives in
+    """
+    moto_s3.client.create_bucket(Bucket='glrestore-test-eu', CreateBucketConfiguration={'LocationConstraint': 'eu-west-1'})
+
+    assert glrestore.s3_utils.get_boto3_client() is glrestore.s3_utils.get_boto3_client(profile=None)
+    assert glrestore.s3_utils.get_boto3_client(max_pool_connections=5) is not glrestore.s3_utils.get_boto3_client()
+
+    eu_client = glrestore.s3_utils.get_client_for_bucket('glrestore-test-eu')
+    assert eu_client.meta.region_name == 'eu-west-1'
+    assert glrestore.s3_utils.get_client_for_bucket('glrestore-test-eu') is eu_client
+    assert glrestore.s3_utils.get_client_for_bucket(moto_s3.bucket).meta.region_name == 'us-east-1'
+
+def test_restore_engine_concurrent(moto_s3):
+    """
+    test that RestoreController.restore_files issues restores in parallel and writes out the failures
+    """
+    missing = f's3://{moto_s3.bucket}/archive/does_not_exist.txt'
+    RC = make_controller(f"glrestore -f {moto_s3.glacier_files[0]} -d 1 -t 4 --retries 0")
+    RC.files_to_restore_filtered = moto_s3.glacier_files + [missing]
+    RC.restore_files()
+
+    for f in moto_s3.glacier_files:
+        assert glrestore.s3_utils.glacier_status_v2(f) == 'glacier-restored'
+
+    with open(RC.kwargs.get('failed')) as r:
+        assert [l.strip() for l in r.readlines()] == [missing]
+
+@pytest.fixture()
+def moto_server(monkeypatch, tmp_path):
+    """
+    A local S3 server (moto) with a bucket of glacier objects, reachable from other processes and from aiobotocore
+    """
+    from moto.server import ThreadedMotoServer
+
+    server = ThreadedMotoServer(port=0)
+    server.start()
+    try:
+        host, port = server.get_host_and_port()
+        monkeypatch.setenv('AWS_ENDPOINT_URL', f'http://{host}:{port}')
+        monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+        monkeypatch.setenv('HOME', str(tmp_path))
+        monkeypatch.chdir(tmp_path)
+        glrestore.s3_utils.clear_client_cache()
+
+        self = TestingClass()
+        self.bucket = 'glrestore-server'
+        self.client = boto3.client('s3', region_name='us-east-1')
+        self.client.create_bucket(Bucket=self.bucket)
+        self.glacier_files = []
+        for i in range(20):
+            self.client.put_object(Bucket=self.bucket, Key=f'a/g_{i}.txt', Body=b'x' * 10, StorageClass='GLACIER')
+            self.glacier_files.append(f's3://{self.bucket}/a/g_{i}.txt')
+        self.client.put_object(Bucket=self.bucket, Key='a/standard.txt', Body=b'x')
+
+        self.test_dir = str(tmp_path)
+        yield self
+    finally:
+        glrestore.s3_utils.clear_client_cache()
+        server.stop()
+
+def test_asyncio_engine(moto_server, monkeypatch):
+    """
+    test the asyncio engine against a local S3 server
+    """
+    pytest.importorskip('aiobotocore')
+    import asyncio
+    import glrestore.async_utils
+
+    bucket = moto_server.bucket
+    client = moto_server.client
+    glacier = moto_server.glacier_files
+
+    # Classification matches the threaded engine
+    db = asyncio.run(glrestore.async_utils.get_object_storage_class_async([f's3://{bucket}/a/'], exact=False, max_in_flight=4))
+    threaded = glrestore.s3_utils.get_object_storage_class_v2([f's3://{bucket}/a/'], exact=False)
+    assert sorted(db['file']) == sorted(threaded['file'])
+    assert len(db) == 21
+    assert set(db.loc[db['storage_class'] == 'GLACIER', 'file']) == set(glacier)
+
+    db = asyncio.run(glrestore.async_utils.get_object_storage_class_async(f's3://{bucket}/*/g_1*.txt'))
+    assert sorted(db['file']) == sorted(glacier[1:2] + glacier[10:])
+
+    missing = f's3://{bucket}/a/missing.txt'
+    db = asyncio.run(glrestore.async_utils.get_object_storage_class_async(glacier[:3] + [missing], exact=True))
+    assert sorted(db['file']) == sorted(glacier[:3])
+
+    # Restores, with failures reported through on_failed, from a generator (pulled a batch at a time)
+    pulls = []
+    pull_batch = glrestore.async_utils.pull_batch
+    monkeypatch.setattr(glrestore.async_utils, 'PULL_BATCH_SIZE', 8)
+    monkeypatch.setattr(glrestore.async_utils, 'pull_batch', lambda it: pulls.append(1) or pull_batch(it))
+    failed = []
+    counts, _ = asyncio.run(glrestore.async_utils.restore_files_async(
+        (f for f in glacier + [missing]), max_in_flight=8, on_failed=lambda f, e: failed.append(f),
+        days=1, speed='Expedited', retries=0))
+    assert counts['issued'] + counts['already-restored'] == 20
+    assert failed == [missing]
+    assert len(pulls) == 4
+    for f in glacier:
+        assert 'Restore' in client.head_object(Bucket=bucket, Key=f.split(bucket + '/')[1])
+
+    # And through the command line
+    RC = make_controller(f"glrestore -f s3://{bucket}/a/ --engine asyncio --max-in-flight 16 --no-cache --report")
+    RC.main()
+    assert len(pd.read_csv(RC.kwargs.get('output') + '.csv')) == 21
+    assert RC.metrics.counters['objects_classified'] == 21
+    assert RC.metrics.requests[('ListObjectsV2', 'ok')] >= 1
+
+def test_sharding():
+    """
+    test that shards split the work without overlap
+    """
+    import glrestore.sharding
+
+    assert glrestore.sharding.parse_shard('1/4') == (1, 4)
+    for bad in ['4/4', '-1/2', 'x', '1']:
+        with pytest.raises(Exception):
+            glrestore.sharding.parse_shard(bad)
+    assert glrestore.sharding.shard_name('glrestore_report.csv', 0, 4) == 'glrestore_report.shard0of4.csv'
+
+    # Prefix mode; entries under another entry are dropped so no object is found by two shards
+    locs = [f's3://b/p{i}/' for i in range(10)] + ['s3://b/p3/sub/', 's3://b/p*.txt', 's3://c/x']
+    shards = [glrestore.sharding.shard_s3_locs(locs, i, 3) for i in range(3)]
+    assert sorted(l for shard in shards for l in shard) == sorted(set(locs) - set(['s3://b/p3/sub/']))
+    assert max(len(shard) for shard in shards) - min(len(shard) for shard in shards) <= 1
+
+    # Hash mode is stable and splits the table into disjoint parts
+    cdb = glrestore.s3_utils.records_to_table([{'file': f's3://b/k{i}', 'storage_class': 'GLACIER', 'size_bytes': 1,
+                                                'LastModified': pd.Timestamp('2024-01-01', tz='UTC')} for i in range(100)])
+    parts = [cdb[glrestore.sharding.shard_mask(cdb, i, 4)] for i in range(4)]
+    assert sum(len(p) for p in parts) == 100
+    assert all(len(p) > 0 for p in parts)
+    assert glrestore.sharding.key_shard('s3://b/k1', 4) == glrestore.sharding.key_shard('s3://b/k1', 4)
+
+def test_hash_shard_requests(moto_s3):
+    """
+    test that hash shards only look up their own objects, while prefixes are still split by object
+    """
+    objects = [f's3://{moto_s3.bucket}/sharded/d{i}/x.txt' for i in range(12)]
+    for f in objects:
+        moto_s3.client.put_object(Bucket=moto_s3.bucket, Key=glrestore.s3_utils.get_bucket_key(f)[1], Body=b'x', StorageClass='GLACIER')
+    with open('manifest.txt', 'w') as o:
+        for f in objects + [f's3://{moto_s3.bucket}/archive/deep/', f's3://{moto_s3.bucket}/archive/glacier_']:
+            o.write(f + '\n')
+
+    moto_s3.requests.clear()
+    make_controller(f"glrestore -f manifest.txt --no-cache --report -o all.csv").main()
+    unsharded = moto_s3.requests['ListObjectsV2'] + moto_s3.requests['HeadObject']
+
+    requests = []
+    for i in range(3):
+        moto_s3.requests.clear()
+        make_controller(f"glrestore -f manifest.txt --no-cache --report -o part.csv --shard {i}/3").main()
+        requests.append(moto_s3.requests['ListObjectsV2'] + moto_s3.requests['HeadObject'])
+
+    # Every shard lists archive/deep/, but each other entry is only looked up by one of them (which keeps
+    # everything under archive/glacier_, since it turned out to be a prefix)
+    assert sum(requests) == unsharded + 2
+    files = pd.concat([pd.read_csv(f'part.shard{i}of3.csv') for i in range(3)])['file']
+    assert sorted(files) == sorted(pd.read_csv('all.csv')['file'])
+
+def test_sharded_report(moto_server):
+    """
+    test that sharded reports (in local processes or one shard at a time) merge into the unsharded report
+    """
+    loc = f"s3://{moto_server.bucket}/a/"
+    RC = make_controller(f"glrestore -f {loc} --no-cache --report -o full.csv")
+    RC.main()
+    full = pd.read_csv('full.csv').sort_values('file').reset_index(drop=True)
+
+    RC = make_controller(f"glrestore -f {loc} --no-cache --report -o pool.csv --processes 2")
+    RC.main()
+    assert os.path.isfile('pool.shard0of2.csv') and os.path.isfile('pool.shard1of2.csv')
+    pool = pd.read_csv('pool.csv').sort_values('file').reset_index(drop=True)
+    assert pool['file'].tolist() == full['file'].tolist()
+    assert pool['storage_class'].tolist() == full['storage_class'].tolist()
+
+    for i in range(3):
+        make_controller(f"glrestore -f {loc} --no-cache --report -o machine.csv --shard {i}/3").main()
+    shard_files = [f'machine.shard{i}of3.csv' for i in range(3)]
+    assert sum(len(pd.read_csv(f)) for f in shard_files) == len(full)
+
+    RC = make_controller(f"glrestore --merge-reports {' '.join(shard_files)} -o merged.csv")
+    RC.main()
+    merged = pd.read_csv('merged.csv').sort_values('file').reset_index(drop=True)
+    assert merged['file'].tolist() == full['file'].tolist()
+    assert RC.totals.num_to_restore == 20
+
+    # Restoring in local processes adds up the counts of every shard
+    RC = make_controller(f"glrestore -f {loc} --no-cache -d 1 --processes 2 --shard-by prefix")
+    RC.main()
+    assert RC.restore_counts['issued'] + RC.restore_counts['already-restored'] == 20
+
+def test_tier_planner(moto_s3, monkeypatch, caplog):
+    """
+    test that --deadline / --budget pick a tier per object, and that costs are priced per storage class
+    """
+    import glrestore.planner
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+
+    GB = 10 ** 9
+    cdb = pd.DataFrame({'file': [f's3://b/{c}/{i}' for c, i in [('g', 0), ('g', 1), ('big', 0), ('d', 0), ('d', 1)]],
+                        'storage_class': pd.Categorical(['GLACIER', 'GLACIER', 'GLACIER', 'DEEP_ARCHIVE', 'DEEP_ARCHIVE']),
+                        'size_bytes': [GB // 10, GB // 10, 300 * 1024 * 1024, GB, GB]})
+
+    # Without a budget, everything gets the cheapest tier that's in time
+    plan = glrestore.planner.plan_restores(cdb, deadline=12)
+    assert plan['tier'].tolist() == ['Bulk', 'Bulk', 'Bulk', 'Standard', 'Standard']
+    plan = glrestore.planner.plan_restores(cdb, deadline=1)
+    assert plan['tier'].tolist() == ['Expedited', 'Expedited', 'Standard', 'Standard', 'Standard']
+    assert 'can\'t be restored within 1 hours' in caplog.text
+
+    # A budget buys faster tiers for the objects listed first
+    floor = glrestore.planner.plan_restores(cdb, days=1)
+    minimum = floor['cost'].sum() + glrestore.planner.storage_cost(cdb['size_bytes'].sum(), 1)
+    assert floor['tier'].tolist() == ['Bulk'] * 5
+    order = glrestore.planner.priority_order(cdb, ['s3://b/d/1', 's3://b/g/'])
+    assert cdb['file'][order].tolist() == ['s3://b/d/1', 's3://b/g/0', 's3://b/g/1', 's3://b/big/0', 's3://b/d/0']
+    plan = glrestore.planner.plan_restores(cdb, budget=minimum + 0.035, days=1, order=order)
+    assert plan['tier'].tolist() == ['Expedited', 'Standard', 'Standard', 'Bulk', 'Standard']
+    assert plan['cost'].sum() + glrestore.planner.storage_cost(cdb['size_bytes'].sum(), 1) <= minimum + 0.035
+    with pytest.raises(Exception, match='over the'):
+        glrestore.planner.plan_restores(cdb, budget=minimum / 2, days=1)
+
+    # From the command line, restores are issued at each planned tier
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/deep/ s3://{moto_s3.bucket}/archive/ -d 1 --no-cache --deadline 24")
+    RC.main()
+    assert RC.restore_plan.set_index('file')['tier'].to_dict() == dict(
+        [(f, 'Bulk') for f in moto_s3.glacier_files[:5]] + [(f, 'Standard') for f in moto_s3.glacier_files[5:]])
+    assert RC.restore_counts['issued'] == 8
+    assert 'Expedited: not available for DEEP_ARCHIVE objects' in caplog.text
+    assert 'Bulk: 5 objects' in caplog.text
+
+def test_reports(moto_s3, monkeypatch):
+    """
+    test that reports are written a chunk at a time in each format, and that --from-report skips classifying
+    """
+    import glrestore.reports
+    import glrestore.sharding
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+    loc = f"s3://{moto_s3.bucket}/archive/"
+
+    full = glrestore.s3_utils.get_object_storage_class_v2(loc, no_cache=True).sort_values('file').reset_index(drop=True)
+    for fmt in ['csv', 'csv.gz', 'parquet']:
+        with glrestore.reports.ReportWriter(glrestore.reports.report_location('chunks', fmt), chunk_size=2) as writer:
+            writer.write(full.iloc[:5])
+            writer.write(full.iloc[5:])
+        assert writer.rows == 9
+        back = glrestore.s3_utils.read_table(writer.loc)
+        pd.testing.assert_frame_equal(back, glrestore.s3_utils.format_table(full), check_dtype=False)
+
+    # Whole-table and streamed reports
+    make_controller(f"glrestore -f {loc} --no-cache --report --report-format csv.gz -o full").main()
+    assert len(glrestore.s3_utils.read_table('full.csv.gz')) == 9
+
+    RC = make_controller(f"glrestore -f {loc} --no-cache --report --stream --report-format parquet -o streamed")
+    RC.main()
+    assert RC.report_loc == 'streamed.parquet'
+    assert RC.totals.num_to_restore == 8
+    assert sorted(glrestore.s3_utils.read_table('streamed.parquet')['file']) == full['file'].tolist()
+
+    # A restore from the report doesn't list anything
+    RC = make_controller(f"glrestore --from-report streamed.parquet -d 1 --no-cache")
+    RC.main()
+    assert RC.restore_counts['issued'] == 8
+    assert not any(api == 'ListObjectsV2' for api, outcome in RC.metrics.requests)
+
+    assert glrestore.sharding.shard_name('full.csv.gz', 0, 2) == 'full.shard0of2.csv.gz'
+
+def test_journal(moto_s3, monkeypatch):
+    """
+    test that --journal records every restore request and --resume only restores what's left
+    """
+    import glrestore.journal
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+    loc = f"s3://{moto_s3.bucket}/archive/"
+
+    odd = 's3://b/a\tb\\c\nd'
+    assert glrestore.journal.unescape(glrestore.journal.escape(odd)) == odd
+    assert '\n' not in glrestore.journal.escape(odd)
+
+    # An interrupted run: everything queued, 3 outcomes and a half-written line
+    with open('interrupted.txt', 'w') as o:
+        for f in moto_s3.glacier_files:
+            o.write(f"queued\tBulk\t{f}\n")
+        o.write("complete\t\t\n")
+        for f in moto_s3.glacier_files[:3]:
+            o.write(f"issued\t\t{f}\n")
+        o.write("failed\t\t" + moto_s3.glacier_files[3] + "\n")
+        o.write("issued\t\ts3://glrestore-te")
+
+    RC = make_controller(f"glrestore -f {loc} -d 1 --no-cache --journal interrupted.txt --resume")
+    RC.main()
+    assert RC.restore_counts['issued'] == 5
+    assert RC.metrics.requests[('RestoreObject', 'ok')] == 5
+    assert not any(api == 'ListObjectsV2' for api, outcome in RC.metrics.requests)
+    # (the journal says the first 3 were restored before the interruption, so they're left alone)
+    for i, f in enumerate(moto_s3.glacier_files):
+        key = f.split(moto_s3.bucket + '/')[1]
+        assert ('Restore' in moto_s3.client.head_object(Bucket=moto_s3.bucket, Key=key)) == (i >= 3)
+
+    state = glrestore.journal.replay('interrupted.txt')
+    assert state.complete
+    assert state.remaining() == []
+    assert set(state.done) == set(moto_s3.glacier_files)
+
+    # A fresh journal lists everything to restore (the 3 left), then every outcome
+    RC = make_controller(f"glrestore -f {loc} -d 1 --no-cache --journal fresh.txt --stream")
+    RC.main()
+    state = glrestore.journal.replay('fresh.txt')
+    assert state.complete and (state.lines == 3 + 1 + 3)
+    assert list(state.queued) == moto_s3.glacier_files[:3]
+    assert state.remaining() == []
+
+    with pytest.raises(Exception, match='--resume needs'):
+        make_controller(f"glrestore -f {loc} --resume").main()
+
+def test_download(moto_s3, monkeypatch):
+    """
+    test that --download fetches objects in ranged parts as they're restored, and picks up partial downloads
+    """
+    import glrestore.download
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+    cmd = f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 --poll-interval 0 --no-cache --download out --download-part-size 0.0001"
+
+    # 0.0001MB parts split the 1,000 byte objects into 10 ranged GETs
+    RC = make_controller(cmd)
+    RC.main()
+    assert RC.downloader.downloaded == 9
+    assert RC.metrics.counters['objects_downloaded'] == 9
+    assert RC.metrics.counters['bytes_downloaded'] == 5 * 100 + 3 * 1000 + 10
+    for f in moto_s3.glacier_files + [moto_s3.standard_file]:
+        path = glrestore.download.local_path('out', f)
+        key = f.split(moto_s3.bucket + '/')[1]
+        with open(path, 'rb') as r:
+            assert r.read() == moto_s3.client.get_object(Bucket=moto_s3.bucket, Key=key)['Body'].read()
+    assert not any(p.endswith('.part') or p.endswith('.part.done') for d, _, ps in os.walk('out') for p in ps)
+
+    # An interrupted download with 2 of its 10 parts done only fetches the other 8
+    path = glrestore.download.local_path('out', moto_s3.glacier_files[5])
+    etag = moto_s3.client.head_object(Bucket=moto_s3.bucket, Key='archive/deep/deep_0.txt')['ETag']
+    os.rename(path, path + '.part')
+    with open(path + '.part', 'r+b') as o:
+        o.seek(2 * 104)
+        o.write(b'\0' * 10)
+    with open(path + '.part.done', 'w') as o:
+        o.write(f"{etag}\n0\n1\n")
+
+    gets = moto_s3.requests['GetObject']
+    RC = make_controller(cmd)
+    RC.main()
+    assert (RC.downloader.downloaded, RC.downloader.skipped) == (1, 8)
+    assert moto_s3.requests['GetObject'] - gets == 8
+    with open(path, 'rb') as r:
+        assert r.read() == b'x' * 1000
+
+    with pytest.raises(Exception, match='outside'):
+        glrestore.download.local_path('out', f's3://{moto_s3.bucket}/../../etc/passwd')
+
+    # The byte rate is shared: going over it makes the next caller wait
+    now = [0.0]
+    slept = []
+    limiter = glrestore.download.RateLimiter(1000, clock=lambda: now[0], sleep=slept.append)
+    limiter.consume(1000)
+    limiter.consume(500)
+    assert slept == [0.5]
+
+def test_copy_to_class(moto_s3, monkeypatch):
+    """
+    test that --copy-to-class copies objects as they're restored (in parts when they're big) and records the copies
+    """
+    import sqlite3
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+    moto_s3.client.put_object(Bucket=moto_s3.bucket, Key='archive/big.bin', Body=os.urandom(11 * 1024 * 1024), StorageClass='GLACIER',
+                              Tagging='project=x', Metadata={'owner': 'me'}, ContentType='application/x-test')
+    moto_s3.client.create_bucket(Bucket='hot')
+    archived = moto_s3.glacier_files + [f's3://{moto_s3.bucket}/archive/big.bin']
+    cmd = f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 --poll-interval 0 --copy-part-size 5"
+
+    # To another bucket; the 11MB object goes in three 5MB parts
+    RC = make_controller(cmd + " --copy-to-class INTELLIGENT_TIERING --copy-to s3://hot/restored/")
+    RC.main()
+    assert (RC.copier.copied, len(RC.copier.failed)) == (9, 0)
+    assert moto_s3.requests['UploadPartCopy'] == 3
+    for f in archived:
+        key = f.split(moto_s3.bucket + '/')[1]
+        head = moto_s3.client.head_object(Bucket='hot', Key='restored/' + key)
+        assert head['StorageClass'] == 'INTELLIGENT_TIERING'
+        assert head['ContentLength'] == moto_s3.client.head_object(Bucket=moto_s3.bucket, Key=key)['ContentLength']
+    with open(f"{moto_s3.test_dir}/big.bin", 'wb') as o:
+        o.write(moto_s3.client.get_object(Bucket='hot', Key='restored/archive/big.bin')['Body'].read())
+    assert os.path.getsize(f"{moto_s3.test_dir}/big.bin") == 11 * 1024 * 1024
+    # The multipart copy keeps the tags and metadata, like CopyObject does
+    assert moto_s3.client.get_object_tagging(Bucket='hot', Key='restored/archive/big.bin')['TagSet'] == [{'Key': 'project', 'Value': 'x'}]
+    head = moto_s3.client.head_object(Bucket='hot', Key='restored/archive/big.bin')
+    assert (head['Metadata'], head['ContentType']) == ({'owner': 'me'}, 'application/x-test')
+
+    # The copies are in the status cache, so running again doesn't copy anything
+    RC = make_controller(cmd + " --copy-to-class INTELLIGENT_TIERING --copy-to s3://hot/restored/")
+    RC.main()
+    assert (RC.copier.copied, RC.copier.skipped) == (0, 9)
+    conn = sqlite3.connect(RC.kwargs['status_cache'].location)
+    assert conn.execute("SELECT status, COUNT(*) FROM copies GROUP BY status").fetchall() == [('copied', 9)]
+
+    # In place, which un-archives them
+    RC = make_controller(cmd + " --copy-to-class STANDARD")
+    RC.main()
+    assert RC.copier.copied == 9
+    for f in archived:
+        key = f.split(moto_s3.bucket + '/')[1]
+        assert moto_s3.client.head_object(Bucket=moto_s3.bucket, Key=key).get('StorageClass', 'STANDARD') == 'STANDARD'
+
+    with pytest.raises(Exception, match='--copy-to needs'):
+        make_controller(cmd + " --copy-to s3://hot/").main()
+
+def test_serve(moto_s3):
+    """
+    test that --serve coalesces restore requests from different clients and wakes every waiter from one poller
+    """
+    import glrestore.service
+    RC = make_controller("glrestore --serve --socket glrestore.sock --poll-interval 1 -d 1 --no-cache")
+    server = Thread(target=RC.main)
+    server.start()
+    try:
+        while (RC.server is None) and server.is_alive():
+            sleep(0.01)
+        client = glrestore.service.ServiceClient('glrestore.sock')
+
+        result = client.restore([f"s3://{moto_s3.bucket}/archive/"])
+        assert len(result['objects']) == 9
+        assert result['counts']['issued'] == 8
+        assert result['objects'][moto_s3.standard_file] == 'available'
+
+        # Another client asking for objects that are already restoring doesn't send (or HEAD) anything
+        requests = dict(moto_s3.requests)
+        result = client.restore(moto_s3.glacier_files[:3])
+        assert result['counts'] == {'coalesced': 3}
+        assert set(result['objects'].values()) == set(['restoring'])
+        assert dict(moto_s3.requests) == requests
+
+        # Both waiters are woken by the same poll
+        results = []
+        waiters = [Thread(target=lambda: results.append(client.wait(moto_s3.glacier_files, timeout=30))) for i in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        for waiter in waiters:
+            waiter.join()
+        assert [r['pending'] for r in results] == [0, 0]
+        assert set(results[0]['objects'].values()) == set(['restored'])
+
+        # The command line client
+        args = make_controller(f"glrestore -f {moto_s3.glacier_files[0]} --wait --connect glrestore.sock").args
+        assert glrestore.service.run_client(args) == 0
+
+        stats = client.stats()
+        assert (stats['requests'], stats['restores_issued'], stats['pending']) == (3, 8, 0)
+    finally:
+        if RC.server is not None:
+            RC.server.shutdown()
+        server.join()
+    assert not os.path.exists('glrestore.sock')
+
+def test_waves(moto_s3, monkeypatch):
+    """
+    test that --wave-bytes / --wave-objects restore a wave at a time, running --wave-hook after each
+    """
+    import glrestore.waves
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+    assert glrestore.waves.parse_size('20TB') == 20 * 10 ** 12
+    assert glrestore.waves.parse_size('1.5TiB') == int(1.5 * 1024 ** 4)
+    assert glrestore.waves.parse_size('1000') == 1000
+    with pytest.raises(ValueError):
+        glrestore.waves.parse_size('20XB')
+    assert glrestore.waves.split_waves([('Expedited', ['a', 'b']), ('Bulk', ['c', 'd'])], max_objects=3) == \
+        [[('Expedited', ['a', 'b']), ('Bulk', ['c'])], [('Bulk', ['d'])]]
+
+    # The 1,000 byte DEEP_ARCHIVE objects come first: 3 waves of one (the last with a 100 byte GLACIER object too),
+    # then the other 4 GLACIER objects
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 --poll-interval 0 --no-cache --wave-bytes 1.1KB")
+    RC.kwargs['wave_hook'] = 'echo "$GLRESTORE_WAVE $GLRESTORE_WAVES $GLRESTORE_WAVE_OBJECTS $GLRESTORE_WAVE_BYTES $(wc -l < $GLRESTORE_WAVE_FILES)" >> hooks.txt'
+    issued_before_wait = []
+    wait_for_restore = RC.wait_for_restore
+    def _wait_for_restore(**kwargs):
+        issued_before_wait.append(moto_s3.requests['RestoreObject'])
+        wait_for_restore(**kwargs)
+    RC.wait_for_restore = _wait_for_restore
+    RC.main()
+
+    assert issued_before_wait == [1, 2, 4, 8]
+    assert RC.metrics.counters['waves_finished'] == 4
+    with open('hooks.txt') as r:
+        assert r.read().split('\n')[:-1] == ['1 4 1 1000 1', '2 4 1 1000 1', '3 4 2 1100 2', '4 4 4 400 4']
+
+    # A failing hook stops the restore before the next wave
+    for f in moto_s3.glacier_files:
+        moto_s3.client.copy_object(Bucket=moto_s3.bucket, Key=f.split(moto_s3.bucket + '/')[1], StorageClass='GLACIER',
+                                   CopySource={'Bucket': moto_s3.bucket, 'Key': f.split(moto_s3.bucket + '/')[1]})
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 --poll-interval 0 --no-cache --wave-objects 5")
+    RC.kwargs['wave_hook'] = 'exit 3'
+    issued = moto_s3.requests['RestoreObject']
+    with pytest.raises(Exception, match='exited with 3 after wave 1 of 2'):
+        RC.main()
+    assert moto_s3.requests['RestoreObject'] - issued == 5
+
+def test_metrics(moto_s3, monkeypatch):
+    """
+    test that --metrics-out records each phase, the S3 requests and retries, and writes JSON and Prometheus files
+    """
+    import json
+    import glrestore.metrics
+    monkeypatch.setattr(time, 'sleep', lambda x: None)
+
+    RC = make_controller(f"glrestore -f s3://{moto_s3.bucket}/archive/ -d 1 --wait --poll-interval 0 --no-cache --metrics-out run.json")
+    RC.main()
+
+    with open('run.json') as r:
+        m = json.load(r)
+    assert set(['setup', 'classify', 'status', 'restore', 'wait']) <= set(m['phases'])
+    # 9 objects found, then the 8 being restored checked again while waiting
+    assert m['counters']['objects_classified'] == 9 + 8
+    assert m['counters']['restores_finished'] == 8
+    assert m['counters']['objects_restored'] == 8
+    assert m['requests']['RestoreObject']['ok'] == 8
+    assert m['latency']['ListObjectsV2']['count'] == sum(m['requests']['ListObjectsV2'].values())
+    assert m['timers']['build_table'] > 0
+    assert m['peak_rss_bytes'] > 0
+
+    with open('run.prom') as r:
+        prom = r.read()
+    assert 'glrestore_requests_total{api="RestoreObject",outcome="ok"} 8' in prom
+    assert 'glrestore_request_seconds_bucket{api="RestoreObject",le="+Inf"} 8' in prom
+    assert 'glrestore_phase_seconds{phase="classify"}' in prom
+
+    # Nothing is recorded once the run is over
+    glrestore.s3_utils.get_object_storage_class_v2(f"s3://{moto_s3.bucket}/archive/", no_cache=True)
+    assert RC.metrics.counters['objects_classified'] == 9 + 8
+
+    # Retries, and the progress line's throughput and ETA
+    metrics = glrestore.metrics.RunMetrics()
+    glrestore.metrics.activate(metrics)
+    try:
+        glrestore.metrics.count_retry('list_objects_v2')
+        glrestore.metrics.tick('objects_classified', 50)
+    finally:
+        glrestore.metrics.activate(None)
+    assert metrics.retries['ListObjectsV2'] == 1
+
+    progress = glrestore.metrics.ProgressReporter(metrics, 'objects_classified', 'Classifying', total=200)
+    progress.begin = 0
+    progress.base = 0
+    assert progress.line(now=10) == "Classifying: 50 objects in 00:00:10 (5.0/s), 25% of 200, ETA 00:00:30"
+
+def test_benchmark(monkeypatch, tmp_path):
+    """
+    test that the benchmark suite runs (on a small bucket)
+    """
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('HOME', str(tmp_path))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    try:
+        import benchmark
+        result = benchmark.Benchmark(300).run(str(tmp_path))
+    finally:
+        sys.path.pop(0)
+        glrestore.s3_utils.clear_client_cache()
+
+    assert result['objects'] == 300
+    assert set(result['phases']) == set(['seed', 'wildcard_expansion', 'get_files_to_restore_v2', 'restore_files',
+                                         'wait_for_restore', 'report'])
+    assert result['phases']['get_files_to_restore_v2']['requests']['ListObjectsV2'] >= 1
+    assert result['phases']['restore_files']['requests']['RestoreObject'] > 0
+    assert all(p['peak_rss_mb'] > 0 for p in result['phases'].values())
+
 """
 INTEGRATED TESTS
 """